@@ -4,7 +4,9 @@ import math
 import numpy as np
 import torch
 import torch.distributed as dist
+import torch.nn.functional as F
 from torch.optim import Optimizer
+from torch.utils.checkpoint import checkpoint
 from torch._utils import _flatten_dense_tensors
 
 
@@ -332,4 +334,28 @@ class FusedAdam(Optimizer):
                     group["weight_decay"],
                 )
 
-        return loss
\ No newline at end of file
+        return loss
+
+
+def chunked_cross_entropy(hidden_states, head, labels, chunk_size=1024, ignore_index=-100):
+    """
+    same loss and gradients as
+        F.cross_entropy(head(hidden_states).float().view(-1, vocab), labels.view(-1), ignore_index=ignore_index)
+    without the B x L x vocab logits: the positions go through `head` + CE `chunk_size` at a time, and the
+    logits of a chunk are recomputed in backward, so at most one chunk of logits is alive.
+    hidden_states: B x L x H, labels: B x L (already shifted), chunk_size=None computes everything at once
+    """
+    def chunk_loss(h, y):
+        logits = head(h).float()
+        return F.cross_entropy(logits.view(-1, logits.size(-1)), y.reshape(-1), ignore_index=ignore_index, reduction="sum")
+
+    seq_len = hidden_states.size(1)
+    chunk_size = seq_len if chunk_size is None else chunk_size
+    total_loss = 0.
+    for start in range(0, seq_len, chunk_size):
+        h, y = hidden_states[:, start: start + chunk_size], labels[:, start: start + chunk_size]
+        if torch.is_grad_enabled() and chunk_size < seq_len:
+            total_loss = total_loss + checkpoint(chunk_loss, h, y, use_reentrant=False)
+        else:
+            total_loss = total_loss + chunk_loss(h, y)
+    return total_loss / (labels != ignore_index).sum()
@@ -11,6 +11,7 @@ from transformers.modeling_outputs import CausalLMOutputWithPast
 from transformers.generation import GenerationMixin
 from transformers.modeling_outputs import Seq2SeqLMOutput, BaseModelOutput
 from transformers.models.t5.modeling_t5 import T5Stack
+from models.utils import chunked_cross_entropy
 import copy
 from typing import Any, Mapping, Tuple, List, Optional, Dict, Sequence, Union
 
@@ -22,9 +23,10 @@ def freeze_model(model):
         param.requires_grad = False
 
 class VQSVGSeq2SeqModel(T5ForConditionalGeneration):  
-    def __init__(self, config, tokenizer=None, vqvae=None, codebook_size=4096):  
+    def __init__(self, config, tokenizer=None, vqvae=None, codebook_size=4096, ce_chunk_size=1024):  
         super(VQSVGSeq2SeqModel, self).__init__(config)
         self.config = config
+        self.ce_chunk_size = ce_chunk_size  # positions per chunk of the head + CE during training
         self.tokenizer = tokenizer
         self.codebook_size = codebook_size + 2  # add one for svg end token
         self.svg_end_token_id = codebook_size
@@ -157,18 +159,14 @@ class VQSVGSeq2SeqModel(T5ForConditionalGeneration):
             torch.cuda.set_device(self.encoder.first_device)
             self.vqvae_head = self.vqvae_head.to(self.encoder.first_device)
             sequence_output = sequence_output.to(self.vqvae_head.weight.device)
-            
-        svg_logits = self.vqvae_head(sequence_output)
         
-        loss = None
+        loss, svg_logits = None, None
 
         if golden_svg_tokens is not None:
-            # Shift so that tokens < n predict n
-            shift_svg_logits = svg_logits[:, :-1, :].contiguous()
-            shift_golden_svg_tokens = golden_svg_tokens[:, 1:].contiguous()
-            shift_svg_logits = shift_svg_logits.view(-1, self.codebook_size)
-            shift_golden_svg_tokens = shift_golden_svg_tokens.view(-1)
-            loss = F.cross_entropy(shift_svg_logits, shift_golden_svg_tokens)
+            # Shift so that tokens < n predict n, the training logits are never materialized
+            loss = chunked_cross_entropy(sequence_output[:, :-1, :], self.vqvae_head, golden_svg_tokens[:, 1:], chunk_size=self.ce_chunk_size)
+        else:
+            svg_logits = self.vqvae_head(sequence_output)
         
         if not return_dict:
             if not isinstance(encoder_outputs, tuple):
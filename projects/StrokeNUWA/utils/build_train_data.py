@@ -3,17 +3,21 @@ import glob
 import logging
 import json
 import sys
+sys.path.append(os.getcwd())  # run from the StrokeNUWA root, like scripts/
 from tqdm import tqdm
 from concurrent import futures
+from collections import deque
 from argparse import ArgumentParser
 from change_deepsvg.svglib.svg import SVG
 from change_deepsvg.svglib.geom import Bbox, Angle, Point
 from change_deepsvg.difflib.tensor import SVGTensor
 from modelzipper.tutils import *
 import torch
+import numpy as np
 from tqdm import trange
 from tqdm.auto import tqdm 
 import multiprocessing
+from data.svg_shards import read_manifest, write_manifest, write_shard, strip_prefixes
 
 BLACK_BOX = torch.tensor([
     [  0.,   0.,   0.,   0.,   0.,   0.,   0.,   0.,  96.],
@@ -34,21 +38,28 @@ EDGE = torch.tensor([
     [  1.,   4., 104.,   0.,   0.,   0.,   0.,   4., 104.],
 ])
 
-def build_mesh_data(svg_file):
+PREFIXES = (BLACK_BOX, EDGE)  # stripped in this order
+
+
+def load_svg_tensor(svg_file):
+    """svg file -> numericalized svg tensor as a float32 array (num_rows x 9), prefixes not stripped yet"""
     try:
         svg = SVG.load_svg(svg_file)
         svg.numericalize(n=200)
         svg_tensors = svg.to_tensor(concat_groups=False, PAD_VAL=0)
-        svg_tensors = torch.cat(svg_tensors)
-        if svg_tensors[:6].equal(BLACK_BOX):
-            svg_tensors = svg_tensors[6:]
-        if svg_tensors[:7].equal(EDGE):
-            svg_tensors = svg_tensors[7:]
-        svg_tensors = torch.clamp(svg_tensors, min=0, max=200)
-        return svg_tensors
+        return torch.cat(svg_tensors).numpy().astype(np.float32)
     except:
-        print_c("Error in build_mesh_data", 'red')
+        print_c(f"Error in load_svg_tensor: {svg_file}", 'red')
+        return None
+
+
+def build_mesh_data(svg_file):
+    svg_tensors = load_svg_tensor(svg_file)
+    if svg_tensors is None:
         return None
+    offsets, lengths = strip_prefixes(svg_tensors, np.zeros(1, dtype=np.int64), np.array([len(svg_tensors)]), [p.numpy() for p in PREFIXES])
+    svg_tensors = torch.from_numpy(svg_tensors[offsets[0]: offsets[0] + lengths[0]])
+    return torch.clamp(svg_tensors, min=0, max=200)
 
 def convert_to_mesh(mesh_data, num_sub_path = 3):
     idx = 0
@@ -66,22 +77,76 @@ def convert_to_mesh(mesh_data, num_sub_path = 3):
     return new_mesh_data, pair_sub_paths
 
 def convert_svg(sample):
-    svg_file = sample['file_path']
-    keywords = sample['keywords']
-    category_name = sample['category_name']
-    mesh_data = build_mesh_data(svg_file)
-    return {'keywords': keywords, 'mesh_data': mesh_data, 'category_name': category_name}
+    return {
+        'keywords': sample['keywords'], 
+        'category_name': sample['category_name'], 
+        'file_path': sample['file_path'],
+        'mesh_data': load_svg_tensor(sample['file_path']),
+    }
+
+
+def convert_svgs(samples):
+    return [convert_svg(sample) for sample in samples]
+
+
+def build_corpus(meta_data, save_dir, shard_size=10000, workers=32, source=None, chunk_size=64, shards_ahead=2):
+    """
+    convert all svg files into the sharded format of data/svg_shards.py, in worker processes
+    every shard is written as soon as its samples are converted, and shards listed in the
+    manifest are skipped, so an interrupted run continues where it stopped
+    only `shards_ahead` shards of samples (in chunks of `chunk_size`) are submitted ahead of the shard being written
+    """
+    os.makedirs(save_dir, exist_ok=True)
+    num_shards = (len(meta_data) + shard_size - 1) // shard_size
+    manifest = read_manifest(save_dir)
+    if manifest is None or manifest['shard_size'] != shard_size or manifest['num_samples'] != len(meta_data):
+        manifest = {'source': source, 'shard_size': shard_size, 'num_samples': len(meta_data), 'num_shards': num_shards, 'shards': {}}
+
+    todo = [i for i in range(num_shards) if str(i) not in manifest['shards']]
+    print_c(f"{num_shards - len(todo)} / {num_shards} shards already done, converting {len(todo)} shards", 'magenta')
+    if len(todo) == 0:
+        return manifest
+
+    def pending_chunks():
+        # chunks never straddle two shards
+        for shard_id in todo:
+            shard = meta_data[shard_id * shard_size: (shard_id + 1) * shard_size]
+            for start in range(0, len(shard), chunk_size):
+                yield shard[start: start + chunk_size]
+
+    chunks = pending_chunks()
+    max_in_flight = max(workers, shards_ahead * ((shard_size + chunk_size - 1) // chunk_size))
+    in_flight = deque()
+
+    with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        with tqdm(total=sum(min(shard_size, len(meta_data) - i * shard_size) for i in todo), desc='converting svg files') as pbar:
+            for shard_id in todo:
+                num_samples = min(shard_size, len(meta_data) - shard_id * shard_size)
+                samples = []
+                while len(samples) < num_samples:
+                    while len(in_flight) < max_in_flight:
+                        chunk = next(chunks, None)
+                        if chunk is None:
+                            break
+                        in_flight.append(executor.submit(convert_svgs, chunk))
+                    samples.extend(in_flight.popleft().result())
+                manifest['shards'][str(shard_id)] = write_shard(save_dir, shard_id, samples, prefixes=[p.numpy() for p in PREFIXES])
+                write_manifest(save_dir, manifest)
+                pbar.update(num_samples)
+    return manifest
 
 
 if __name__ == '__main__':
 
     parser = ArgumentParser()
     parser.add_argument("--workers", default=32, type=int)
-    parser.add_argument("--file", default=32, type=int)
+    parser.add_argument("--file", required=True, type=str)
+    parser.add_argument("--save_dir", required=True, type=str)
+    parser.add_argument("--shard_size", default=10000, type=int)
 
     args = parser.parse_args()
 
     meta_data = auto_read_data(args.file)  # ["file_path", "keywords", "category_name"]
 
-
-    auto_save_data(meta_data, '/save/path')
\ No newline at end of file
+    manifest = build_corpus(meta_data, args.save_dir, shard_size=args.shard_size, workers=args.workers, source=args.file)
+    print_c(f"{sum(manifest['shards'].values())} / {len(meta_data)} svg files saved in {args.save_dir}", 'green')
@@ -6,6 +6,7 @@ from typing import List, Optional, Sequence, Union, Any, Callable, Dict, Tuple
 from modelzipper.tutils import *
 from torch.utils.data import DataLoader, Dataset
 import pytorch_lightning as pl
+from data.svg_shards import SVGShardCorpus, is_svg_corpus
 
 EDGE = torch.tensor([  # after convert function
     [    0,    0,    0,    0,    0,    0,    0,    4,  104],
@@ -34,7 +35,10 @@ class BasicDataset(Dataset):
         if cluster_batch:
             # first sort the dataset by length
             print_c("you choose to cluster by batch length, begin to sort dataset by length, this may take some time ...", color='magenta')
-            dataset = sorted(dataset, key=lambda x: x['mesh_data'].shape[0])
+            if isinstance(dataset, SVGShardCorpus):
+                dataset = dataset.sort_by_length()
+            else:
+                dataset = sorted(dataset, key=lambda x: x['mesh_data'].shape[0])
             print_c("sort done !", color='magenta')
 
         self.dataset = dataset
@@ -43,6 +47,9 @@ class BasicDataset(Dataset):
         # just prevent too short path
         # length exceed max_seq_length will be cut off in __getitem__
         print_c(f"begin to sanity check the dataset and conduct pre_process, num of samples: {len(dataset)}, it will take some time...", color='magenta')
+        if isinstance(dataset, SVGShardCorpus):
+            # prefixes are already stripped by the builder, only the lengths are needed
+            return dataset.subset(dataset.lengths() >= min_length)
         new_dataset = []
         for item in dataset:
             sample = item['mesh_data']
@@ -154,6 +161,13 @@ class PadCollate:
         return self.pad_collate(batch)
     
 
+def load_svg_data(path):
+    """sharded corpus directory from data/build_train_data.py (memory-mapped), or a pkl / jsonl file"""
+    if is_svg_corpus(path):
+        return SVGShardCorpus(path)
+    return auto_read_data(path)
+
+
 class SvgDataModule(pl.LightningDataModule):
     def __init__(self, config, transform=None):
         super().__init__()
@@ -168,7 +182,7 @@ class SvgDataModule(pl.LightningDataModule):
     def setup(self, stage: str = 'fit') -> None:
         self.test_dataset = None
         if self.cfg.inference_mode:
-            self.test_file = auto_read_data(self.cfg.test_data_path)
+            self.test_file = load_svg_data(self.cfg.test_data_path)
             self.test_dataset = BasicDataset(
                 self.test_file, max_path_nums=self.cfg.max_path_nums, 
                 mode='test', pad_token_id=self.cfg.pad_token_id,
@@ -177,7 +191,7 @@ class SvgDataModule(pl.LightningDataModule):
                 cluster_batch=False
             )
         else:
-            self.svg_files = auto_read_data(self.cfg.train_data_path)
+            self.svg_files = load_svg_data(self.cfg.train_data_path)
             val_length = min(1000, len(self.svg_files) * 0.02)
             self.train_file = self.svg_files[:-1000]
             self.valid_file = self.svg_files[-1000:]
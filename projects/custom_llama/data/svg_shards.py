@@ -0,0 +1,158 @@
+"""
+Sharded, memory-mapped SVG tensor corpus, written by data/build_train_data.py
+
+    corpus_dir/
+        manifest.json               source file, shard size, completed shards
+        shard_00000.bin             uint8 rows of all the svg tensors of the shard, num_rows x 9
+        shard_00000.index.npy       int64 (offset, length) in rows of each sample
+        shard_00000.meta.json       keywords / category_name / file_path of each sample
+
+The values are clamped to [0, 200] by the builder, so one byte per value is enough.
+`SVGShardCorpus` reads the samples lazily and can stand in for the list of
+{'keywords', 'mesh_data', ...} dicts loaded from the old full_data.pkl.
+"""
+import os
+import json
+import numpy as np
+import torch
+
+MANIFEST_NAME = "manifest.json"
+NUM_COLUMNS = 9
+VALUE_DTYPE = np.uint8
+
+
+def shard_name(shard_id):
+    return f"shard_{shard_id:05d}"
+
+
+def read_manifest(corpus_dir):
+    path = os.path.join(corpus_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_manifest(corpus_dir, manifest):
+    # write then rename, a crash never leaves a half written manifest
+    path = os.path.join(corpus_dir, MANIFEST_NAME)
+    with open(path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(path + ".tmp", path)
+
+
+def is_svg_corpus(path):
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, MANIFEST_NAME))
+
+
+def strip_prefixes(values, offsets, lengths, prefixes):
+    """
+    drop the leading rows of every sample that equal one of `prefixes` (checked in order), for all samples at once
+    values: concatenated rows of the samples, num_rows x 9
+    offsets / lengths: int64 arrays, the rows of each sample
+    returns the new offsets and lengths
+    """
+    offsets, lengths = offsets.copy(), lengths.copy()
+    for prefix in prefixes:
+        n = len(prefix)
+        rows = offsets[:, None] + np.arange(n)[None, :]
+        candidates = values[np.minimum(rows, len(values) - 1)] if len(values) > 0 else np.zeros((len(offsets), n, NUM_COLUMNS), values.dtype)
+        matched = (lengths >= n) & (candidates == prefix[None]).all(axis=(1, 2))
+        offsets[matched] += n
+        lengths[matched] -= n
+    return offsets, lengths
+
+
+def write_shard(corpus_dir, shard_id, samples, prefixes=(), max_value=200):
+    """
+    samples: list of {'mesh_data': array num_rows x 9 or None, **meta}, failed samples (None) are dropped
+    returns the number of samples written
+    """
+    samples = [s for s in samples if s["mesh_data"] is not None]
+    arrays = [np.asarray(s["mesh_data"], dtype=np.float32).reshape(-1, NUM_COLUMNS) for s in samples]
+    lengths = np.array([len(a) for a in arrays], dtype=np.int64)
+    offsets = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64) if len(arrays) > 0 else lengths
+    values = np.concatenate(arrays) if len(arrays) > 0 else np.zeros((0, NUM_COLUMNS), dtype=np.float32)
+
+    offsets, lengths = strip_prefixes(values, offsets, lengths, [np.asarray(p, dtype=np.float32) for p in prefixes])
+    values = np.clip(values, 0, max_value).astype(VALUE_DTYPE)
+
+    name = os.path.join(corpus_dir, shard_name(shard_id))
+    # the index is written last, a shard without index is incomplete
+    values.tofile(name + ".bin")
+    with open(name + ".meta.json", "w") as f:
+        json.dump([{k: v for k, v in s.items() if k != "mesh_data"} for s in samples], f)
+    np.save(name + ".index.npy", np.stack([offsets, lengths], axis=1).reshape(-1, 2))
+    return len(samples)
+
+
+class SVGShardCorpus:
+    """
+    list-like view of a sharded corpus, `corpus[i]` is {'keywords', 'mesh_data', ...} with mesh_data a float tensor
+    slicing / `subset` / `sort_by_length` return views, nothing is read until an item is accessed
+    """
+    def __init__(self, corpus_dir, indices=None):
+        self.corpus_dir = corpus_dir
+        self.manifest = read_manifest(corpus_dir)
+        assert self.manifest is not None, f"no {MANIFEST_NAME} in {corpus_dir}"
+
+        shard_ids = sorted(int(k) for k in self.manifest["shards"])
+        self.shard_ids = shard_ids
+        self.index = [np.load(os.path.join(corpus_dir, shard_name(i) + ".index.npy")) for i in shard_ids]
+        self.meta = None
+        self.values = None  # memmaps are opened lazily, once per dataloader worker
+
+        shard_of = np.concatenate([np.full(len(idx), k, dtype=np.int64) for k, idx in enumerate(self.index)]) if self.index else np.zeros(0, dtype=np.int64)
+        row_of = np.concatenate([np.arange(len(idx)) for idx in self.index]) if self.index else np.zeros(0, dtype=np.int64)
+        self.locations = np.stack([shard_of, row_of], axis=1)
+        self.all_lengths = np.concatenate([idx[:, 1] for idx in self.index]) if self.index else np.zeros(0, dtype=np.int64)
+        self.indices = np.arange(len(self.locations)) if indices is None else np.asarray(indices, dtype=np.int64)
+
+    def _view(self, indices):
+        view = object.__new__(SVGShardCorpus)
+        view.__dict__.update(self.__dict__)
+        view.indices = np.asarray(indices, dtype=np.int64)
+        return view
+
+    def _open(self):
+        self.values, self.meta = [], []
+        for i in self.shard_ids:
+            name = os.path.join(self.corpus_dir, shard_name(i))
+            size = os.path.getsize(name + ".bin")
+            self.values.append(np.memmap(name + ".bin", dtype=VALUE_DTYPE, mode="r").reshape(-1, NUM_COLUMNS) if size > 0 else np.zeros((0, NUM_COLUMNS), dtype=VALUE_DTYPE))
+            with open(name + ".meta.json") as f:
+                self.meta.append(json.load(f))
+
+    def __getstate__(self):
+        # memmaps are not sent to the workers, each one reopens them
+        state = dict(self.__dict__)
+        state["values"], state["meta"] = None, None
+        return state
+
+    def lengths(self):
+        """number of rows (paths) of each sample, without reading them"""
+        return self.all_lengths[self.indices]
+
+    def subset(self, mask_or_indices):
+        return self._view(self.indices[mask_or_indices])
+
+    def sort_by_length(self):
+        return self._view(self.indices[np.argsort(self.lengths(), kind="stable")])
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self._view(self.indices[idx])
+        if self.values is None:
+            self._open()
+        shard, row = self.locations[self.indices[idx]]
+        offset, length = self.index[shard][row]
+        item = dict(self.meta[shard][row])
+        item["mesh_data"] = torch.from_numpy(self.values[shard][offset: offset + length].astype(np.float32))
+        return item
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
@@ -9,6 +9,7 @@ import torch.nn as nn
 from transformers import PreTrainedTokenizer, LlamaConfig, LlamaForCausalLM  
 from torch.utils.data import DataLoader, Dataset 
 from modelzipper.tutils import *
+from models.vq_code_cache import svg_content_hash
 
 
 EDGE = torch.tensor([  # after convert function
@@ -64,7 +65,11 @@ class BasicDataset(Dataset):
     # PROMPT_TEMPLATE = "Keywords: {keywords} #begin:"
     PROMPT_TEMPLATE = "{keywords}"
 
-    def __init__(self, content, tokenizer, svg_begin_token=None, mode="train", min_path_nums=None, max_path_nums=None, max_text_length=64, cluster_batch=False) -> None:
+    def __init__(self, content, tokenizer, svg_begin_token=None, mode="train", min_path_nums=None, max_path_nums=None, max_text_length=64, cluster_batch=False, sample_id_offset=0) -> None:
+        """
+        sample_id_offset: position of content[0] in the full data file, sample ids (the keys of the
+        vqvae code cache, see models/vq_code_cache.py) stay the same for the train / valid splits
+        """
         super().__init__()
 
         self.tokenizer = tokenizer
@@ -74,7 +79,7 @@ class BasicDataset(Dataset):
         self.min_path_nums = min_path_nums
         self.max_path_nums = max_path_nums
 
-        content = self.pre_process(content)
+        content = self.pre_process(content, sample_id_offset=sample_id_offset)
         if cluster_batch:
             # first sort the dataset by length
             print_c("you choose to cluster by batch length, begin to sort dataset by length, this may take some time ...", color='magenta')
@@ -82,12 +87,12 @@ class BasicDataset(Dataset):
             print_c("sort done !", color='magenta')
         self.content = content
 
-    def pre_process(self, dataset, min_length=1):   
+    def pre_process(self, dataset, min_length=1, sample_id_offset=0):   
         # just prevent too short path
         # length exceed max_seq_length will be cut off in __getitem__
         print_c(f"begin to sanity check the dataset and conduct pre_process, num of samples: {len(dataset)}, it will take some time...", color='magenta')
         new_dataset = []
-        for item in dataset:
+        for i, item in enumerate(dataset):
             sample = item['mesh_data']
             if sample is None:
                 continue
@@ -98,6 +103,7 @@ class BasicDataset(Dataset):
                     {
                         'keywords': item['keywords'],
                         'mesh_data': sample,
+                        'sample_id': sample_id_offset + i,
                     }
                 )
         return new_dataset
@@ -153,6 +159,8 @@ class BasicDataset(Dataset):
             "text_labels": text_labels,
             "svg_tensors": sample.long(),
             "svg_attention_mask": svg_attention_mask,
+            "svg_ids": item['sample_id'],
+            "svg_hashes": svg_content_hash(sample.long()),
         }
 
 
@@ -376,13 +384,17 @@ class VQDataCollator:
             svg_padding_mask = list(map(lambda x: cal_compress_padding_mask(x), svg_padding_mask))
             svg_padding_mask = torch.stack(svg_padding_mask, dim=0)
 
-        return {
+        res = {
             "text_input_ids": text_input_ids,
             "text_attention_mask": text_attention_mask,
             "text_labels": text_labels,
             "svg_tensors": svg_tensors, 
             "svg_padding_mask": svg_padding_mask,
         }
+        if not self.offline_mode and "svg_ids" in batch[0]:  # keys of the vqvae code cache
+            res["svg_ids"] = torch.tensor([x['svg_ids'] for x in batch], dtype=torch.long)
+            res["svg_hashes"] = torch.tensor([x['svg_hashes'] for x in batch], dtype=torch.long)
+        return res
 
     def __call__(self, batch):
         return self.pad_collate(batch)
@@ -415,9 +427,12 @@ class VQLLaMAData:
                 print_c(f"num of train data: {len(content) - num_valid_data}", color='magenta')
                 self.valid_data = content[:num_valid_data]
                 self.train_data = content[num_valid_data:]
+                self.train_id_offset = num_valid_data
             else:
                 self.train_data = content
                 self.valid_data = content  # fake validation set
+                self.train_id_offset = 0
+            self.num_samples = len(content)  # size of the vqvae code cache
         
         self.svg_begin_token = svg_begin_token
         self.offline_mode = offline_mode
@@ -451,7 +466,8 @@ class VQLLaMAData:
                 svg_begin_token = self.svg_begin_token,
                 max_text_length=self.cfg.max_text_length,
                 mode="train",
-                cluster_batch=False
+                cluster_batch=False,
+                sample_id_offset=self.train_id_offset,
             )
 
     @property
@@ -11,6 +11,7 @@ from models.vqvae import VQVAE, postprocess
 from data.svg_data import *
 import pytorch_lightning as pl
 from utils.visualize_svg import convert_svg
+from utils.render_pool import SVGRenderPool
 import transformers
 from tqdm import trange
 from PIL import Image
@@ -20,6 +21,9 @@ FILE_PATH = "/zecheng2/svg/icon-shop/test_data_snaps/test_data_all_seq_with_mesh
 VQVAE_CONFIG_PATH = "/workspace/zecheng/modelzipper/projects/custom_llama/configs/deepspeed/vqvae_config_v2.yaml"
 DATA_PATH = "/zecheng2/svg/icon-shop/test_data_snaps/test_data_all_seq_with_mesh.pkl"
 
+# pngs are rendered in background processes while the VQVAE decodes the next samples
+render_pool = SVGRenderPool(num_workers=16)
+
 tokenizer = transformers.AutoTokenizer.from_pretrained("/zecheng2/model_hub/flan-t5-xl")
 
 content = auto_read_data(DATA_PATH)
@@ -85,9 +89,13 @@ for i in trange(200):
         PC_RES_IMAGE_PATH = os.path.join("/zecheng2/evaluation/test_vq/version_8/image", f"PC_{i}.png")
         GT_IMAGE_PATH = os.path.join("/zecheng2/evaluation/test_vq/version_8/image", f"GT_{i}.png")
         
-        PI_RES_image, PI_RES_str = convert_svg(PI_RES, True, PI_RES_IMAGE_PATH)
-        PC_RES_image, PC_RES_str = convert_svg(PC_RES, True, PC_RES_IMAGE_PATH)
-        GOLDEN_image, GT_str = convert_svg(dataset[i]['mesh_data'], True, GT_IMAGE_PATH)
+        PI_RES_image, PI_RES_str = convert_svg(PI_RES, False)
+        PC_RES_image, PC_RES_str = convert_svg(PC_RES, False)
+        GOLDEN_image, GT_str = convert_svg(dataset[i]['mesh_data'], False)
+        
+        render_pool.submit(PI_RES, save_path=PI_RES_IMAGE_PATH, colored=True)
+        render_pool.submit(PC_RES, save_path=PC_RES_IMAGE_PATH, colored=True)
+        render_pool.submit(dataset[i]['mesh_data'], save_path=GT_IMAGE_PATH, colored=True)
         
         cur_save_case['pi_res_str'] = PI_RES_image.numericalize(n=200).to_str()
         cur_save_case['pc_res_str'] = PC_RES_image.numericalize(n=200).to_str()
@@ -107,5 +115,6 @@ for i in trange(200):
         
         vq_test.append(cur_save_case)
     
+render_pool.close()  # wait for the last pngs
 auto_save_data(vq_test, "/zecheng2/evaluation/test_vq/version_8/vq_test.pkl")
         
\ No newline at end of file
@@ -1,74 +1,47 @@
 import torch
 import clip
 from PIL import Image
-from torchmetrics.multimodal.clip_score import CLIPScore
-from torchmetrics.image.fid import FrechetInceptionDistance
-from torchmetrics.multimodal import CLIPImageQualityAssessment
-import edit_distance
+from image_metrics import ImageMetricEngine
+from token_metrics import batched_edit_distance, tokenize_ids
 import transformers
 from tqdm import trange
 from modelzipper.tutils import *
 import gc
 
+FEATURE_CACHE_DIR = "/zecheng2/evaluation/feature_cache"  # per-image inception / CLIP features, keyed by png hash
 
-@torch.no_grad()
-def calculate_fid(fid_metric, pred_images, golden_images, clip_model, clip_process, device):
+
+def calculate_fid(engine, pred_images, golden_images):
     """
-    a single tensor it should have shape (N, C, H, W). If a list of tensors, each tensor should have shape (C, H, W). C is the number of channels, H and W are the height and width of the image.
-    
-        imgs_dist1 = torch.randint(0, 200, (100, 3, 299, 299), dtype=torch.uint8)  
-        imgs_dist2 = torch.randint(100, 255, (100, 3, 299, 299), dtype=torch.uint8)
-        fid.update(imgs_dist1, real=True)
-        fid.update(imgs_dist2, real=False)
+    FID between the rendered predictions and the golden images (png paths), the images are
+    decoded in DataLoader workers and embedded in batches, see image_metrics.ImageMetricEngine
     """
-    pred_image_features, golden_image_features = [], []
-    for i in trange(len(pred_images)):
-        pred_image = clip_process(Image.open(pred_images[i])).to(device)
-        golden_image = clip_process(Image.open(golden_images[i])).to(device)
-        pred_image_features.append(pred_image)
-        golden_image_features.append(golden_image)
-    
-    pred_images = torch.stack(pred_image_features, dim=0).to(dtype=torch.uint8)
-    golden_images = torch.stack(golden_image_features, dim=0).to(dtype=torch.uint8)
-    
-    fid_metric.update(golden_images, real=True)  # N x C x W x H
-    fid_metric.update(pred_images, real=False)
-    return fid_metric.compute()
-
-@torch.no_grad()
-def calculate_clip_core(clip_process, clip_metric, pred_images, keywords_lst):
+    return engine.fid(pred_images, golden_images)
+
+
+def calculate_clip_core(engine, pred_images, keywords_lst):
     """
-        metric = CLIPScore(model_name_or_path="openai/clip-vit-base-patch16")
-        score = metric(torch.randint(255, (3, 224, 224), generator=torch.manual_seed(42)), "a photo of a cat")
-        score.detach()
+    mean CLIPScore of each image (png path) against its keywords
     """
-    avg_scores = []
-    for i in trange(len(pred_images)):
-        img = clip_process(Image.open(pred_images[i])).unsqueeze(0).to(device).to(dtype=torch.uint8)
-        clip_score = clip_metric(img, keywords_lst[i]).detach()
-        avg_scores.append(clip_score)
-        
-    return sum(avg_scores) / len(avg_scores)
+    return engine.clip_score(pred_images, keywords_lst)
 
 
-def calculate_clip_image_quality(quality_metric, imgs):
+def calculate_clip_image_quality(engine, pred_images):
     """
-        _ = torch.manual_seed(42)
-        imgs = torch.randint(255, (2, 3, 224, 224)).float()
-        metric = CLIPImageQualityAssessment(prompts=("quality"))
-        metric(imgs)
+    CLIP-IQA "quality" score of each image (png path)
     """
-    return quality_metric(imgs)
+    return engine.clip_image_quality(pred_images)
 
 
-def calculate_edit(tokenizer, gen_svg_paths, golden_svg_paths):
-    preds = [tokenizer.tokenize(x) for x in gen_svg_paths]     
+def calculate_edit(tokenizer, gen_svg_paths, golden_svg_paths, num_workers=16):
+    """
+    mean token-level edit distance between the generated and golden strings, the strings are
+    tokenized in one batched call and the distances computed in worker processes
+    """
+    preds = tokenize_ids(tokenizer, gen_svg_paths)
     avg_str_prd_len = sum([len(x) for x in preds]) / len(preds)
-    golden = [tokenizer.tokenize(x) for x in golden_svg_paths]      
-    distance = []
-    for i in trange(len(preds)):
-        sm = edit_distance.SequenceMatcher(a=preds[i], b=golden[i])
-        distance.append(sm.distance())
+    golden = tokenize_ids(tokenizer, golden_svg_paths)
+    distance = batched_edit_distance(preds, golden, num_workers=num_workers)
     return sum(distance) / len(distance), avg_str_prd_len
 
 
@@ -151,12 +124,8 @@ if __name__ == "__main__":
     # dict_keys(['text', 'p_svg_str', 'g_svg_str', 'r_svg_str', 'r_svg_path', 'p_svg_path', 'g_svg_path'])
     
     device =  "cuda:1"
-    fid_metric = FrechetInceptionDistance(feature=768).to(device)  # 768
-    clip_metric = CLIPScore(model_name_or_path="openai/clip-vit-large-patch14").to(device)
-   
-    quality_metric = CLIPImageQualityAssessment(prompts=("quality",))
-    
-    clip_model, clip_process = clip.load("ViT-L/14", device=device)
+    # FID (inception 768) / CLIPScore (clip-vit-large-patch14) / CLIP-IQA (torchmetrics clip_iqa), features cached across runs
+    engine = ImageMetricEngine.from_pretrained(fid_feature=768, clip_model="openai/clip-vit-large-patch14", device=device, cache_dir=FEATURE_CACHE_DIR)
     
     # pred_images = [item['p_svg_path'] for item in data]
     # reconstruction_images = [item['r_svg_path'] for item in data]
@@ -165,12 +134,12 @@ if __name__ == "__main__":
     import pdb; pdb.set_trace()
     
     ## GPT4
-    calculate_clip_core(clip_process, clip_metric, GPT4_PNG, KEYS) # 16.3232
+    calculate_clip_core(engine, GPT4_PNG, KEYS)
     
-    calculate_clip_core(clip_process, clip_metric, LIVE_PNG, KEYS) # 23.1125
-    calculate_clip_core(clip_process, clip_metric, LayoutNUWA_PNG, KEYS) # 21.8337
-    calculate_clip_core(clip_process, clip_metric, LIVE_PNG_2, KEYS) # 23.2657
-    calculate_clip_core(clip_process, clip_metric, SVGNUWA_PNG, KEYS)  # 24.6824
+    calculate_clip_core(engine, LIVE_PNG, KEYS)
+    calculate_clip_core(engine, LayoutNUWA_PNG, KEYS)
+    calculate_clip_core(engine, LIVE_PNG_2, KEYS)
+    calculate_clip_core(engine, SVGNUWA_PNG, KEYS)
     
     metrics = {}
     
@@ -178,14 +147,14 @@ if __name__ == "__main__":
     metrics['pc_res_len'] = sum(pc_res_len) / len(pc_res_len)
     metrics['gt_res_len'] = sum(gt_res_len) / len(gt_res_len)
     
-    PI_fid_res = calculate_fid(fid_metric, PI_RES_image_path, GT_image_path, clip_model, clip_process, device).cpu()
-    PC_fid_res = calculate_fid(fid_metric, PC_RES_image_path, GT_image_path, clip_model, clip_process, device).cpu()
+    PI_fid_res = calculate_fid(engine, PI_RES_image_path, GT_image_path).cpu()
+    PC_fid_res = calculate_fid(engine, PC_RES_image_path, GT_image_path).cpu()
     
     metrics['PI_fid_res'] = PI_fid_res
     metrics['PC_fid_res'] = PC_fid_res
     
-    PI_CLIP_SCORE = calculate_clip_core(clip_process, clip_metric, PI_RES_image_path, keys)
-    PC_CLIP_SCORE = calculate_clip_core(clip_process, clip_metric, PC_RES_image_path, keys)
+    PI_CLIP_SCORE = calculate_clip_core(engine, PI_RES_image_path, keys)
+    PC_CLIP_SCORE = calculate_clip_core(engine, PC_RES_image_path, keys)
     
     metrics['PI_CLIP_SCORE'] = PI_CLIP_SCORE
     metrics['PC_CLIP_SCORE'] = PC_CLIP_SCORE
@@ -0,0 +1,372 @@
+"""
+Batched image metrics (FID / CLIPScore / CLIP-IQA) for the rendered SVG samples.
+
+Images are decoded and preprocessed inside DataLoader workers, embedded in fixed-size
+batches, and the per-image features are cached on disk keyed by the file content hash,
+so re-scoring a run against a new baseline only embeds the new images.
+
+    engine = ImageMetricEngine.from_pretrained(device="cuda:0", cache_dir="/zecheng2/evaluation/feature_cache")
+    fid = engine.fid(pred_paths, golden_paths)
+    clip_score = engine.clip_score(pred_paths, texts)
+    quality = engine.clip_image_quality(pred_paths)
+
+`python eval/image_metrics.py --test` runs the whole pipeline on CPU with tiny feature extractors.
+"""
+import os
+import io
+import hashlib
+import argparse
+import tempfile
+from concurrent import futures
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch.utils.data import Dataset, DataLoader
+from torchmetrics.image.fid import FrechetInceptionDistance
+from PIL import Image
+from tqdm import tqdm
+
+CLIP_IQA_PROMPTS = {
+    "quality": ("Good photo.", "Bad photo."),
+    "brightness": ("Bright photo.", "Dark photo."),
+    "noisiness": ("Clean photo.", "Noisy photo."),
+    "colorfullness": ("Colorful photo.", "Dull photo."),
+    "sharpness": ("Sharp photo.", "Blurry photo."),
+}
+
+
+def file_hash(path):
+    with open(path, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def load_image(data, image_size):
+    """
+    decode an image (path or bytes) into a uint8 tensor of shape 3 x image_size x image_size,
+    resized on the short side and center cropped, like the CLIP preprocessing
+    """
+    image = Image.open(io.BytesIO(data) if isinstance(data, bytes) else data).convert("RGB")
+    w, h = image.size
+    scale = image_size / min(w, h)
+    image = image.resize((max(image_size, round(w * scale)), max(image_size, round(h * scale))), Image.BICUBIC)
+    w, h = image.size
+    left, top = (w - image_size) // 2, (h - image_size) // 2
+    image = image.crop((left, top, left + image_size, top + image_size))
+    return torch.from_numpy(np.asarray(image).copy()).permute(2, 0, 1)
+
+
+class ImageFileDataset(Dataset):
+    """decoding and preprocessing happen in the DataLoader workers"""
+    def __init__(self, paths, image_size):
+        self.paths = paths
+        self.image_size = image_size
+
+    def __len__(self):
+        return len(self.paths)
+
+    def __getitem__(self, idx):
+        return idx, load_image(self.paths[idx], self.image_size)
+
+
+class FeatureCache:
+    """
+    per-image features of one feature extractor, keyed by the file content hash,
+    stored as a single npz file (keys + feature matrix) under cache_dir
+    """
+    def __init__(self, cache_dir, name):
+        self.path = os.path.join(cache_dir, f"{name}.npz") if cache_dir is not None else None
+        self.features = {}
+        self.dirty = False
+        if self.path is not None and os.path.exists(self.path):
+            content = np.load(self.path)
+            self.features = dict(zip(content["keys"].tolist(), content["features"]))
+
+    def __contains__(self, key):
+        return key in self.features
+
+    def get(self, keys):
+        return torch.from_numpy(np.stack([self.features[k] for k in keys]))
+
+    def put(self, keys, features):
+        features = features.float().cpu().numpy()
+        for key, feature in zip(keys, features):
+            self.features[key] = feature
+        self.dirty = True
+
+    def save(self):
+        if self.path is None or not self.dirty:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        keys = list(self.features.keys())
+        tmp_path = self.path + ".tmp.npz"
+        np.savez(tmp_path, keys=np.array(keys), features=np.stack([self.features[k] for k in keys]))
+        os.replace(tmp_path, self.path)
+        self.dirty = False
+
+
+class PrecomputedFeatures(nn.Module):
+    """identity 'feature extractor', so that FrechetInceptionDistance.update takes features directly"""
+    def __init__(self, num_features):
+        super().__init__()
+        self.num_features = num_features
+
+    def forward(self, x):
+        return x
+
+
+class HFClipBackend(nn.Module):
+    """CLIP image / text embeddings from a huggingface checkpoint, same model as torchmetrics CLIPScore"""
+    def __init__(self, model_name_or_path="openai/clip-vit-large-patch14"):
+        super().__init__()
+        from transformers import CLIPModel, CLIPProcessor
+        self.name = model_name_or_path.replace("/", "_")
+        self.model = CLIPModel.from_pretrained(model_name_or_path).eval()
+        self.processor = CLIPProcessor.from_pretrained(model_name_or_path)
+        self.image_size = self.processor.image_processor.crop_size["height"]
+        self.register_buffer("mean", torch.tensor(self.processor.image_processor.image_mean).view(1, 3, 1, 1))
+        self.register_buffer("std", torch.tensor(self.processor.image_processor.image_std).view(1, 3, 1, 1))
+
+    def encode_images(self, images):
+        pixel_values = (images.float() / 255 - self.mean) / self.std
+        return F.normalize(self.model.get_image_features(pixel_values=pixel_values), dim=-1)
+
+    def encode_texts(self, texts):
+        max_length = self.model.config.text_config.max_position_embeddings
+        inputs = self.processor(text=texts, return_tensors="pt", padding=True, truncation=True, max_length=max_length)
+        inputs = {k: v.to(self.mean.device) for k, v in inputs.items()}
+        return F.normalize(self.model.get_text_features(**inputs), dim=-1)
+
+
+class ClipIQABackend(nn.Module):
+    """
+    model, anchor prompts and image normalization of torchmetrics CLIPImageQualityAssessment, the default
+    "clip_iqa" (CLIP-IQA paper weights, needs piq) runs without position embeddings, i.e. at any resolution
+    """
+    def __init__(self, model_name_or_path="clip_iqa", image_size=224):
+        super().__init__()
+        from torchmetrics.functional.multimodal.clip_iqa import _get_clip_iqa_model_and_processor
+        self.model_name_or_path = model_name_or_path
+        self.name = f"iqa_{model_name_or_path.replace('/', '_')}"
+        self.image_size = image_size
+        self.model, self.processor = _get_clip_iqa_model_and_processor(model_name_or_path)
+
+    @property
+    def device(self):
+        return next(self.model.parameters()).device
+
+    def encode_images(self, images):
+        from torchmetrics.functional.multimodal.clip_iqa import _clip_iqa_update
+        return _clip_iqa_update(self.model_name_or_path, images.float(), self.model, self.processor, data_range=255., device=self.device)
+
+    def encode_texts(self, texts):
+        from torchmetrics.functional.multimodal.clip_iqa import _clip_iqa_get_anchor_vectors
+        return _clip_iqa_get_anchor_vectors(self.model_name_or_path, self.model, self.processor, list(texts), self.device)
+
+
+class TinyImageEncoder(nn.Module):
+    """small random conv encoder, stands in for inception / CLIP in the CPU test mode"""
+    def __init__(self, num_features=16, seed=0):
+        super().__init__()
+        generator = torch.Generator().manual_seed(seed)
+        self.name = f"tiny{num_features}_{seed}"
+        self.num_features = num_features
+        self.conv = nn.Conv2d(3, num_features, kernel_size=8, stride=8)
+        with torch.no_grad():
+            self.conv.weight.copy_(torch.randn(self.conv.weight.shape, generator=generator) * 0.05)
+            self.conv.bias.zero_()
+
+    def forward(self, images):
+        return self.conv(images.float() / 255).relu().mean(dim=(-2, -1))
+
+
+class TinyClipBackend(nn.Module):
+    """CLIP-like backend for the CPU test mode, texts are embedded as a bag of hashed bytes"""
+    def __init__(self, num_features=16, image_size=32, seed=0):
+        super().__init__()
+        self.name = f"tiny_clip{num_features}_{seed}"
+        self.image_size = image_size
+        self.image_encoder = TinyImageEncoder(num_features, seed)
+        generator = torch.Generator().manual_seed(seed + 1)
+        self.register_buffer("byte_embed", torch.randn(256, num_features, generator=generator))
+
+    def encode_images(self, images):
+        return F.normalize(self.image_encoder(images), dim=-1)
+
+    def encode_texts(self, texts):
+        ids = [torch.tensor(list(text.encode()) or [0]) for text in texts]
+        embeds = torch.stack([self.byte_embed[i.to(self.byte_embed.device)].mean(dim=0) for i in ids])
+        return F.normalize(embeds, dim=-1)
+
+
+class ImageMetricEngine:
+    """
+    Args:
+        fid_extractor: module mapping uint8 images (b, 3, h, w) to features (b, d), with a `num_features` attribute
+        clip_backend: module with `encode_images` / `encode_texts` returning normalized embeddings
+        iqa_backend: backend for CLIP-IQA, e.g. ClipIQABackend, None reuses `clip_backend` (and its image embeddings)
+        fid_image_size: input resolution of `fid_extractor`
+        cache_dir: folder of the feature caches, None disables caching
+    """
+    def __init__(self, fid_extractor, clip_backend, iqa_backend=None, fid_image_size=299,
+                 batch_size=64, num_workers=4, cache_dir=None, device="cpu"):
+        self.device = device
+        self.fid_extractor = fid_extractor.eval().to(device)
+        self.clip_backend = clip_backend.eval().to(device)
+        self.iqa_backend = iqa_backend.eval().to(device) if iqa_backend is not None else self.clip_backend
+        self.fid_image_size = fid_image_size
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.cache_dir = cache_dir
+        self.caches = {}
+        self.hashes = {}
+
+    @classmethod
+    def from_pretrained(cls, fid_feature=768, clip_model="openai/clip-vit-large-patch14", iqa_model="clip_iqa", **kwargs):
+        """
+        iqa_model: CLIP model of CLIP-IQA, "clip_iqa" is the torchmetrics CLIPImageQualityAssessment default,
+        None scores with the anchor prompts on `clip_model` instead (cheaper, but not comparable with the torchmetrics numbers)
+        """
+        fid_extractor = FrechetInceptionDistance(feature=fid_feature).inception
+        fid_extractor.name = f"inception{fid_feature}"
+        fid_extractor.num_features = fid_feature
+        iqa_backend = ClipIQABackend(iqa_model) if iqa_model is not None else None
+        return cls(fid_extractor, HFClipBackend(clip_model), iqa_backend=iqa_backend, **kwargs)
+
+    @classmethod
+    def for_testing(cls, num_features=16, **kwargs):
+        """CPU test mode, tiny random feature extractors instead of inception and CLIP"""
+        kwargs.setdefault("fid_image_size", 32)
+        return cls(TinyImageEncoder(num_features), TinyClipBackend(num_features), **kwargs)
+
+    def _hash_files(self, paths):
+        missing = [p for p in set(paths) if p not in self.hashes]
+        with futures.ThreadPoolExecutor(max(self.num_workers, 1)) as pool:
+            self.hashes.update(zip(missing, pool.map(file_hash, missing)))
+        return [self.hashes[p] for p in paths]
+
+    def _cache(self, name):
+        if name not in self.caches:
+            self.caches[name] = FeatureCache(self.cache_dir, name)
+        return self.caches[name]
+
+    @torch.no_grad()
+    def iter_features(self, paths, encode_fn, name, image_size):
+        """
+        yield (indices, features) batches for the images in `paths`, cached features first,
+        then the uncached images streamed through worker-side decoding in fixed-size batches
+        """
+        keys = self._hash_files(paths)
+        cache = self._cache(f"{name}_{image_size}")
+
+        cached = [i for i, k in enumerate(keys) if k in cache]
+        for start in range(0, len(cached), self.batch_size):
+            indices = cached[start: start + self.batch_size]
+            yield indices, cache.get([keys[i] for i in indices])
+
+        # identical files are only embedded once
+        first_index = {}
+        for i, k in enumerate(keys):
+            if k not in cache:
+                first_index.setdefault(k, i)
+        todo = list(first_index.values())
+        duplicates = [i for i, k in enumerate(keys) if k not in cache and first_index[k] != i]
+
+        if todo:
+            loader = DataLoader(
+                ImageFileDataset([paths[i] for i in todo], image_size),
+                batch_size=self.batch_size, num_workers=self.num_workers,
+                pin_memory=str(self.device).startswith("cuda"),
+            )
+            for batch_indices, images in tqdm(loader, desc=f"embedding {name}", leave=False):
+                indices = [todo[i] for i in batch_indices.tolist()]
+                features = encode_fn(images.to(self.device, non_blocking=True)).float().cpu()
+                cache.put([keys[i] for i in indices], features)
+                yield indices, features
+
+        for start in range(0, len(duplicates), self.batch_size):
+            indices = duplicates[start: start + self.batch_size]
+            yield indices, cache.get([keys[i] for i in indices])
+
+        cache.save()
+
+    def features(self, paths, encode_fn, name, image_size):
+        """all features of `paths` as a (n, d) tensor, in order"""
+        out = None
+        for indices, features in self.iter_features(paths, encode_fn, name, image_size):
+            if out is None:
+                out = torch.empty(len(paths), features.size(-1))
+            out[indices] = features
+        return out
+
+    def fid(self, pred_paths, golden_paths):
+        fid_metric = FrechetInceptionDistance(feature=PrecomputedFeatures(self.fid_extractor.num_features))
+        for paths, real in ((golden_paths, True), (pred_paths, False)):
+            for _, features in self.iter_features(paths, self.fid_extractor, self.fid_extractor.name, self.fid_image_size):
+                fid_metric.update(features, real=real)
+        return fid_metric.compute()
+
+    def clip_score(self, pred_paths, texts):
+        """mean over images of 100 * max(cos(image, text), 0), as averaged per image by torchmetrics CLIPScore"""
+        backend = self.clip_backend
+        total = 0.
+        for indices, image_features in self.iter_features(pred_paths, backend.encode_images, backend.name, backend.image_size):
+            with torch.no_grad():
+                text_features = backend.encode_texts([texts[i] for i in indices]).float().cpu()
+            total += (100 * (image_features * text_features).sum(dim=-1)).clamp(min=0).sum().item()
+        return total / len(pred_paths)
+
+    def clip_image_quality(self, pred_paths, prompts=("quality",)):
+        """
+        CLIP-IQA, probability of the positive prompt of each antonym pair, shape (n,) or (n, len(prompts)),
+        same scoring as torchmetrics CLIPImageQualityAssessment on the images resized to the backend image_size
+        """
+        backend = self.iqa_backend
+        pairs = [CLIP_IQA_PROMPTS[p] if isinstance(p, str) else tuple(p) for p in prompts]
+        with torch.no_grad():
+            anchors = backend.encode_texts([text for pair in pairs for text in pair]).float().cpu()
+        image_features = self.features(pred_paths, backend.encode_images, backend.name, backend.image_size)
+        logits = 100 * image_features @ anchors.t()
+        probs = logits.view(len(pred_paths), len(pairs), 2).softmax(dim=-1)[..., 0]
+        return probs.squeeze(-1) if len(pairs) == 1 else probs
+
+
+def run_test(num_images=24):
+    with tempfile.TemporaryDirectory() as tmp:
+        rng = np.random.default_rng(0)
+        paths = []
+        for i in range(num_images):
+            path = os.path.join(tmp, f"{i}.png")
+            Image.fromarray(rng.integers(0, 255, (48, 40, 3), dtype=np.uint8)).save(path)
+            paths.append(path)
+        pred, golden = paths[: num_images // 2], paths[num_images // 2:]
+        texts = [f"icon {i}" for i in range(len(pred))]
+
+        cache_dir = os.path.join(tmp, "cache")
+        engine = ImageMetricEngine.for_testing(batch_size=5, num_workers=2, cache_dir=cache_dir)
+        scores = engine.fid(pred, golden), engine.clip_score(pred, texts), engine.clip_image_quality(pred)
+
+        # unbatched reference
+        images = torch.stack([load_image(p, 32) for p in paths])
+        ref_fid = FrechetInceptionDistance(feature=engine.fid_extractor)
+        ref_fid.update(images[num_images // 2:], real=True)
+        ref_fid.update(images[: num_images // 2], real=False)
+        assert torch.allclose(scores[0], ref_fid.compute(), rtol=1e-4, atol=1e-4), (scores[0], ref_fid.compute())
+
+        # a new engine only reads the cache, even with the predictions shuffled and duplicated
+        engine = ImageMetricEngine.for_testing(batch_size=7, num_workers=0, cache_dir=cache_dir)
+        engine.fid_extractor.forward = None
+        rescored = engine.fid(pred[::-1] + pred[:2], golden)
+        assert np.isfinite(rescored.item())
+        assert abs(engine.clip_score(pred, texts) - scores[1]) < 1e-4
+        assert torch.allclose(engine.clip_image_quality(pred), scores[2], atol=1e-5)
+        print(f"fid {scores[0].item():.4f} | clip score {scores[1]:.4f} | clip-iqa {scores[2].mean().item():.4f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--test", action="store_true", help="CPU test mode with tiny feature extractors")
+    args = parser.parse_args()
+    if args.test:
+        run_test()
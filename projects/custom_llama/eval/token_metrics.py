@@ -0,0 +1,163 @@
+"""
+Batched token metrics (multiset recall / edit distance) for the generated SVG samples.
+
+Code sequences are padded into one tensor and the per-sample token counts are taken with a
+single bincount, the VQVAE encodes predictions and references in batches of equal length, and
+the Levenshtein distances over token id arrays are computed in worker processes.
+
+    pred_codes = batched_vqvae_encode(vqvae, [item['generated_svg_path'] for item in pred_res])
+    golden_codes = batched_vqvae_encode(vqvae, [item['raw_data'] for item in pred_res])
+    recalls = multiset_recall(pad_codes(pred_codes), pad_codes(golden_codes))
+    distances = batched_edit_distance(pred_ids, golden_ids, num_workers=16)
+
+`python eval/token_metrics.py --test` checks everything against the per-sample implementations.
+"""
+import argparse
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import torch
+
+PAD_ID = -1
+
+
+def pad_codes(seqs, pad_id=PAD_ID):
+    """list of 1d int sequences (lists / arrays / tensors) -> LongTensor batch x max_len, padded with `pad_id`"""
+    seqs = [torch.as_tensor(s, dtype=torch.long).flatten() for s in seqs]
+    return torch.nn.utils.rnn.pad_sequence(seqs, batch_first=True, padding_value=pad_id)
+
+
+def multiset_recall(pred, gold, pad_id=PAD_ID, vocab_size=None):
+    """
+    per-sample recall of the golden tokens, counting repeated tokens as in `calculate_recall`:
+    sum_t min(#t in pred, #t in gold) / len(gold)
+    pred / gold: padded LongTensors batch x len (see `pad_codes`), returns a float tensor of size batch
+    """
+    assert pred.size(0) == gold.size(0), "pred and gold must have the same batch size"
+    batch = pred.size(0)
+    if vocab_size is None:
+        vocab_size = int(max(pred.max().item(), gold.max().item(), 0)) + 1
+
+    def counts(x):
+        # pad tokens go to an extra bin that is dropped afterwards
+        ids = torch.where(x == pad_id, torch.full_like(x, vocab_size), x)
+        ids = ids + torch.arange(batch, device=x.device).unsqueeze(1) * (vocab_size + 1)
+        bins = torch.bincount(ids.flatten(), minlength=batch * (vocab_size + 1))
+        return bins.view(batch, vocab_size + 1)[:, :vocab_size]
+
+    true_positives = torch.minimum(counts(pred), counts(gold)).sum(dim=1)
+    total_relevant = (gold != pad_id).sum(dim=1)
+    return torch.where(total_relevant > 0, true_positives / total_relevant.clamp(min=1), torch.zeros_like(true_positives, dtype=torch.float))
+
+
+@torch.no_grad()
+def batched_vqvae_encode(vqvae, svg_tensors, batch_size=64, start_level=0, end_level=1, device=None):
+    """
+    encode every SVG tensor (num_paths x x_channels) with `vqvae.encode`, returns the code lists in order
+    samples are grouped by length, so no padding goes through the encoder and the codes are the
+    same as encoding each sample on its own
+    """
+    device = device if device is not None else next(vqvae.parameters()).device
+    buckets = defaultdict(list)
+    for i, x in enumerate(svg_tensors):
+        buckets[tuple(x.shape)].append(i)
+
+    codes = [None] * len(svg_tensors)
+    for idx in buckets.values():
+        for start in range(0, len(idx), batch_size):
+            chunk = idx[start: start + batch_size]
+            x = torch.stack([torch.as_tensor(svg_tensors[i]) for i in chunk]).to(device)
+            zs = vqvae.encode(x, start_level, end_level)[0].cpu()
+            for i, z in zip(chunk, zs):
+                codes[i] = z.tolist()
+    return codes
+
+
+def levenshtein(a, b):
+    """
+    edit distance (insert / delete / substitute, all cost 1) between two 1d token id arrays,
+    the same as `edit_distance.SequenceMatcher(a, b).distance()`
+    one numpy pass per token of `a`: the row is the min over deletions / substitutions of the
+    previous row, and the insertions along the row are a running minimum of (row - j) + j
+    """
+    a, b = np.asarray(a), np.asarray(b)
+    if len(a) == 0 or len(b) == 0:
+        return int(max(len(a), len(b)))
+    steps = np.arange(len(b) + 1)
+    row = steps.copy()
+    for i, token in enumerate(a, 1):
+        cur = np.empty_like(row)
+        cur[0] = i
+        np.minimum(row[1:] + 1, row[:-1] + (b != token), out=cur[1:])
+        row = np.minimum.accumulate(cur - steps) + steps
+    return int(row[-1])
+
+
+def _levenshtein_pair(pair):
+    return levenshtein(*pair)
+
+
+def batched_edit_distance(preds, golden, num_workers=8, chunksize=16):
+    """edit distance of each (pred, golden) pair of token id sequences, spread over `num_workers` processes"""
+    assert len(preds) == len(golden), "preds and golden must have the same length"
+    pairs = [(np.asarray(p, dtype=np.int64), np.asarray(g, dtype=np.int64)) for p, g in zip(preds, golden)]
+    if num_workers <= 1:
+        return [_levenshtein_pair(pair) for pair in pairs]
+    with ProcessPoolExecutor(num_workers) as pool:
+        return list(pool.map(_levenshtein_pair, pairs, chunksize=chunksize))
+
+
+def tokenize_ids(tokenizer, texts):
+    """token ids of each string in one batched tokenizer call, the ids of `tokenizer.tokenize(x)`"""
+    return tokenizer(list(texts), add_special_tokens=False)["input_ids"]
+
+
+def run_test(num_samples=64, vocab_size=50, seed=0):
+    rng = np.random.default_rng(seed)
+    preds = [rng.integers(0, vocab_size, rng.integers(0, 40)).tolist() for _ in range(num_samples)]
+    golden = [rng.integers(0, vocab_size, rng.integers(0, 40)).tolist() for _ in range(num_samples)]
+
+    # recall against the per-sample list.count version
+    def reference_recall(pred_list, gold_list):
+        common_tokens = set(pred_list) & set(gold_list)
+        true_positives = sum(min(pred_list.count(token), gold_list.count(token)) for token in common_tokens)
+        return true_positives / len(gold_list) if len(gold_list) > 0 else 0
+
+    recalls = multiset_recall(pad_codes(preds), pad_codes(golden))
+    assert np.allclose(recalls.numpy(), [reference_recall(p, g) for p, g in zip(preds, golden)])
+
+    # edit distance against the textbook dynamic programming
+    def reference_levenshtein(a, b):
+        dp = list(range(len(b) + 1))
+        for i in range(1, len(a) + 1):
+            prev, dp[0] = dp[0], i
+            for j in range(1, len(b) + 1):
+                prev, dp[j] = dp[j], min(dp[j] + 1, dp[j - 1] + 1, prev + (a[i - 1] != b[j - 1]))
+        return dp[-1]
+
+    distances = batched_edit_distance(preds, golden, num_workers=2)
+    assert distances == [reference_levenshtein(p, g) for p, g in zip(preds, golden)]
+
+    # batched encoding against one sample at a time, with a toy encoder
+    class ToyVQVAE(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.conv = torch.nn.Conv1d(9, 8, 4, stride=4)
+
+        def encode(self, x, start_level=0, end_level=None):
+            return [self.conv(x.permute(0, 2, 1).float()).argmax(dim=1)]
+
+    vqvae = ToyVQVAE()
+    svgs = [torch.randint(0, 200, (int(rng.choice([16, 32, 64])), 9)) for _ in range(num_samples)]
+    codes = batched_vqvae_encode(vqvae, svgs, batch_size=7)
+    assert codes == [vqvae.encode(x.unsqueeze(0), 0, 1)[0].tolist()[0] for x in svgs]
+    print(f"{num_samples} samples | mean recall {recalls.mean().item():.4f} | mean edit distance {np.mean(distances):.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--test", action="store_true", help="check against the per-sample implementations")
+    args = parser.parse_args()
+    if args.test:
+        run_test()
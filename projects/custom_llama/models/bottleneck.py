@@ -5,12 +5,52 @@ import torch.nn.functional as F
 import torch.distributed as dist
 
 
+def _dist_ready():
+    return dist.is_available() and dist.is_initialized()
+
+
+def broadcast(x, src=0):
+    # no-op on a single process (e.g. CPU inference), so the block runs without a process group
+    if _dist_ready():
+        dist.broadcast(x, src)
+
+
+def all_reduce(x):
+    if _dist_ready():
+        dist.all_reduce(x)
+
+
+def code_stats(x, x_l, k_bins):
+    """
+    per code sum of the assigned vectors (k_bins, w) and number of assigned vectors (k_bins,)
+    index_add_ / bincount over the code indices, instead of a dense (k_bins, N) one-hot matmul
+    """
+    _k_sum = t.zeros(k_bins, x.shape[-1], device=x.device, dtype=x.dtype).index_add_(0, x_l, x)
+    _k_elem = t.bincount(x_l, minlength=k_bins).to(x.dtype)
+    return _k_sum, _k_elem
+
+
+def dense_code_stats(x, x_l, k_bins):
+    # previous one-hot version, kept for the benchmark
+    x_l_onehot = t.zeros(k_bins, x.shape[0], device=x.device)
+    x_l_onehot.scatter_(0, x_l.view(1, x.shape[0]), 1)
+    return t.matmul(x_l_onehot, x), x_l_onehot.sum(dim=-1)
+
+
 class BottleneckBlock(nn.Module):
-    def __init__(self, k_bins, emb_width, mu):
+    """
+    chunk_size: rows of x compared against the codebook at once in `quantise`, bounds the distance matrix to chunk_size x k_bins
+    search_dtype: e.g. t.bfloat16 to find candidates with a low precision matmul, the best `recheck_k` are re-scored exactly
+    """
+    def __init__(self, k_bins, emb_width, mu, chunk_size=4096, search_dtype=None, recheck_k=8):
         super().__init__()
         self.k_bins = k_bins  # 9012 tokens
         self.emb_width = emb_width  # 4096
         self.mu = mu
+        self.chunk_size = chunk_size
+        self.search_dtype = search_dtype
+        self.recheck_k = recheck_k
+        self._k_norm_cache = None
         self.reset_k()
         self.threshold = 1.0
 
@@ -18,7 +58,7 @@ class BottleneckBlock(nn.Module):
         self.init = False
         self.k_sum = None
         self.k_elem = None
-        self.register_buffer('k', t.zeros(self.k_bins, self.emb_width).cuda())
+        self.register_buffer('k', t.zeros(self.k_bins, self.emb_width))  # moved with the module, e.g. .cuda()
 
     def _tile(self, x):
         d, ew = x.shape
@@ -34,8 +74,8 @@ class BottleneckBlock(nn.Module):
         self.init = True
         # init k_w using random vectors from x
         y = self._tile(x)
-        _k_rand = y[t.randperm(y.shape[0])][:k_bins]
-        dist.broadcast(_k_rand, 0)
+        _k_rand = y[t.randperm(y.shape[0], device=y.device)][:k_bins]
+        broadcast(_k_rand, 0)
         self.k = _k_rand
         assert self.k.shape == (k_bins, emb_width)
         self.k_sum = self.k
@@ -57,19 +97,14 @@ class BottleneckBlock(nn.Module):
         mu, emb_width, k_bins = self.mu, self.emb_width, self.k_bins # (0.99, 4096, 9012)
         with t.no_grad():
             # Calculate new centres
-            x_l_onehot = t.zeros(k_bins, x.shape[0], device=x.device)  # k_bins, N * L
-            # which codebook vector did we use for each feature (k_bins,num_enc_vectors)
-            x_l_onehot.scatter_(0, x_l.view(1, x.shape[0]), 1) # 9012, 4096
-            # k_bins, w: the sum of the encoder output, which are used with this codebook vector.
-            _k_sum = t.matmul(x_l_onehot, x) # 9012, 4096
-
-            _k_elem = x_l_onehot.sum(dim=-1)  # k_bins
+            # k_bins, w: the sum of the encoder output, which are used with this codebook vector, and how many were used
+            _k_sum, _k_elem = code_stats(x, x_l, k_bins)  # 9012, 4096 / 9012
             y = self._tile(x)
-            _k_rand = y[t.randperm(y.shape[0])][:k_bins]
+            _k_rand = y[t.randperm(y.shape[0], device=y.device)][:k_bins]
 
-            dist.broadcast(_k_rand, 0)
-            dist.all_reduce(_k_sum)
-            dist.all_reduce(_k_elem)
+            broadcast(_k_rand, 0)
+            all_reduce(_k_sum)
+            all_reduce(_k_elem)
 
             # Update centres
             old_k = self.k
@@ -116,11 +151,41 @@ class BottleneckBlock(nn.Module):
         x_l = x_l.view(N, T)
         return x_l, x_d
 
+    def k_norm(self):
+        # squared norms of the codes (1, k_bins), recomputed only when k is replaced or modified in place
+        key = (self.k.data_ptr(), self.k._version, self.k.shape, self.k.dtype)
+        if self._k_norm_cache is None or self._k_norm_cache[0] != key:
+            self._k_norm_cache = (key, t.sum(self.k.t() ** 2, dim=0, keepdim=True))
+        return self._k_norm_cache[1]
+
+    def _quantise_chunk(self, x, k_w, k_norm):
+        if self.search_dtype is None:
+            distance = t.sum(x ** 2, dim=-1, keepdim=True) - 2 * t.matmul(x, k_w) + k_norm  # (chunk, k_bins)
+            return t.min(distance, dim=-1)
+
+        # low precision search for candidates, then the exact distance of the candidates only
+        approx = k_norm - 2 * t.matmul(x.to(self.search_dtype), k_w.to(self.search_dtype)).float()
+        candidates = t.topk(approx, min(self.recheck_k, self.k_bins), dim=-1, largest=False).indices  # (chunk, r)
+        # the gathered candidate codes (rows, r, w) are kept under 1/8 of the exact (chunk, k_bins) distance matrix
+        rows = max(1, x.shape[0] * self.k_bins // (8 * candidates.shape[1] * self.emb_width))
+        distance = []
+        for x_sub, c_sub in zip(x.split(rows), candidates.split(rows)):
+            dot = t.bmm(self.k[c_sub], x_sub.unsqueeze(-1)).squeeze(-1)  # (rows, r)
+            distance.append(t.sum(x_sub ** 2, dim=-1, keepdim=True) - 2 * dot + k_norm[0, c_sub])
+        min_distance, best = t.min(t.cat(distance), dim=-1)
+        return min_distance, candidates.gather(-1, best.unsqueeze(-1)).squeeze(-1)
+
     def quantise(self, x):
-        # Calculate latent code x_l
+        # Calculate latent code x_l, `chunk_size` rows at a time
         k_w = self.k.t()  # 4096, 9012
-        distance = t.sum(x ** 2, dim=-1, keepdim=True) - 2 * t.matmul(x, k_w) + t.sum(k_w ** 2, dim=0, keepdim=True)  # (N * L, b) 4096 x 9012
-        min_distance, x_l = t.min(distance, dim=-1) 
+        k_norm = self.k_norm()
+        chunk_size = self.chunk_size if self.chunk_size is not None else x.shape[0]
+        min_distance, x_l = [], []
+        for chunk in x.split(chunk_size):
+            chunk_min_distance, chunk_x_l = self._quantise_chunk(chunk, k_w, k_norm)
+            min_distance.append(chunk_min_distance)
+            x_l.append(chunk_x_l)
+        min_distance, x_l = t.cat(min_distance), t.cat(x_l)
         fit = t.mean(min_distance)
         return x_l, fit
 
@@ -186,10 +251,10 @@ class BottleneckBlock(nn.Module):
 
 
 class Bottleneck(nn.Module):
-    def __init__(self, l_bins, emb_width, mu, levels):
+    def __init__(self, l_bins, emb_width, mu, levels, **block_kwargs):
         super().__init__()
         self.levels = levels
-        def level_block(level): return BottleneckBlock(l_bins, emb_width, mu)
+        def level_block(level): return BottleneckBlock(l_bins, emb_width, mu, **block_kwargs)
         self.level_blocks = nn.ModuleList()
         for level in range(self.levels):
             self.level_blocks.append(level_block(level))
@@ -249,8 +314,68 @@ class NoBottleneck(nn.Module):
         return zs
 
     def forward(self, xs):
-        zero = t.zeros(()).cuda()
+        zero = t.zeros((), device=xs[0].device)
         commit_losses = [zero for _ in range(self.levels)]
         metrics = [dict(entropy=zero, usage=zero, used_curr=zero,
                         pn=zero, dk=zero) for _ in range(self.levels)]
-        return xs, xs, commit_losses, metrics
\ No newline at end of file
+        return xs, xs, commit_losses, metrics
+
+
+def benchmark_code_stats(k_bins_list=(1024, 8192, 65536), num_vectors=4096, emb_width=512, repeats=5, device="cpu"):
+    """step time and peak memory of the one-hot vs index_add_ codebook statistics (on CPU the memory is an estimate)"""
+    import time
+    x = t.randn(num_vectors, emb_width, device=device)
+    for k_bins in k_bins_list:
+        x_l = t.randint(0, k_bins, (num_vectors,), device=device)
+        results = {}
+        for name, fn in (("dense", dense_code_stats), ("sparse", code_stats)):
+            if device.startswith("cuda"):
+                t.cuda.synchronize()
+                t.cuda.reset_peak_memory_stats()
+                base = t.cuda.memory_allocated()
+            fn(x, x_l, k_bins)  # warmup
+            start = time.perf_counter()
+            for _ in range(repeats):
+                out = fn(x, x_l, k_bins)
+            if device.startswith("cuda"):
+                t.cuda.synchronize()
+                peak = (t.cuda.max_memory_allocated() - base) / 2 ** 20
+            else:
+                # not measured: outputs plus the one-hot matrix for dense, nothing beyond the outputs for sparse
+                peak = (k_bins * emb_width + k_bins + (k_bins * num_vectors if name == "dense" else 0)) * 4 / 2 ** 20
+            results[name] = ((time.perf_counter() - start) / repeats * 1000, peak, out)
+        assert t.allclose(results["dense"][2][0], results["sparse"][2][0], atol=1e-4)
+        assert t.equal(results["dense"][2][1], results["sparse"][2][1])
+        memory = "peak" if device.startswith("cuda") else "estimated"
+        print(f"k_bins {k_bins:6d} | " + " | ".join(f"{name} {ms:8.2f} ms {mb:9.1f} MB {memory}" for name, (ms, mb, _) in results.items()))
+
+
+def benchmark_quantise(k_bins=65536, num_vectors=16384, emb_width=512, chunk_sizes=(None, 4096, 1024), device="cpu"):
+    """step time and largest distance matrix of the nearest code search for a few chunk sizes"""
+    import time
+    block = BottleneckBlock(k_bins, emb_width, 0.99).to(device)
+    block.k = t.randn(k_bins, emb_width, device=device)
+    x = t.randn(num_vectors, emb_width, device=device)
+    reference = None
+    for chunk_size in chunk_sizes:
+        block.chunk_size = chunk_size
+        block.quantise(x[:8])  # warmup, fills the norm cache
+        start = time.perf_counter()
+        x_l, _ = block.quantise(x)
+        if device.startswith("cuda"):
+            t.cuda.synchronize()
+        reference = x_l if reference is None else reference
+        assert t.equal(x_l, reference)
+        rows = chunk_size if chunk_size is not None else num_vectors
+        print(f"chunk_size {str(chunk_size):>5} | {(time.perf_counter() - start) * 1000:8.1f} ms | distance matrix {min(rows, num_vectors) * k_bins * 4 / 2 ** 20:8.1f} MB")
+
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_vectors", type=int, default=4096)
+    parser.add_argument("--emb_width", type=int, default=512)
+    parser.add_argument("--device", type=str, default="cuda" if t.cuda.is_available() else "cpu")
+    args = parser.parse_args()
+    benchmark_code_stats(num_vectors=args.num_vectors, emb_width=args.emb_width, device=args.device)
+    benchmark_quantise(num_vectors=args.num_vectors, emb_width=args.emb_width, device=args.device)
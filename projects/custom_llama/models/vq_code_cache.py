@@ -0,0 +1,137 @@
+"""
+On-disk cache of the (frozen) VQVAE codes for online VQSVGLlama training
+
+    cache_dir/codes-<vqvae checkpoint hash>-<dataset id>-<num_samples>/
+        codes.npy       int32 num_samples x code_len, row = sample id
+        keys.npy        int64 num_samples, content hash of the svg tensor the row was encoded from (0 = empty)
+
+A row is only used when the content hash of the incoming svg tensor matches, so reordered or
+edited data is re-encoded instead of silently reusing stale codes. The cache is filled during
+the first epoch (`VQCodeCache.encode`) or by an offline pass (`fill_code_cache`).
+"""
+import os
+import shutil
+import hashlib
+import numpy as np
+import torch
+from tqdm import tqdm
+
+CODES_NAME = "codes.npy"
+KEYS_NAME = "keys.npy"
+
+
+@torch.no_grad()
+def vqvae_checkpoint_hash(vqvae):
+    """hash of all the parameters and buffers, a new checkpoint gets a new cache"""
+    hasher = hashlib.sha256()
+    for name, tensor in sorted(vqvae.state_dict().items()):
+        hasher.update(name.encode())
+        hasher.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return hasher.hexdigest()[:16]
+
+
+def svg_content_hash(svg_tensor):
+    """non-zero int64 fingerprint of an svg tensor"""
+    data = svg_tensor.detach().cpu().contiguous().numpy().tobytes()
+    value = int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), "little", signed=True)
+    return value if value != 0 else 1
+
+
+class VQCodeCache:
+    def __init__(self, cache_dir, checkpoint_hash, num_samples, dataset_id=None):
+        """dataset_id: name of the data the sample ids refer to (e.g. the data path), caches of other data are never opened"""
+        dataset_key = hashlib.sha1(str(dataset_id).encode()).hexdigest()[:8]
+        self.cache_dir = os.path.join(cache_dir, f"codes-{checkpoint_hash}-{dataset_key}-{num_samples}")
+        self.num_samples = num_samples
+        self.codes = None
+        self.keys = None
+        self.hits, self.misses = 0, 0
+
+    @classmethod
+    def from_vqvae(cls, cache_dir, vqvae, num_samples, dataset_id=None):
+        return cls(cache_dir, vqvae_checkpoint_hash(vqvae), num_samples, dataset_id=dataset_id)
+
+    def _create(self, code_len):
+        """
+        the files are written into a private folder which is then renamed to cache_dir, the rename fails if
+        another rank was faster, the files of the winner are then used, nobody keeps a memmap of a replaced file
+        """
+        tmp_dir = f"{self.cache_dir}.{os.getpid()}.tmp"
+        os.makedirs(tmp_dir, exist_ok=True)
+        np.lib.format.open_memmap(os.path.join(tmp_dir, CODES_NAME), mode="w+", dtype=np.int32, shape=(self.num_samples, code_len)).flush()
+        np.lib.format.open_memmap(os.path.join(tmp_dir, KEYS_NAME), mode="w+", dtype=np.int64, shape=(self.num_samples,)).flush()
+        try:
+            os.rename(tmp_dir, self.cache_dir)
+        except OSError:  # lost the race, cache_dir already holds the files
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+    def _open(self, code_len=None):
+        # opened lazily in every process, the code length is taken from the first encoded batch
+        codes_path, keys_path = os.path.join(self.cache_dir, CODES_NAME), os.path.join(self.cache_dir, KEYS_NAME)
+        if os.path.exists(keys_path) and os.path.exists(codes_path):
+            codes = np.load(codes_path, mmap_mode="r+")
+            keys = np.load(keys_path, mmap_mode="r+")
+            if codes.shape[0] != self.num_samples or keys.shape != (self.num_samples,):
+                raise ValueError(f"{self.cache_dir} holds {codes.shape[0]} rows, {self.num_samples} expected, remove it or use another cache_dir")
+            self.codes, self.keys = codes, keys
+        elif code_len is not None:
+            os.makedirs(os.path.dirname(self.cache_dir), exist_ok=True)
+            self._create(code_len)
+            return self._open(code_len)
+        return self.codes is not None
+
+    def lookup(self, sample_ids, content_hashes):
+        """cached codes (B x code_len, None if nothing cached yet) and hit mask (B,)"""
+        sample_ids, content_hashes = np.asarray(sample_ids), np.asarray(content_hashes)
+        if self.codes is None and not self._open():
+            return None, np.zeros(len(sample_ids), dtype=bool)
+        hit = self.keys[sample_ids] == content_hashes
+        return torch.from_numpy(np.asarray(self.codes[sample_ids])), hit
+
+    def store(self, sample_ids, content_hashes, codes):
+        if self.codes is None:
+            self._open(code_len=codes.shape[1])
+        if self.codes.shape[1] != codes.shape[1]:  # another rank created the cache with other padded lengths
+            return
+        sample_ids = np.asarray(sample_ids)
+        self.codes[sample_ids] = codes.cpu().numpy().astype(np.int32)
+        self.keys[sample_ids] = np.asarray(content_hashes)  # written after the codes, marks the rows as valid
+
+    @torch.no_grad()
+    def encode(self, vqvae, svg_tensors, sample_ids, content_hashes, start_level=0, end_level=1):
+        """
+        codes of the first compress level of `svg_tensors` (B x L x 9), the VQVAE only runs on the samples not cached yet
+        sample_ids / content_hashes: LongTensor (B,) from the dataset
+        """
+        code_len = svg_tensors.shape[1] // int(vqvae.hop_lengths[start_level])
+        if self.codes is None:
+            self._open()
+        if self.codes is not None and self.codes.shape[1] != code_len:
+            # padded to another length than the cached rows (e.g. cluster_batch), the cache does not apply
+            return vqvae.encode_no_grad(svg_tensors, start_level=start_level, end_level=end_level)[0]
+
+        sample_ids, content_hashes = sample_ids.cpu().numpy(), content_hashes.cpu().numpy()
+        cached, hit = self.lookup(sample_ids, content_hashes)
+        self.hits += int(hit.sum())
+        self.misses += int((~hit).sum())
+        if hit.all():
+            return cached.long().to(svg_tensors.device)
+
+        miss = np.flatnonzero(~hit)
+        new_codes = vqvae.encode_no_grad(svg_tensors[torch.from_numpy(miss).to(svg_tensors.device)], start_level=start_level, end_level=end_level)[0]
+        self.store(sample_ids[miss], content_hashes[miss], new_codes)
+        if cached is None:
+            return new_codes
+
+        codes = cached.long().to(svg_tensors.device)
+        codes[torch.from_numpy(miss).to(codes.device)] = new_codes.long()
+        return codes
+
+
+@torch.no_grad()
+def fill_code_cache(vqvae, cache, dataset, collate_fn, batch_size=64, num_workers=8, device="cuda"):
+    """offline pass over `dataset` (which returns svg_ids / svg_hashes), so the first epoch does not run the VQVAE either"""
+    dataloader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, num_workers=num_workers, collate_fn=collate_fn, shuffle=False)
+    for batch in tqdm(dataloader, desc="caching vqvae codes"):
+        cache.encode(vqvae, batch["svg_tensors"].to(device), batch["svg_ids"], batch["svg_hashes"])
+    print(f"vqvae code cache {cache.cache_dir}: {cache.hits} cached, {cache.misses} encoded")
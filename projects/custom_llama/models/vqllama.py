@@ -10,12 +10,14 @@ from transformers import LlamaForCausalLM
 from transformers.modeling_outputs import CausalLMOutputWithPast
 from transformers.generation import GenerationMixin
 from modelzipper.tutils import *
+from models.utils import chunked_cross_entropy
 
 
 class VQSVGLlama(LlamaForCausalLM):  
-    def __init__(self, config, vq_loss_weight=2.0, convert_token_weight=1.5, tokenizer=None, svg_begin_token_id=None, vqvae=None, codebook_size=8192):  
+    def __init__(self, config, vq_loss_weight=2.0, convert_token_weight=1.5, tokenizer=None, svg_begin_token_id=None, vqvae=None, codebook_size=8192, ce_chunk_size=1024):  
         super(VQSVGLlama, self).__init__(config)
         self.config = config
+        self.ce_chunk_size = ce_chunk_size  # positions per chunk of the head + CE, full logits are never materialized
         self.tokenizer = tokenizer
         self.svg_begin_token_id = svg_begin_token_id
         self.vq_loss_weight = vq_loss_weight
@@ -23,6 +25,7 @@ class VQSVGLlama(LlamaForCausalLM):
         self.codebook_size = codebook_size + 1  # add one for svg end token
         self.svg_end_token_id = codebook_size
         self.vqvae = vqvae
+        self.vq_code_cache = None
         self.up_adapter = nn.Linear(config.hidden_size, config.hidden_size)
         self.down_adapter = nn.Linear(config.hidden_size, config.hidden_size)
         self.vqvae_embedding = nn.Embedding(self.codebook_size, config.hidden_size)
@@ -35,8 +38,13 @@ class VQSVGLlama(LlamaForCausalLM):
             self.lm_head.requires_grad_ = False
             self.base_model.embed_tokens.requires_grad_ = True 
     
-    def init_vqvae(self, vqvae):
+    def init_vqvae(self, vqvae, code_cache=None):
+        """
+        code_cache: optional VQCodeCache (models/vq_code_cache.py), the codes of every sample are then
+        encoded once and read from disk afterwards, so training steps do not run the VQVAE
+        """
         self.vqvae = vqvae
+        self.vq_code_cache = code_cache
         self.vqvae.model.eval()
         for param in self.vqvae.model.parameters():
             param.requires_grad = False
@@ -50,13 +58,14 @@ class VQSVGLlama(LlamaForCausalLM):
     def load_state_dict(self, state_dict: Mapping[str, Any], strict: bool = True):
         return super().load_state_dict(state_dict, strict)
         
-    def forward(self, text_input_ids=None, text_attention_mask=None, text_labels=None, svg_tensors=None, svg_padding_mask=None, **kwargs): 
+    def forward(self, text_input_ids=None, text_attention_mask=None, text_labels=None, svg_tensors=None, svg_padding_mask=None, svg_ids=None, svg_hashes=None, **kwargs): 
         """
             text_input_ids: B x L 
             text_attention_mask: B x L,
             text_labels: B x L,
             svg_tensors: B x L (x l_bins),  depend on offline or online mode
             svg_padding_mask: B x L,
+            svg_ids / svg_hashes: B, sample ids and content hashes for the vqvae code cache (online mode)
         """
         if self.config.frozen_llm:  # only calculate svg loss when freezen LLM
             self.base_model.requires_grad_ = False 
@@ -75,19 +84,21 @@ class VQSVGLlama(LlamaForCausalLM):
             if self.vqvae.model.training: # deepspeed will make vqvae training again
                 self.vqvae.model.eval()
                 freeze_model(self.vqvae.model)
-            svg_token_ids = self.vqvae.model.encode_no_grad(svg_tensors, start_level=0, end_level=1)
-            svg_token_ids = svg_token_ids[0]  # first compress level
+            if self.vq_code_cache is not None and svg_ids is not None:
+                svg_token_ids = self.vq_code_cache.encode(self.vqvae.model, svg_tensors, svg_ids, svg_hashes, start_level=0, end_level=1)
+            else:
+                svg_token_ids = self.vqvae.model.encode_no_grad(svg_tensors, start_level=0, end_level=1)
+                svg_token_ids = svg_token_ids[0]  # first compress level
         else:  # offline mode
             svg_token_ids = svg_tensors
         
         compress_svg_max_length = svg_token_ids.size(1)
-        # add svg end token id
+        # add svg end token id, right after the last real token of every sample
         real_svg_lengths = svg_padding_mask.sum(dim=1)
-
-        for i in range(bsz):
-            cur_padding_pos = min(real_svg_lengths[i], compress_svg_max_length - 1)
-            svg_token_ids[i, cur_padding_pos] = self.svg_end_token_id
-            svg_padding_mask[i, cur_padding_pos] = True
+        batch_idx = torch.arange(bsz, device=svg_token_ids.device)
+        cur_padding_pos = real_svg_lengths.clamp(max=compress_svg_max_length - 1).to(svg_token_ids.device)
+        svg_token_ids[batch_idx, cur_padding_pos] = self.svg_end_token_id
+        svg_padding_mask[batch_idx, cur_padding_pos] = True
 
         golden_svg_tokens = torch.where(svg_padding_mask, svg_token_ids, -100).to(svg_token_ids.device).long()
         svg_token_embeddings = self.vqvae_embedding(svg_token_ids) # Encode svg tokens
@@ -104,47 +115,29 @@ class VQSVGLlama(LlamaForCausalLM):
         )
         hidden_states = outputs[0]
 
-        # text modality, last token is svg special token
-        text_logits = self.lm_head(hidden_states[:, :text_width, :]).float()
-        
         # svg modality, first token is svg special token, last token should be svg end token
         svg_output_hidden_states = self.down_adapter(hidden_states[:, text_width:, :])
-        svg_pred = self.vqvae_head(svg_output_hidden_states).float() 
         
         total_loss, text_loss, svg_loss, convert_token_loss = None, None, None, None
 
         if text_labels is not None and not self.config.frozen_llm:  # only calculate svg loss when freezen LLM
-            # Shift so that tokens < n predict n
-            shift_logits = text_logits[..., :-1, :].contiguous()  # last logits is convert_token logits
-            shift_labels = text_labels[..., 1:].contiguous() # last token is convert_token
-            # Flatten the tokens
-            shift_logits = shift_logits.view(-1, self.config.vocab_size)
-            shift_labels = shift_labels.view(-1)
-            # Enable model parallelism
-            shift_labels = shift_labels.to(shift_logits.device)
-            text_loss = F.cross_entropy(shift_logits, shift_labels)
+            # Shift so that tokens < n predict n, text modality, last token is svg special token
+            text_labels = text_labels.to(hidden_states.device)
+            text_loss = chunked_cross_entropy(hidden_states[:, :text_width - 1, :], self.lm_head, text_labels[:, 1:], chunk_size=self.ce_chunk_size)
 
         if golden_svg_tokens is not None:
             # Shift so that tokens < n predict n
-            shift_svg_logits = svg_pred[:, :-1, :].contiguous()
-            shift_golden_svg_tokens = golden_svg_tokens[:, 1:].contiguous()
-            shift_svg_logits = shift_svg_logits.view(-1, self.codebook_size)
-            shift_golden_svg_tokens = shift_golden_svg_tokens.view(-1)
-            svg_loss = F.cross_entropy(shift_svg_logits, shift_golden_svg_tokens)
+            svg_loss = chunked_cross_entropy(svg_output_hidden_states[:, :-1, :], self.vqvae_head, golden_svg_tokens[:, 1:], chunk_size=self.ce_chunk_size)
 
         if text_labels is not None and golden_svg_tokens is not None:  # convert token loss is be significant as vocabularies are different
-            import pdb; pdb.set_trace()
-            bsz, _, dim_ = svg_pred.size()
-            # obtain the last text token logits
-            real_text_lengths = text_attention_mask.sum(dim=1)  
-            first_svg_token_logits = torch.zeros(bsz, 1, dim_).to(text_logits.device)
-            
-            for i in range(bsz):  # convert the last text token (<svg>) to the first svg token
-                first_svg_token_logits[i] = self.vqvae_head(hidden_states[i, real_text_lengths[i] - 1][None, ])
+            # convert the last text token (<svg>) to the first svg token
+            real_text_lengths = text_attention_mask.sum(dim=1)
+            last_text_hidden_states = hidden_states[torch.arange(bsz, device=hidden_states.device), real_text_lengths - 1]
+            first_svg_token_logits = self.vqvae_head(last_text_hidden_states).float()
 
             # calculate CE Loss for last text token -> first svg token
             convert_token_loss = F.cross_entropy(
-                first_svg_token_logits.contiguous().view(-1, self.codebook_size), 
+                first_svg_token_logits, 
                 golden_svg_tokens[:, 0].contiguous().view(-1), 
                 reduction="mean",
             )
@@ -5,6 +5,8 @@ from dataclasses import dataclass, field
 from transformers import Trainer
 from modelzipper.tutils import *
 from models.vqllama import VQSVGLlama
+from models.vqvae import VQVAE
+from models.vq_code_cache import VQCodeCache, fill_code_cache
 from data.vqllama_dataset import VQDataCollator, VQLLaMAData
 
 IGNORE_INDEX = -100
@@ -17,6 +19,8 @@ DEFAULT_SVG_BEGIN_TOKEN = "<SVG>"
 @dataclass
 class VQVAEConfig:
     config_path: str = field(default=None)
+    vq_code_cache_dir: str = field(default=None, metadata={"help": "Cache dir of the vqvae codes in online mode (see models/vq_code_cache.py), None runs the vqvae every step."})
+    fill_code_cache: bool = field(default=False, metadata={"help": "Encode the whole dataset into vq_code_cache_dir before training."})
     
 @dataclass
 class ModelArguments:
@@ -27,6 +31,7 @@ class DataArguments:
     data_path: str = field(default=None, metadata={"help": "Path to the training data."})
     vq_svg_pad_file: str = field(default=None, metadata={"help": "Path to the vq svg pad file."})
     add_eval: bool = field(default=True, metadata={"help": "Whether to add eval dataset."})
+    offline_mode: bool = field(default=True, metadata={"help": "data_path holds vq codes, otherwise svg tensors encoded by the frozen vqvae."})
 
 
 @dataclass
@@ -148,15 +153,15 @@ def train():
         data_args.data_path, 
         svg_begin_token=DEFAULT_SVG_BEGIN_TOKEN, 
         tokenizer=llama_tokenizer, 
-        offline_mode=True,
+        offline_mode=data_args.offline_mode,
         task="generation",
         add_eval=data_args.add_eval,
     )
 
     data_collator = VQDataCollator(
         max_svg_length=llamaconfig.max_path_nums,
-        offline_mode=True,
-        return_all_token_mask=True, # for offline setting
+        offline_mode=data_args.offline_mode,
+        return_all_token_mask=data_args.offline_mode, # for offline setting
     )
     
     data_module = dict(
@@ -188,6 +193,39 @@ def train():
     svgllama.add_svg_begin_token_id(svg_begin_token_id)
     svgllama.set_tokenizer(llama_tokenizer)
 
+    if not data_args.offline_mode:
+        # init VQVAE
+        block_kwargs = dict(
+            width=vqvae_config.vqvae_conv_block.width, 
+            depth=vqvae_config.vqvae_conv_block.depth, 
+            m_conv=vqvae_config.vqvae_conv_block.m_conv,
+            dilation_growth_rate=vqvae_config.vqvae_conv_block.dilation_growth_rate,
+            dilation_cycle=vqvae_config.vqvae_conv_block.dilation_cycle,
+            reverse_decoder_dilation=vqvae_config.vqvae_conv_block.vqvae_reverse_decoder_dilation
+        )
+        vqvae = VQVAE(vqvae_config, multipliers=None, **block_kwargs)
+        plugin_vqvae = PluginVQVAE(vqvae)
+        checkpoint = torch.load(vqvae_config.ckpt_path, map_location="cpu")  # load vqvae ckpt
+        plugin_vqvae.load_state_dict(checkpoint['state_dict'])
+        print_c("VQVAE loaded!", "green")
+
+        code_cache = None
+        if vqvae_args.vq_code_cache_dir is not None:
+            code_cache = VQCodeCache.from_vqvae(vqvae_args.vq_code_cache_dir, vqvae, svg_data_module.num_samples, dataset_id=os.path.abspath(data_args.data_path))
+            if vqvae_args.fill_code_cache:
+                # the main process fills the (shared) cache, the other ranks wait and then only read it
+                with training_args.main_process_first(local=False, desc="caching vqvae codes"):
+                    if training_args.process_index == 0:
+                        vqvae.eval().to(training_args.device)
+                        for dataset in (data_module["train_dataset"], data_module["eval_dataset"]):
+                            fill_code_cache(
+                                vqvae, code_cache, dataset, data_collator, 
+                                batch_size=training_args.per_device_eval_batch_size, 
+                                num_workers=training_args.dataloader_num_workers, 
+                                device=training_args.device,
+                            )
+        svgllama.init_vqvae(plugin_vqvae, code_cache=code_cache)
+
     svgllama.is_parallelizable = True
     svgllama.model_parallel = True
 
@@ -0,0 +1,239 @@
+"""
+Parallel SVG -> PNG rasterization for the generated samples.
+
+SVG tensors (as taken by `visualize_svg.convert_svg`) or SVG strings are rendered with cairosvg
+in worker processes. At most `max_pending` renders are queued at once, so producers (generation
+loops) block instead of piling up work, and identical SVG strings are only rendered once.
+
+    with SVGRenderPool(num_workers=16) as pool:
+        for i, t in enumerate(predictions):
+            pool.submit(t, save_path=f"{i}.png", colored=True, background=True)
+    # all files are written when leaving the with block, a RuntimeError is raised if any render failed
+
+`python utils/render_pool.py --num_svgs 512` measures the throughput against serial rendering.
+"""
+import os
+import io
+import sys
+import time
+import hashlib
+import argparse
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future, ProcessPoolExecutor
+
+import cairosvg
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), "../..")))
+
+
+def tensor_to_svg_str(t, colored=False):
+    """same drawing as `convert_svg(t, colored=True, save_path=...)`, i.e. `SVG.draw_colored`, as a string"""
+    from change_deepsvg.svglib.svg import SVG
+    from change_deepsvg.svglib.geom import Bbox
+    from change_deepsvg.difflib.tensor import SVGTensor
+
+    svg = SVG.from_tensor(SVGTensor.from_data(t).data, viewbox=Bbox(200))
+    if colored:
+        svg = svg.copy().normalize().split_paths().set_color("random")
+    return svg.to_str()
+
+
+def composite_background(png):
+    """paste the rendered image on a black RGB canvas, same as `visualize_svg.add_background`"""
+    image = Image.open(io.BytesIO(png))
+    background = Image.new("RGB", image.size)
+    background.paste(image, (0, 0))
+    out = io.BytesIO()
+    background.save(out, format="PNG")
+    return out.getvalue()
+
+
+def render_svg(svg, colored=False, background=False, output_width=None):
+    """render a tensor or SVG string to PNG bytes, runs in the worker processes"""
+    if isinstance(svg, (torch.Tensor, np.ndarray)):
+        svg = tensor_to_svg_str(torch.as_tensor(svg), colored)
+    png = cairosvg.svg2png(bytestring=svg.encode(), output_width=output_width)
+    if background:
+        png = composite_background(png)
+    return png
+
+
+def content_hash(svg, colored, background, output_width):
+    if isinstance(svg, (torch.Tensor, np.ndarray)):
+        t = torch.as_tensor(svg).detach().cpu().contiguous()
+        data = str(t.dtype).encode() + str(tuple(t.shape)).encode() + t.numpy().tobytes()
+    else:
+        data = svg.encode()
+    options = f"{colored}|{background}|{output_width}".encode()
+    return hashlib.sha1(options + b"|" + data).hexdigest()
+
+
+class SVGRenderPool:
+    """
+    Args:
+        num_workers: number of rendering processes
+        max_pending: maximum number of queued renders, `submit` blocks when reached
+        cache_size: number of rendered PNGs kept in memory, by content hash of the input and options
+    """
+    def __init__(self, num_workers=8, max_pending=64, cache_size=4096):
+        self.executor = ProcessPoolExecutor(num_workers)
+        self.slots = threading.BoundedSemaphore(max_pending)
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # hash -> png bytes
+        self.inflight = {}  # hash -> future, identical renders submitted before the first one finished
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.failures = []  # (save_path, exception) of the failed renders, reported by `wait`
+        self.cache_hits = 0
+
+    def _remember(self, key, future):
+        with self.lock:
+            self.inflight.pop(key, None)
+            if future.exception() is None:
+                self.cache[key] = future.result()
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+        self.slots.release()
+
+    def _render(self, svg, colored, background, output_width):
+        key = content_hash(svg, colored, background, output_width)
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.cache_hits += 1
+                done = Future()
+                done.set_result(self.cache[key])
+                return done
+            if key in self.inflight:
+                self.cache_hits += 1
+                return self.inflight[key]
+
+        self.slots.acquire()  # bounded queue, blocks the producer
+        if isinstance(svg, torch.Tensor):
+            svg = svg.detach().cpu()
+        try:
+            future = self.executor.submit(render_svg, svg, colored, background, output_width)
+        except BaseException:  # e.g. after shutdown, the slot is never released by `_remember`
+            self.slots.release()
+            raise
+        future.add_done_callback(lambda f: self._remember(key, f))
+        with self.lock:
+            if not future.done():  # otherwise `_remember` already ran
+                self.inflight[key] = future
+        return future
+
+    def submit(self, svg, save_path=None, colored=False, background=False, output_width=None):
+        """
+        queue one render, returns a future of the PNG bytes, which resolves once `save_path` is written
+        svg: SVG tensor (num_commands x 7 / 9) or SVG string
+        colored: random colors per path, as `SVG.draw_colored` (tensors only)
+        background: composite on a black background, as `add_background`
+        """
+        render = self._render(svg, colored, background, output_width)
+        out = Future()
+
+        def finish(f):
+            try:
+                png = f.result()
+                if save_path is not None:
+                    with open(save_path, "wb") as fo:
+                        fo.write(png)
+                out.set_result(png)
+            except Exception as exc:
+                with self.lock:
+                    self.failures.append((save_path, exc))
+                out.set_exception(exc)
+            finally:
+                with self.lock:
+                    self.pending.discard(out)
+
+        with self.lock:
+            self.pending.add(out)
+        render.add_done_callback(finish)
+        return out
+
+    def map(self, svgs, save_paths=None, **kwargs):
+        """render all `svgs`, returns the PNG bytes in order"""
+        save_paths = save_paths if save_paths is not None else [None] * len(svgs)
+        futures = [self.submit(svg, save_path, **kwargs) for svg, save_path in zip(svgs, save_paths)]
+        return [f.result() for f in futures]
+
+    def wait(self, raise_errors=True):
+        """
+        block until every submitted render is written or failed, the failures since the last call
+        raise a RuntimeError (or are only printed with raise_errors=False), returns their number
+        """
+        while True:
+            with self.lock:
+                pending = list(self.pending)
+            if not pending:
+                break
+            for f in pending:
+                f.exception()
+
+        with self.lock:
+            failures, self.failures = self.failures, []
+        if failures:
+            save_path, exc = failures[0]
+            message = f"{len(failures)} svg renders failed, first one ({save_path}): {exc!r}"
+            if raise_errors:
+                raise RuntimeError(message) from exc
+            print(message)
+        return len(failures)
+
+    def close(self, raise_errors=True):
+        try:
+            self.wait(raise_errors)
+        finally:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(raise_errors=exc_type is None)  # do not hide the exception leaving the with block
+
+
+def random_svg_str(rng, num_paths=8, num_segments=6):
+    paths = []
+    for _ in range(num_paths):
+        points = rng.uniform(0, 200, (num_segments, 6)).round(1)
+        start = rng.uniform(0, 200, 2).round(1)
+        d = f"M{start[0]} {start[1]} " + " ".join("C" + " ".join(map(str, p)) for p in points) + " Z"
+        color = "#%06x" % rng.integers(0, 1 << 24)
+        paths.append(f'<path fill="{color}" stroke="black" d="{d}"/>')
+    return f'<svg xmlns="http://www.w3.org/2000/svg" width="200" height="200" viewBox="0 0 200 200">{"".join(paths)}</svg>'
+
+
+def benchmark(num_svgs=512, num_workers=8, duplicate_ratio=0.25, output_width=512, background=True):
+    rng = np.random.default_rng(0)
+    unique = [random_svg_str(rng) for _ in range(int(num_svgs * (1 - duplicate_ratio)))]
+    svgs = unique + [unique[i] for i in rng.integers(0, len(unique), num_svgs - len(unique))]
+
+    start = time.perf_counter()
+    serial = [render_svg(s, background=background, output_width=output_width) for s in svgs]
+    serial_time = time.perf_counter() - start
+
+    with SVGRenderPool(num_workers=num_workers) as pool:
+        start = time.perf_counter()
+        pooled = pool.map(svgs, background=background, output_width=output_width)
+        pool_time = time.perf_counter() - start
+        hits = pool.cache_hits
+
+    assert serial == pooled
+    print(f"{num_svgs} svgs ({len(unique)} unique) | serial {num_svgs / serial_time:.1f} svg/s | "
+          f"pool ({num_workers} workers) {num_svgs / pool_time:.1f} svg/s | {hits} cache hits")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_svgs", type=int, default=512)
+    parser.add_argument("--num_workers", type=int, default=8)
+    parser.add_argument("--duplicate_ratio", type=float, default=0.25)
+    parser.add_argument("--output_width", type=int, default=512)
+    args = parser.parse_args()
+    benchmark(args.num_svgs, args.num_workers, args.duplicate_ratio, args.output_width)
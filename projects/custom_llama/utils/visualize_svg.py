@@ -132,6 +132,8 @@ def main(cl: int = 0, rd: str = None):
         num_svgs = len(results[keys[0]])
         # num_svgs = 2000
         str_paths = []
+        from render_pool import SVGRenderPool  # script mode, utils/ is on the path
+        render_pool = SVGRenderPool(num_workers=16)
         # special_lst = [815, 36, 196, 200, 1202]
         for i in trange(num_svgs):
         # for i in special_lst:
@@ -147,10 +149,10 @@ def main(cl: int = 0, rd: str = None):
             golden = sanint_check_svg_tensor(golden).squeeze(0)
             g_svg, g_svg_str = convert_svg(golden, True)
             import pdb; pdb.set_trace()
-            ## tmp save
-            _ = p_svg1.normalize().draw_colored(fill=True, file_path=os.path.join(SINGLE_IMAGE_SAVED_DIR, f"{i}_p_svg1.png"))
-            _ = p_svg2.normalize().draw_colored(fill=True, file_path=os.path.join(SINGLE_IMAGE_SAVED_DIR, f"{i}_p_svg2.png"))
-            _ = g_svg.normalize().draw_colored(fill=True, file_path=os.path.join(SINGLE_IMAGE_SAVED_DIR, f"{i}_g_svg.png"))
+            ## tmp save, rendered in the pool workers (with the background already composited if DIRECT_ADD_BACKGROUND)
+            render_pool.submit(p_predict1, save_path=os.path.join(SINGLE_IMAGE_SAVED_DIR, f"{i}_p_svg1.png"), colored=True, background=DIRECT_ADD_BACKGROUND)
+            render_pool.submit(p_predict2, save_path=os.path.join(SINGLE_IMAGE_SAVED_DIR, f"{i}_p_svg2.png"), colored=True, background=DIRECT_ADD_BACKGROUND)
+            render_pool.submit(golden, save_path=os.path.join(SINGLE_IMAGE_SAVED_DIR, f"{i}_g_svg.png"), colored=True, background=DIRECT_ADD_BACKGROUND)
             
             str_paths.append({
                 "p_svg_str1": p_svg_str1,
@@ -165,6 +167,7 @@ def main(cl: int = 0, rd: str = None):
             all_image_paths.append(os.path.join(SINGLE_IMAGE_SAVED_DIR, f"{i}_p_svg2.png"))
             all_image_paths.append(os.path.join(SINGLE_IMAGE_SAVED_DIR, f"{i}_g_svg.png"))
 
+        render_pool.close()  # all single images written
         auto_save_data(str_paths, PATH_SAVED_PATH)
 
     if DIRECT_GENERATE_BIG_MAP:
@@ -187,7 +190,7 @@ def main(cl: int = 0, rd: str = None):
             save_dir=BIG_MAP_SAVED_DIR
         )
 
-    if DIRECT_ADD_BACKGROUND:
+    if DIRECT_ADD_BACKGROUND and not DIRECT_GENERATE_SINGLE_IMAGE:
         if len(all_image_paths) == 0:
             print_c(f"no image path, read all image paths from {SINGLE_IMAGE_SAVED_DIR}", "magenta")
             all_image_paths = glob.glob(os.path.join(SINGLE_IMAGE_SAVED_DIR, "*.png"))
@@ -4,6 +4,8 @@ from transformers import LlamaForCausalLM, LlamaTokenizer, AutoConfig
 from dataclasses import field, dataclass
 from modelzipper import *  # modelzipper will load all the necessary modules
 from modelzipper.datamanager import *
+import hashlib
+import collections
 
 # Template for vanilla alpaca-lora
 LLAMA_TEMPLATE_V1 = {
@@ -17,15 +19,21 @@ LLAMA_TEMPLATE_V1 = {
 
 class BaseData(BaseDataset):
     
-    def __init__(self, file, tokenizer=None, max_seq_length=None, split="train"):
+    def __init__(self, file, tokenizer=None, max_seq_length=None, split="train", cache_dir=None, pad_to_multiple_of=8, report_every=100):
         super(BaseData, self).__init__()
         
         self.content = auto_read_data(file)
         self.tokenizer = tokenizer
         self.max_seq_length = max_seq_length
-    
-    def __getitem__(self, index):
-        sample = self.content[index]
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.report_every = report_every
+        self.utilization = collections.deque(maxlen=report_every or 100)  # real tokens / padded tokens of the last collated batches
+        self.num_batches = 0
+
+        # every example is tokenized once (unpadded), and the batches are padded in `custom_datacollator`
+        self.input_ids = self.tokenize_all(cache_dir)
+
+    def build_text(self, sample):
         instruction = sample.get("instruction", "")
         input_ = sample.get("input", "")
         output = sample.get("output", "")
@@ -36,18 +44,39 @@ class BaseData(BaseDataset):
         else:
             sample_ipt = LLAMA_TEMPLATE_V1["prompt_no_input"].format(instruction=instruction)
         
-        ipt_text = sample_ipt + "" + output
-
-        seq_inputs = self.tokenizer(
-            ipt_text, 
-            padding="max_length", 
-            truncation=True, 
-            max_length=self.max_seq_length,
-            return_tensors="pt",
-        )
-        
-        text_input_ids = seq_inputs.input_ids[0]
-        text_attention_mask = seq_inputs.attention_mask[0]
+        return sample_ipt + "" + output
+
+    def tokenize_all(self, cache_dir=None, chunk_size=10000):
+        texts = [self.build_text(sample) for sample in self.content]
+
+        cache_file = None
+        if cache_dir is not None:
+            hasher = hashlib.sha1()
+            for text in texts:
+                hasher.update(text.encode())
+                hasher.update(b"\0")
+            hasher.update(f"{self.tokenizer.name_or_path}|{len(self.tokenizer)}|{self.max_seq_length}".encode())
+            cache_file = os.path.join(cache_dir, f"tokenized_{hasher.hexdigest()[:16]}.pt")
+            if os.path.exists(cache_file):
+                return torch.load(cache_file)
+
+        input_ids = []
+        for start in range(0, len(texts), chunk_size):
+            tokenized = self.tokenizer(texts[start: start + chunk_size], truncation=True, max_length=self.max_seq_length)
+            input_ids.extend(torch.tensor(ids, dtype=torch.long) for ids in tokenized["input_ids"])
+
+        if cache_file is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            torch.save(input_ids, cache_file + ".tmp")
+            os.replace(cache_file + ".tmp", cache_file)
+        return input_ids
+
+    def __len__(self):
+        return len(self.content)
+    
+    def __getitem__(self, index):
+        text_input_ids = self.input_ids[index]
+        text_attention_mask = torch.ones_like(text_input_ids)
         text_labels = torch.where(text_input_ids != self.tokenizer.pad_token_id, text_input_ids, -100)
 
         return {
@@ -56,18 +85,25 @@ class BaseData(BaseDataset):
             "labels": text_labels,
         }
 
-    @classmethod
-    def custom_datacollator(cls, instances) -> Dict[str, torch.Tensor]:
-        """Collate examples for supervised fine-tuning."""
-        batch_input_ids, batch_attn_mask, batch_label = [], [], []
-        for ins in instances:
-            batch_input_ids.append(ins["input_ids"])
-            batch_attn_mask.append(ins["attention_mask"])
-            batch_label.append(ins["labels"])
-            
-        batch_input_ids = torch.stack(batch_input_ids, dim=0)
-        batch_attn_mask = torch.stack(batch_attn_mask, dim=0)
-        batch_label = torch.stack(batch_label, dim=0)
+    def custom_datacollator(self, instances) -> Dict[str, torch.Tensor]:
+        """Collate examples for supervised fine-tuning, padded to the longest example (rounded up to `pad_to_multiple_of`)."""
+        lengths = [ins["input_ids"].size(0) for ins in instances]
+        max_length = max(lengths)
+        if self.pad_to_multiple_of is not None:
+            max_length = (max_length + self.pad_to_multiple_of - 1) // self.pad_to_multiple_of * self.pad_to_multiple_of
+
+        batch_input_ids = torch.full((len(instances), max_length), self.tokenizer.pad_token_id, dtype=torch.long)
+        batch_attn_mask = torch.zeros((len(instances), max_length), dtype=torch.long)
+        batch_label = torch.full((len(instances), max_length), -100, dtype=torch.long)
+        for i, ins in enumerate(instances):
+            batch_input_ids[i, :lengths[i]] = ins["input_ids"]
+            batch_attn_mask[i, :lengths[i]] = ins["attention_mask"]
+            batch_label[i, :lengths[i]] = ins["labels"]
+
+        self.utilization.append(sum(lengths) / batch_input_ids.numel())
+        self.num_batches += 1
+        if self.report_every is not None and self.num_batches % self.report_every == 0:
+            print_c(f"token utilization of the last {self.report_every} batches: {sum(self.utilization) / len(self.utilization):.3f}", "yellow")
         
         return {
             "batch_input_ids": batch_input_ids,
@@ -115,6 +151,7 @@ class TrainingArguments(transformers.TrainingArguments):
         default=512,
         metadata={"help": "Maximum sequence length. Sequences will be right padded (and possibly truncated)."},
     )
+    group_by_length: bool = field(default=True, metadata={"help": "Batch examples of similar length, so the dynamic padding stays small."})
 
     
 def main(cf: str = None):
@@ -153,7 +190,7 @@ def main(cf: str = None):
     )
     tokenizer.pad_token_id = tokenizer.unk_token_id
 
-    train_dataset = BaseData(cfg.data_path, tokenizer, cfg.model_max_length, "train")
+    train_dataset = BaseData(cfg.data_path, tokenizer, cfg.model_max_length, "train", cache_dir=cfg.get("cache_dir", None))
 
     model.is_parallelizable = True
     model.model_parallel = True
@@ -0,0 +1,175 @@
+"""Offline cache of the training audio for `train_pyl.py`.
+
+The files listed in a CSV (as read by `train_pyl.CustomAudioDataset`) are decoded and
+resampled once into fixed-rate PCM shards, stored as raw `[T, C]` arrays, along with an
+index giving the shard, offset and length of every file. `CachedAudioDataset` then
+memory-maps the shards and directly reads a random `tensor_cut` window of each clip.
+
+    python audio_cache.py train.csv /data/cache/train --sample_rate 24000 --channels 1
+"""
+
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+import random
+import typing as tp
+
+import librosa
+import numpy as np
+import pandas as pd
+import torch
+
+MANIFEST_NAME = 'manifest.json'
+INDEX_NAME = 'index.npy'
+SHARD_PATTERN = 'shard_{:05d}.bin'
+DTYPES = {'int16': np.int16, 'float32': np.float32}
+INT16_SCALE = 2 ** 15
+
+
+def _load_audio(path: str, sample_rate: int, channels: int) -> tp.Optional[np.ndarray]:
+    """Decode and resample a single file, returns an array of shape `[T, C]`, or None on failure."""
+    try:
+        wav, _ = librosa.load(path, sr=sample_rate, mono=channels == 1)
+    except Exception as exc:  # corrupted or unsupported file, skipped from the cache.
+        print(f"Skipping {path}: {exc}")
+        return None
+    wav = np.atleast_2d(wav)
+    if wav.shape[0] != channels:
+        if channels == 1:
+            wav = wav.mean(axis=0, keepdims=True)
+        elif wav.shape[0] == 1:
+            wav = np.repeat(wav, channels, axis=0)
+        else:
+            raise RuntimeError(f"Impossible to convert from {wav.shape[0]} to {channels} channels")
+    return np.ascontiguousarray(wav.T)
+
+
+def build_audio_cache(csv_path: str, cache_dir: str, sample_rate: int, channels: int = 1,
+                      dtype: str = 'int16', shard_bytes: int = 2 ** 30, num_workers: int = 8,
+                      window: int = 256):
+    """Resample all the files listed in `csv_path` into shards of about `shard_bytes` bytes in `cache_dir`.
+
+    Args:
+        csv_path (str): CSV with one audio path per line, read like `CustomAudioDataset` does.
+        cache_dir (str): output folder, created if needed.
+        sample_rate (int): target sample rate.
+        channels (int): target number of channels.
+        dtype (str): storage type, `int16` halves the size compared to `float32`.
+        shard_bytes (int): a new shard is started once the current one exceeds this size.
+        num_workers (int): number of processes decoding the audio.
+        window (int): files decoded per round, only this many decoded clips are held in memory at once.
+    """
+    assert dtype in DTYPES, f"dtype must be one of {list(DTYPES)}"
+    os.makedirs(cache_dir, exist_ok=True)
+    paths = [str(path) for path in pd.read_csv(csv_path, on_bad_lines='skip').iloc[:, 0].values]
+
+    index: tp.List[tp.Tuple[int, int, int]] = []
+    sources: tp.List[str] = []
+    shard_id, shard_length = 0, 0
+    shard_file = open(os.path.join(cache_dir, SHARD_PATTERN.format(shard_id)), 'wb')
+    frame_bytes = channels * np.dtype(DTYPES[dtype]).itemsize
+    load = functools.partial(_load_audio, sample_rate=sample_rate, channels=channels)
+    with multiprocessing.Pool(num_workers) as pool:
+        for start in range(0, len(paths), window):
+            # decoded clips are written as soon as they arrive, in order
+            window_paths = paths[start: start + window]
+            for path, wav in zip(window_paths, pool.imap(load, window_paths, chunksize=4)):
+                if wav is None or not len(wav):
+                    continue
+                if shard_length and (shard_length + len(wav)) * frame_bytes > shard_bytes:
+                    shard_file.close()
+                    shard_id, shard_length = shard_id + 1, 0
+                    shard_file = open(os.path.join(cache_dir, SHARD_PATTERN.format(shard_id)), 'wb')
+                if dtype == 'int16':
+                    wav = np.round(np.clip(wav, -1, 1 - 1 / INT16_SCALE) * INT16_SCALE)
+                shard_file.write(wav.astype(DTYPES[dtype]).tobytes())
+                index.append((shard_id, shard_length, len(wav)))
+                sources.append(path)
+                shard_length += len(wav)
+    shard_file.close()
+
+    np.save(os.path.join(cache_dir, INDEX_NAME), np.array(index, dtype=np.int64).reshape(-1, 3))
+    manifest = {
+        'sample_rate': sample_rate,
+        'channels': channels,
+        'dtype': dtype,
+        'num_shards': shard_id + 1,
+        'sources': sources,
+    }
+    with open(os.path.join(cache_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f)
+    print(f"Cached {len(index)} / {len(paths)} files into {shard_id + 1} shards in {cache_dir}")
+
+
+class CachedAudioDataset(torch.utils.data.Dataset):
+    """Drop-in replacement for `train_pyl.CustomAudioDataset` reading from `build_audio_cache` shards.
+    Only the random `tensor_cut` window is read from the memory-mapped shards, and clips
+    shorter than `tensor_cut` are zero padded at the end, so that all items have the same length.
+    When given, `sample_rate` and `channels` (those of the model) must match the ones of the cache.
+    """
+    def __init__(self, cache_dir: str, tensor_cut: int, fixed_length: int = 0, transform=None,
+                 sample_rate: tp.Optional[int] = None, channels: tp.Optional[int] = None):
+        self.cache_dir = cache_dir
+        with open(os.path.join(cache_dir, MANIFEST_NAME)) as f:
+            self.manifest = json.load(f)
+        for key, expected in (('sample_rate', sample_rate), ('channels', channels)):
+            if expected is not None and self.manifest[key] != expected:
+                raise ValueError(f"{cache_dir} was built with {key}={self.manifest[key]} but {expected} is expected, "
+                                 "rebuild it with `audio_cache.py`")
+        self.index = np.load(os.path.join(cache_dir, INDEX_NAME))
+        self.sample_rate = self.manifest['sample_rate']
+        self.channels = self.manifest['channels']
+        self.dtype = self.manifest['dtype']
+        self.tensor_cut = tensor_cut
+        self.fixed_length = fixed_length
+        self.transform = transform
+        # Opened lazily, so that each dataloader worker has its own memory maps.
+        self._shards: tp.Dict[int, np.memmap] = {}
+
+    def __len__(self):
+        return self.fixed_length if self.fixed_length and len(self.index) > self.fixed_length else len(self.index)
+
+    def _shard(self, shard_id: int) -> np.memmap:
+        if shard_id not in self._shards:
+            path = os.path.join(self.cache_dir, SHARD_PATTERN.format(shard_id))
+            data = np.memmap(path, dtype=DTYPES[self.dtype], mode='r')
+            self._shards[shard_id] = data.reshape(-1, self.channels)
+        return self._shards[shard_id]
+
+    def __getitem__(self, idx):
+        shard_id, offset, length = (int(v) for v in self.index[idx])
+        start, size = 0, length
+        if self.tensor_cut > 0 and length > self.tensor_cut:
+            start = random.randint(0, length - self.tensor_cut - 1)  # random start point
+            size = self.tensor_cut
+        window = np.array(self._shard(shard_id)[offset + start: offset + start + size].T, dtype=np.float32)
+        if self.dtype == 'int16':
+            window /= INT16_SCALE
+        waveform = torch.from_numpy(window)
+        if self.tensor_cut > 0 and size < self.tensor_cut:
+            waveform = torch.nn.functional.pad(waveform, (0, self.tensor_cut - size))
+
+        if self.transform:
+            waveform = self.transform(waveform)
+        return waveform, self.sample_rate
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(description='Resample the audio listed in a CSV into PCM shards.')
+    parser.add_argument('csv_path', type=str, help='CSV with one audio file per line.')
+    parser.add_argument('cache_dir', type=str, help='Output folder for the shards.')
+    parser.add_argument('--sample_rate', type=int, default=24_000)
+    parser.add_argument('--channels', type=int, default=1)
+    parser.add_argument('--dtype', type=str, default='int16', choices=list(DTYPES))
+    parser.add_argument('--shard_bytes', type=int, default=2 ** 30)
+    parser.add_argument('--num_workers', type=int, default=8)
+    parser.add_argument('--window', type=int, default=256)
+    return parser
+
+
+if __name__ == '__main__':
+    args = get_parser().parse_args()
+    build_audio_cache(args.csv_path, args.cache_dir, args.sample_rate, args.channels,
+                      args.dtype, args.shard_bytes, args.num_workers, args.window)
@@ -27,6 +27,45 @@ def _timer():
     return _measure
 
 
+def bench_rvq(model: EncodecModel, x: torch.Tensor, chunk_size: int = 256):
+    """Residual VQ encoding, going through each layer vs. the in place path with cached norms."""
+    vq = model.quantizer.vq
+    with torch.no_grad():
+        emb = model.encoder(x)
+        for bandwidth in model.target_bandwidths:
+            n_q = model.quantizer.get_num_quantizers_for_bandwidth(model.frame_rate, bandwidth)
+            timer = _timer()
+            reference = vq._encode_layers(emb, n_q)
+            t_ref = timer()
+            codes = vq.encode(emb, n_q)
+            t_cached = timer()
+            codes_chunked = vq.encode(emb, n_q, chunk_size=chunk_size)
+            t_chunked = timer()
+            agreement = (codes == reference).float().mean().item()
+            assert torch.equal(codes, codes_chunked)
+            print(f"RVQ {bandwidth:4.1f} kbps (n_q={n_q:2d}): reference {1000 * t_ref:.1f} ms, "
+                  f"cached {1000 * t_cached:.1f} ms, chunked {1000 * t_chunked:.1f} ms, "
+                  f"codes agreement {100 * agreement:.3f}%")
+
+
+def bench_segment_batching(model: EncodecModel, x: torch.Tensor, batch_sizes=(1, 8, 32)):
+    """Throughput of the segmented models when batching several segments together."""
+    duration = x.shape[-1] / model.sample_rate
+    reference = None
+    for batch_size in batch_sizes:
+        timer = _timer()
+        with torch.no_grad():
+            frames = model.encode(x, segment_batch_size=batch_size)
+            t_enc = timer()
+            out = model.decode(frames, segment_batch_size=batch_size)
+            t_dec = timer()
+        if reference is None:
+            reference = out
+        delta = (out - reference).abs().max().item()
+        print(f"Segment batch size {batch_size:3d}: encode {duration / t_enc:.1f}x real time, "
+              f"decode {duration / t_dec:.1f}x real time, max delta {delta:.2e}")
+
+
 def main():
     torch.set_num_threads(1)
     model_lq = EncodecModel.encodec_model_24khz()
@@ -59,21 +98,24 @@ def main():
         fo = io.BytesIO()
         coder = ArithmeticCoder(fo)
         for t in range(T):
+            q_cdfs = build_stable_quantized_cdf(
+                probas[0, :, :, t].t(), coder.total_range_bits, check=False)
             for k, value in enumerate(codes[0, :, t].tolist()):
-                q_cdf = build_stable_quantized_cdf(
-                    probas[0, :, k, t], coder.total_range_bits, check=False)
-                coder.push(value, q_cdf)
+                coder.push(value, q_cdfs[k])
         print("Time to AC enc.:", timer())
         decoder = ArithmeticDecoder(fo)
         for t in range(T):
-            for k, value in enumerate(codes[0, :, t].tolist()):
-                q_cdf = build_stable_quantized_cdf(
-                    probas[0, :, k, t], coder.total_range_bits, check=False)
-                decoder.pull(q_cdf)
+            q_cdfs = build_stable_quantized_cdf(
+                probas[0, :, :, t].t(), coder.total_range_bits, check=False)
+            for k in range(K):
+                decoder.pull(q_cdfs[k])
         print("Time to AC dec.:", timer())
         with torch.no_grad():
             _ = model.decode(frames)
         print("Time to decode:", timer())
+        bench_rvq(model, x)
+        if model.segment_length is not None:
+            bench_segment_batching(model, x)
 
 
 if __name__ == '__main__':
@@ -7,16 +7,22 @@
 """Command-line for audio compression."""
 
 import argparse
+import io
 from pathlib import Path
 import sys
+import typing as tp
 
+import torch
 import torchaudio
 
-from .compress import compress, decompress, MODELS
-from .utils import save_audio, convert_audio
+from .compress import compress, compress_stream_to_file, decompress, decompress_stream_from_file, MODELS
+from .model import EncodecModel
+from .utils import save_audio, save_audio_stream, convert_audio
 
 
 SUFFIX = '.ecdc'
+# Duration of the audio chunks read from the input file when streaming.
+CHUNK_DURATION = 10.
 
 
 def get_parser():
@@ -65,10 +71,9 @@ def check_output_exists(args):
         fatal(f"Output file {args.output} exist. Use -f / --force to overwrite.")
 
 
-def check_clipping(wav, args):
+def check_clipping(mx, args):
     if args.rescale:
         return
-    mx = wav.abs().max()
     limit = 0.99
     if mx > limit:
         print(
@@ -77,6 +82,24 @@ def check_clipping(wav, args):
             file=sys.stderr)
 
 
+def load_audio_chunks(path: Path, model: EncodecModel, length: int) -> tp.Iterator[torch.Tensor]:
+    chunk_length = int(CHUNK_DURATION * model.sample_rate)
+    for offset in range(0, length, chunk_length):
+        wav, sr = torchaudio.load(path, frame_offset=offset, num_frames=chunk_length)
+        yield convert_audio(wav, sr, model.sample_rate, model.channels)
+
+
+def decompress_and_save(fo: tp.IO[bytes], args):
+    if args.rescale:
+        # Rescaling requires the full audio.
+        out, out_sample_rate = decompress(fo.read())
+        save_audio(out, args.output, out_sample_rate, rescale=True)
+        return
+    chunks, out_sample_rate = decompress_stream_from_file(fo)
+    mx = save_audio_stream(chunks, args.output, out_sample_rate)
+    check_clipping(mx, args)
+
+
 def main():
     args = get_parser().parse_args()
     if not args.input.exists():
@@ -89,9 +112,8 @@ def main():
         elif args.output.suffix.lower() != '.wav':
             fatal("Output extension must be .wav")
         check_output_exists(args)
-        out, out_sample_rate = decompress(args.input.read_bytes())
-        check_clipping(out, args)
-        save_audio(out, args.output, out_sample_rate, rescale=args.rescale)
+        with open(args.input, 'rb') as fo:
+            decompress_and_save(fo, args)
     else:
         # Compression
         if args.output is None:
@@ -106,6 +128,14 @@ def main():
             fatal(f"Bandwidth {args.bandwidth} is not supported by the model {model_name}")
         model.set_target_bandwidth(args.bandwidth)
 
+        info = torchaudio.info(str(args.input))
+        if info.sample_rate == model.sample_rate and args.output.suffix.lower() == SUFFIX:
+            # No resampling required, we can stream the input with a bounded memory usage.
+            chunks = load_audio_chunks(args.input, model, info.num_frames)
+            with open(args.output, 'wb') as fo:
+                compress_stream_to_file(model, chunks, info.num_frames, fo, use_lm=args.lm)
+            return
+
         wav, sr = torchaudio.load(args.input)
         wav = convert_audio(wav, sr, model.sample_rate, model.channels)
         compressed = compress(model, wav, use_lm=args.lm)
@@ -114,9 +144,7 @@ def main():
         else:
             # Directly run decompression stage
             assert args.output.suffix.lower() == '.wav'
-            out, out_sample_rate = decompress(compressed)
-            check_clipping(out, args)
-            save_audio(out, args.output, out_sample_rate, rescale=args.rescale)
+            decompress_and_save(io.BytesIO(compressed), args)
 
 
 if __name__ == '__main__':
@@ -12,11 +12,12 @@ import struct
 import time
 import typing as tp
 
+import numpy as np
 import torch
 
 from . import binary
 from .quantization.ac import ArithmeticCoder, ArithmeticDecoder, build_stable_quantized_cdf
-from .model import EncodecModel, EncodedFrame
+from .model import EncodecModel, EncodedFrame, LMModel
 
 
 MODELS = {
@@ -25,6 +26,93 @@ MODELS = {
 }
 
 
+class _CodesWriter:
+    """Writes the codes of consecutive frames to `fo`, see `compress_to_file`.
+    A frame can be pushed in several pieces along the time axis, the LM state,
+    the arithmetic coder or the codes not yet filling a full byte being carried over.
+    """
+    def __init__(self, model: EncodecModel, fo: tp.IO[bytes], lm: tp.Optional[LMModel] = None):
+        self.model = model
+        self.fo = fo
+        self.lm = lm
+        # Codes are only packed by groups filling an integer number of bytes until the frame ends.
+        self._align = 8 // math.gcd(model.bits_per_codebook, 8)
+        self._pending = np.zeros(0, dtype=np.int64)
+        self._coder: tp.Optional[ArithmeticCoder] = None
+        self._states: tp.Any = None
+        self._offset = 0
+        self._input: tp.Optional[torch.Tensor] = None
+
+    def start(self, scale: tp.Optional[torch.Tensor]):
+        """Start a new frame, with the given rescaling factor."""
+        if scale is not None:
+            self.fo.write(struct.pack('!f', scale.cpu().item()))
+        if self.lm is not None:
+            self._coder = ArithmeticCoder(self.fo)
+            self._states = None
+            self._offset = 0
+            self._input = None
+
+    def push(self, frame: torch.Tensor):
+        """Push the codes of shape `[1, K, T]` for the next `T` timesteps of the current frame."""
+        _, K, T = frame.shape
+        if self.lm is None:
+            # Codes are stored one timestep after the other, i.e. as `[T, K]`.
+            codes = np.concatenate([self._pending, frame[0].t().cpu().numpy().reshape(-1)])
+            count = len(codes) - len(codes) % self._align
+            binary.pack_codes(codes[:count], self.model.bits_per_codebook, self.fo)
+            self._pending = codes[count:]
+            return
+        assert self._coder is not None
+        if self._input is None:
+            self._input = torch.zeros(1, K, 1, dtype=torch.long, device=frame.device)
+        for t in range(T):
+            probas, self._states, self._offset = self.lm(self._input, self._states, self._offset)
+            self._input = 1 + frame[:, :, t: t + 1]
+            q_cdfs = build_stable_quantized_cdf(
+                probas[0, :, :, 0].t(), self._coder.total_range_bits, check=False)
+            for k, value in enumerate(frame[0, :, t].tolist()):
+                self._coder.push(value, q_cdfs[k])
+
+    def finish(self):
+        """Flush the current frame."""
+        if self.lm is None:
+            if len(self._pending):
+                binary.pack_codes(self._pending, self.model.bits_per_codebook, self.fo)
+                self._pending = self._pending[:0]
+        else:
+            assert self._coder is not None
+            self._coder.flush()
+
+
+def _write_frames(model: EncodecModel, frames: tp.Iterable[EncodedFrame], audio_length: int,
+                  fo: tp.IO[bytes], use_lm: bool):
+    lm = model.get_lm_model() if use_lm else None
+    metadata = {
+        'm': model.name,                 # model name
+        'al': audio_length,              # audio_length
+        'nc': model.quantizer.get_num_quantizers_for_bandwidth(
+            model.frame_rate, model.bandwidth),  # num_codebooks
+        'lm': use_lm,                    # use lm?
+    }
+    binary.write_ecdc_header(fo, metadata)
+
+    # Without segments, the frames are pieces of a single frame, see `EncodecModel.encode_stream`.
+    segmented = model.segment_length is not None
+    writer = _CodesWriter(model, fo, lm)
+    started = False
+    with torch.no_grad():
+        for (frame, scale) in frames:
+            if segmented or not started:
+                if started:
+                    writer.finish()
+                writer.start(scale)
+                started = True
+            writer.push(frame)
+    if started:
+        writer.finish()
+
+
 def compress_to_file(model: EncodecModel, wav: torch.Tensor, fo: tp.IO[bytes],
                      use_lm: bool = True):
     """Compress a waveform to a file-object using the given model.
@@ -44,60 +132,41 @@ def compress_to_file(model: EncodecModel, wav: torch.Tensor, fo: tp.IO[bytes],
     if model.name not in MODELS:
         raise ValueError(f"The provided model {model.name} is not supported.")
 
-    if use_lm:
-        lm = model.get_lm_model()
-
     with torch.no_grad():
         frames = model.encode(wav[None])
-
-    metadata = {
-        'm': model.name,                 # model name
-        'al': wav.shape[-1],             # audio_length
-        'nc': frames[0][0].shape[1],     # num_codebooks
-        'lm': use_lm,                    # use lm?
-    }
-    binary.write_ecdc_header(fo, metadata)
-
-    for (frame, scale) in frames:
-        if scale is not None:
-            fo.write(struct.pack('!f', scale.cpu().item()))
-        _, K, T = frame.shape
-        if use_lm:
-            coder = ArithmeticCoder(fo)
-            states: tp.Any = None
-            offset = 0
-            input_ = torch.zeros(1, K, 1, dtype=torch.long, device=wav.device)
-        else:
-            packer = binary.BitPacker(model.bits_per_codebook, fo)
-        for t in range(T):
-            if use_lm:
-                with torch.no_grad():
-                    probas, states, offset = lm(input_, states, offset)
-                # We emulate a streaming scenario even though we do not provide an API for it.
-                # This gives us a more accurate benchmark.
-                input_ = 1 + frame[:, :, t: t + 1]
-            for k, value in enumerate(frame[0, :, t].tolist()):
-                if use_lm:
-                    q_cdf = build_stable_quantized_cdf(
-                        probas[0, :, k, 0], coder.total_range_bits, check=False)
-                    coder.push(value, q_cdf)
-                else:
-                    packer.push(value)
-        if use_lm:
-            coder.flush()
-        else:
-            packer.flush()
+    _write_frames(model, frames, wav.shape[-1], fo, use_lm)
 
 
-def decompress_from_file(fo: tp.IO[bytes], device='cpu') -> tp.Tuple[torch.Tensor, int]:
-    """Decompress from a file-object.
-    Returns a tuple `(wav, sample_rate)`.
+def compress_stream_to_file(model: EncodecModel, chunks: tp.Iterable[torch.Tensor], audio_length: int,
+                            fo: tp.IO[bytes], use_lm: bool = True):
+    """Streaming version of `compress_to_file`, only keeping a bounded amount of audio
+    in memory, see `EncodecModel.encode_stream`. The output is the same `.ecdc` format.
 
     Args:
-        fo (IO[bytes]): file-object from which to read. If you want to decompress
-            from `bytes` instead, see `decompress`.
-        device: device to use to perform the computations.
+        model (EncodecModel): a pre-trained EncodecModel to use to compress the audio.
+        chunks (iterable of torch.Tensor): consecutive chunks of the waveform, each of shape `[C, T_i]`.
+        audio_length (int): total length of the waveform, required as it is stored in the header.
+        fo (IO[bytes]): file-object to which the compressed bits will be written.
+        use_lm (bool): if True, use a pre-trained language model to further
+            compress the stream using Entropy Coding.
     """
+    if model.name not in MODELS:
+        raise ValueError(f"The provided model {model.name} is not supported.")
+    seen = 0
+
+    def _batched_chunks():
+        nonlocal seen
+        for chunk in chunks:
+            assert chunk.dim() == 2, "Only single waveform can be encoded."
+            seen += chunk.shape[-1]
+            yield chunk[None]
+
+    _write_frames(model, model.encode_stream(_batched_chunks()), audio_length, fo, use_lm)
+    if seen != audio_length:
+        raise ValueError(f"Expected {audio_length} samples but the chunks contained {seen}.")
+
+
+def _read_header(fo: tp.IO[bytes], device) -> tp.Tuple[EncodecModel, tp.Optional[LMModel], int, int]:
     metadata = binary.read_ecdc_header(fo)
     model_name = metadata['m']
     audio_length = metadata['al']
@@ -108,54 +177,107 @@ def decompress_from_file(fo: tp.IO[bytes], device='cpu') -> tp.Tuple[torch.Tenso
     if model_name not in MODELS:
         raise ValueError(f"The audio was compressed with an unsupported model {model_name}.")
     model = MODELS[model_name]().to(device)
+    lm = model.get_lm_model() if use_lm else None
+    return model, lm, audio_length, num_codebooks
 
-    if use_lm:
-        lm = model.get_lm_model()
 
-    frames: tp.List[EncodedFrame] = []
+def _read_frames(fo: tp.IO[bytes], model: EncodecModel, lm: tp.Optional[LMModel],
+                 audio_length: int, num_codebooks: int, device,
+                 piece_length: tp.Optional[int] = None) -> tp.Iterator[EncodedFrame]:
+    """Read the frames written by `_write_frames`. If `piece_length` is given, frames are
+    yielded in pieces of that many timesteps, which is only valid for models without segments,
+    see `EncodecModel.decode_stream`.
+    """
+    if piece_length is not None:
+        assert model.segment_length is None
+        # Intermediate pieces must fill an integer number of bytes.
+        assert piece_length % 8 == 0
     segment_length = model.segment_length or audio_length
     segment_stride = model.segment_stride or audio_length
-    for offset in range(0, audio_length, segment_stride):
-        this_segment_length = min(audio_length - offset, segment_length)
+    for segment_offset in range(0, audio_length, segment_stride):
+        this_segment_length = min(audio_length - segment_offset, segment_length)
         frame_length = int(math.ceil(this_segment_length * model.frame_rate / model.sample_rate))
         if model.normalize:
             scale_f, = struct.unpack('!f', binary._read_exactly(fo, struct.calcsize('!f')))
             scale = torch.tensor(scale_f, device=device).view(1)
         else:
             scale = None
-        if use_lm:
+        if lm is not None:
             decoder = ArithmeticDecoder(fo)
             states: tp.Any = None
             offset = 0
             input_ = torch.zeros(1, num_codebooks, 1, dtype=torch.long, device=device)
-        else:
-            unpacker = binary.BitUnpacker(model.bits_per_codebook, fo)
-        frame = torch.zeros(1, num_codebooks, frame_length, dtype=torch.long, device=device)
-        for t in range(frame_length):
-            if use_lm:
+        this_piece_length = piece_length or frame_length
+        for piece_offset in range(0, frame_length, this_piece_length):
+            length = min(this_piece_length, frame_length - piece_offset)
+            if lm is None:
+                flat_codes = binary.unpack_codes(fo, model.bits_per_codebook, length * num_codebooks)
+                frame = torch.from_numpy(flat_codes).view(length, num_codebooks).t()
+                yield frame[None].contiguous().to(device), scale
+                continue
+            frame = torch.zeros(1, num_codebooks, length, dtype=torch.long, device=device)
+            for t in range(length):
                 with torch.no_grad():
                     probas, states, offset = lm(input_, states, offset)
-            code_list: tp.List[int] = []
-            for k in range(num_codebooks):
-                if use_lm:
-                    q_cdf = build_stable_quantized_cdf(
-                        probas[0, :, k, 0], decoder.total_range_bits, check=False)
-                    code = decoder.pull(q_cdf)
-                else:
-                    code = unpacker.pull()
-                if code is None:
-                    raise EOFError("The stream ended sooner than expected.")
-                code_list.append(code)
-            codes = torch.tensor(code_list, dtype=torch.long, device=device)
-            frame[0, :, t] = codes
-            if use_lm:
+                q_cdfs = build_stable_quantized_cdf(
+                    probas[0, :, :, 0].t(), decoder.total_range_bits, check=False)
+                code_list: tp.List[int] = []
+                for k in range(num_codebooks):
+                    code = decoder.pull(q_cdfs[k])
+                    if code is None:
+                        raise EOFError("The stream ended sooner than expected.")
+                    code_list.append(code)
+                codes = torch.tensor(code_list, dtype=torch.long, device=device)
+                frame[0, :, t] = codes
                 input_ = 1 + frame[:, :, t: t + 1]
-        frames.append((frame, scale))
+            yield frame, scale
+
+
+def decompress_from_file(fo: tp.IO[bytes], device='cpu') -> tp.Tuple[torch.Tensor, int]:
+    """Decompress from a file-object.
+    Returns a tuple `(wav, sample_rate)`.
+
+    Args:
+        fo (IO[bytes]): file-object from which to read. If you want to decompress
+            from `bytes` instead, see `decompress`.
+        device: device to use to perform the computations.
+    """
+    model, lm, audio_length, num_codebooks = _read_header(fo, device)
+    frames = list(_read_frames(fo, model, lm, audio_length, num_codebooks, device))
     with torch.no_grad():
         wav = model.decode(frames)
     return wav[0, :, :audio_length], model.sample_rate
 
 
+def decompress_stream_from_file(fo: tp.IO[bytes], device='cpu') -> tp.Tuple[tp.Iterator[torch.Tensor], int]:
+    """Streaming version of `decompress_from_file`, only keeping a bounded amount of audio in memory.
+    Returns a tuple `(chunks, sample_rate)`, with `chunks` an iterator over consecutive
+    chunks of the waveform, each of shape `[C, T_i]`. The header is read right away,
+    the rest of `fo` is read lazily while iterating over `chunks`.
+
+    Args:
+        fo (IO[bytes]): file-object from which to read.
+        device: device to use to perform the computations.
+    """
+    model, lm, audio_length, num_codebooks = _read_header(fo, device)
+    piece_length: tp.Optional[int] = None
+    if model.segment_length is None:
+        # The single frame is read by pieces of roughly one second, filling an integer number of bytes.
+        piece_length = 8 * max(1, model.frame_rate // 8)
+
+    @torch.no_grad()
+    def _chunks():
+        frames = _read_frames(fo, model, lm, audio_length, num_codebooks, device, piece_length)
+        remaining = audio_length
+        for wav in model.decode_stream(frames):
+            wav = wav[0, :, :remaining]
+            remaining -= wav.shape[-1]
+            if wav.shape[-1]:
+                yield wav
+
+    return _chunks(), model.sample_rate
+
+
 def compress(model: EncodecModel, wav: torch.Tensor, use_lm: bool = False) -> bytes:
     """Compress a waveform using the given model. Returns the compressed bytes.
 
@@ -206,6 +328,13 @@ def test():
                   f"time decomp:{t_decomp:.1f}.")
             assert x_dec.shape == x.shape
 
+            fo = io.BytesIO()
+            compress_stream_to_file(model, torch.split(x, 12_345, dim=-1), x.shape[-1], fo, use_lm=use_lm)
+            fo.seek(0)
+            chunks, _ = decompress_stream_from_file(fo)
+            x_stream = torch.cat(list(chunks), dim=-1)
+            assert x_stream.shape == x.shape
+
 
 if __name__ == '__main__':
     test()
@@ -16,7 +16,7 @@ from torch import nn
 
 from . import quantization as qt
 from . import modules as m
-from .utils import _check_checksum, _linear_overlap_add, _get_checkpoint_url
+from .utils import _check_checksum, _linear_overlap_add, _get_checkpoint_url, _StreamingLinearOverlapAdd
 
 
 ROOT_URL = 'https://dl.fbaipublicfiles.com/encodec/v0/'
@@ -24,6 +24,21 @@ ROOT_URL = 'https://dl.fbaipublicfiles.com/encodec/v0/'
 EncodedFrame = tp.Tuple[torch.Tensor, tp.Optional[torch.Tensor]]
 
 
+_T = tp.TypeVar('_T')
+
+
+def _group_frames(frames: tp.List[_T], key: tp.Callable[[_T], tp.Any], max_size: int) -> tp.Iterator[tp.List[_T]]:
+    # Groups consecutive frames sharing the same key, e.g. their shape, into lists of at most `max_size`.
+    group: tp.List[_T] = []
+    for frame in frames:
+        if group and (len(group) >= max_size or key(group[0]) != key(frame)):
+            yield group
+            group = []
+        group.append(frame)
+    if group:
+        yield group
+
+
 class LMModel(nn.Module):
     """Language Model to estimate probabilities of each codebook entry.
     We predict all codebooks in parallel for a given time step.
@@ -119,13 +134,18 @@ class EncodecModel(nn.Module):
             return None
         return max(1, int((1 - self.overlap) * segment_length))
 
-    def encode(self, x: torch.Tensor) -> tp.List[EncodedFrame]:
+    def encode(self, x: torch.Tensor, segment_batch_size: int = 1) -> tp.List[EncodedFrame]:
         """Given a tensor `x`, returns a list of frames containing
         the discrete encoded codes for `x`, along with rescaling factors
         for each segment, when `self.normalize` is True.
 
         Each frames is a tuple `(codebook, scale)`, with `codebook` of
         shape `[B, K, T]`, with `K` the number of codebooks.
+
+        For segmented models, up to `segment_batch_size` consecutive segments of the same
+        length are encoded as a single batch, which is much faster than one segment at a time.
+        The last (shorter) segments are encoded on their own, so that the frames are the same
+        as with `segment_batch_size=1`.
         """
         assert x.dim() == 3
         _, channels, length = x.shape
@@ -138,12 +158,62 @@ class EncodecModel(nn.Module):
             stride = self.segment_stride  # type: ignore
             assert stride is not None
 
+        frames = [x[:, :, offset: offset + segment_length] for offset in range(0, length, stride)]
         encoded_frames: tp.List[EncodedFrame] = []
-        for offset in range(0, length, stride):
-            frame = x[:, :, offset: offset + segment_length]
-            encoded_frames.append(self._encode_frame(frame))
+        for group in _group_frames(frames, lambda frame: frame.shape, segment_batch_size):
+            encoded_frames += self._encode_frames(group)
         return encoded_frames
 
+    def encode_stream(self, chunks: tp.Iterable[torch.Tensor]) -> tp.Iterator[EncodedFrame]:
+        """Streaming version of `encode`, taking an iterable over consecutive chunks of audio,
+        each of shape `[B, C, T_i]`, and yielding the encoded frames as soon as possible.
+
+        For segmented models, this yields exactly the frames of `encode`, keeping at most
+        one segment in memory. Otherwise, streaming is only supported for causal models,
+        and the single frame `encode` would return is yielded as consecutive pieces
+        along the time axis, the encoder state being carried over between chunks.
+        """
+        segment_length = self.segment_length
+        if segment_length is None:
+            if self.normalize:
+                raise RuntimeError("Streaming requires segments when normalizing the audio.")
+            state: tp.Any = None
+            last_chunk: tp.Optional[torch.Tensor] = None
+            for chunk in chunks:
+                emb, state = self.encoder.streaming_forward(chunk, state)
+                last_chunk = chunk
+                if emb.shape[-1]:
+                    codes = self.quantizer.encode(emb, self.frame_rate, self.bandwidth)
+                    yield codes.transpose(0, 1), None
+            if last_chunk is not None:
+                emb, _ = self.encoder.streaming_forward(last_chunk[..., :0], state, last=True)
+                if emb.shape[-1]:
+                    codes = self.quantizer.encode(emb, self.frame_rate, self.bandwidth)
+                    yield codes.transpose(0, 1), None
+            return
+
+        stride = self.segment_stride
+        assert stride is not None
+        buffer: tp.Optional[torch.Tensor] = None
+        for chunk in chunks:
+            buffer = chunk if buffer is None else torch.cat([buffer, chunk], dim=-1)
+            while buffer.shape[-1] >= segment_length:
+                yield self._encode_frame(buffer[..., :segment_length])
+                buffer = buffer[..., stride:]
+        if buffer is not None:
+            for offset in range(0, buffer.shape[-1], stride):
+                yield self._encode_frame(buffer[..., offset: offset + segment_length])
+
+    def _encode_frames(self, frames: tp.List[torch.Tensor]) -> tp.List[EncodedFrame]:
+        # Encode frames of the same shape as a single batch.
+        if len(frames) == 1:
+            return [self._encode_frame(frames[0])]
+        codes, scale = self._encode_frame(torch.cat(frames, dim=0))
+        all_codes = codes.chunk(len(frames), dim=0)
+        if scale is None:
+            return [(frame_codes, None) for frame_codes in all_codes]
+        return list(zip(all_codes, scale.chunk(len(frames), dim=0)))
+
     def _encode_frame(self, x: torch.Tensor) -> EncodedFrame:
         length = x.shape[-1]
         duration = length / self.sample_rate
@@ -164,19 +234,69 @@ class EncodecModel(nn.Module):
         # codes is [B, K, T], with T frames, K nb of codebooks.
         return codes, scale
 
-    def decode(self, encoded_frames: tp.List[EncodedFrame]) -> torch.Tensor:
+    def decode(self, encoded_frames: tp.List[EncodedFrame], segment_batch_size: int = 1) -> torch.Tensor:
         """Decode the given frames into a waveform.
         Note that the output might be a bit bigger than the input. In that case,
         any extra steps at the end can be trimmed.
+
+        As for `encode`, up to `segment_batch_size` consecutive frames of the same
+        length are decoded as a single batch before the overlap-add.
         """
         segment_length = self.segment_length
         if segment_length is None:
             assert len(encoded_frames) == 1
             return self._decode_frame(encoded_frames[0])
 
-        frames = [self._decode_frame(frame) for frame in encoded_frames]
+        frames: tp.List[torch.Tensor] = []
+        for group in _group_frames(encoded_frames, lambda frame: (frame[0].shape, frame[1] is None),
+                                   segment_batch_size):
+            frames += self._decode_frames(group)
         return _linear_overlap_add(frames, self.segment_stride or 1)
 
+    def decode_stream(self, encoded_frames: tp.Iterable[EncodedFrame]) -> tp.Iterator[torch.Tensor]:
+        """Streaming version of `decode`, yielding consecutive chunks of the waveform.
+        The frames are expected as given by `encode_stream` (or `encode`). Only the
+        overlap-add tail, or the decoder state for non segmented causal models,
+        is kept between frames.
+        """
+        segment_length = self.segment_length
+        if segment_length is None:
+            state: tp.Any = None
+            last_emb: tp.Optional[torch.Tensor] = None
+            for codes, scale in encoded_frames:
+                assert scale is None, "Streaming requires segments when normalizing the audio."
+                emb = self.quantizer.decode(codes.transpose(0, 1))
+                out, state = self.decoder.streaming_forward(emb, state)
+                last_emb = emb
+                if out.shape[-1]:
+                    yield out
+            if last_emb is not None:
+                out, _ = self.decoder.streaming_forward(last_emb[..., :0], state, last=True)
+                if out.shape[-1]:
+                    yield out
+            return
+
+        overlap_add = _StreamingLinearOverlapAdd(self.segment_stride or 1)
+        pushed = False
+        for frame in encoded_frames:
+            out = overlap_add.push(self._decode_frame(frame))
+            pushed = True
+            if out.shape[-1]:
+                yield out
+        if pushed:
+            yield overlap_add.flush()
+
+    def _decode_frames(self, encoded_frames: tp.List[EncodedFrame]) -> tp.List[torch.Tensor]:
+        # Decode frames of the same shape as a single batch.
+        if len(encoded_frames) == 1:
+            return [self._decode_frame(encoded_frames[0])]
+        codes = torch.cat([codes for codes, _ in encoded_frames], dim=0)
+        scale: tp.Optional[torch.Tensor] = None
+        if encoded_frames[0][1] is not None:
+            scale = torch.cat([scale for _, scale in encoded_frames], dim=0)  # type: ignore
+        out = self._decode_frame((codes, scale))
+        return list(out.chunk(len(encoded_frames), dim=0))
+
     def _decode_frame(self, encoded_frame: EncodedFrame) -> torch.Tensor:
         codes, scale = encoded_frame
         codes = codes.transpose(0, 1)
@@ -318,6 +438,16 @@ def test():
         wav_in = wav.unsqueeze(0)
         wav_dec = model(wav_in)[0]
         assert wav.shape == wav_dec.shape, (wav.shape, wav_dec.shape)
+        with torch.no_grad():
+            frames = list(model.encode_stream(torch.split(wav_in, 4_567, dim=-1)))
+            wav_stream = torch.cat(list(model.decode_stream(frames)), dim=-1)[0, :, :wav.shape[-1]]
+        assert wav.shape == wav_stream.shape, (wav.shape, wav_stream.shape)
+        with torch.no_grad():
+            frames = model.encode(wav_in)
+            frames_batched = model.encode(wav_in, segment_batch_size=4)
+            wav_batched = model.decode(frames_batched, segment_batch_size=4)[0, :, :wav.shape[-1]]
+        assert len(frames) == len(frames_batched)
+        assert wav.shape == wav_batched.shape, (wav.shape, wav_batched.shape)
 
 
 if __name__ == '__main__':
@@ -210,6 +210,42 @@ class SConv1d(nn.Module):
             x = pad1d(x, (padding_left, padding_right + extra_padding), mode=self.pad_mode)
         return self.conv(x)
 
+    def streaming_forward(self, x: torch.Tensor, state: tp.Any = None,
+                          last: bool = False) -> tp.Tuple[torch.Tensor, tp.Any]:
+        """Streaming version of `forward`, only available for causal convolutions.
+        Feeding a signal chunk by chunk, with `last=True` on the final call, yields
+        exactly the output of `forward` on the full signal.
+        Returns a tuple `(y, state)`, `state` to be passed to the next call.
+        """
+        assert self.causal, "Streaming is only supported for causal convolutions."
+        kernel_size = self.conv.conv.kernel_size[0]
+        stride = self.conv.conv.stride[0]
+        dilation = self.conv.conv.dilation[0]
+        kernel_size = (kernel_size - 1) * dilation + 1  # effective kernel size with dilations
+        padding_total = kernel_size - stride
+        started = False
+        if state is not None:
+            buffer, started = state
+            x = torch.cat([buffer, x], dim=-1)
+        if not started:
+            if last:
+                # The whole signal was seen at once, nothing specific to do.
+                return self.forward(x), None
+            if x.shape[-1] <= padding_total:
+                # Reflect padding on the left needs the first `padding_total + 1` steps.
+                return x.new_zeros(x.shape[0], self.conv.conv.out_channels, 0), (x, False)
+            x = pad1d(x, (padding_total, 0), mode=self.pad_mode)
+        if last:
+            extra_padding = get_extra_padding_for_conv1d(x, kernel_size, stride)
+            x = pad1d(x, (0, extra_padding), mode=self.pad_mode)
+        length = x.shape[-1]
+        num_frames = max(0, (length - kernel_size) // stride + 1)
+        if num_frames:
+            y = self.conv(x[..., :(num_frames - 1) * stride + kernel_size])
+        else:
+            y = x.new_zeros(x.shape[0], self.conv.conv.out_channels, 0)
+        return y, (x[..., num_frames * stride:], True)
+
 
 class SConvTranspose1d(nn.Module):
     """ConvTranspose1d with some builtin handling of asymmetric or causal padding
@@ -251,3 +287,39 @@ class SConvTranspose1d(nn.Module):
             padding_left = padding_total - padding_right
             y = unpad1d(y, (padding_left, padding_right))
         return y
+
+    def streaming_forward(self, x: torch.Tensor, state: tp.Any = None,
+                          last: bool = False) -> tp.Tuple[torch.Tensor, tp.Any]:
+        """Streaming version of `forward`, only available for causal convolutions.
+        The overlapping tail of the transposed convolution is kept in `state`
+        and added to the output of the next call.
+        Returns a tuple `(y, state)`, `state` to be passed to the next call.
+        """
+        assert self.causal, "Streaming is only supported for causal convolutions."
+        convtr = self.convtr.convtr
+        kernel_size = convtr.kernel_size[0]
+        stride = convtr.stride[0]
+        padding_total = kernel_size - stride
+        padding_right = math.ceil(padding_total * self.trim_right_ratio)
+        padding_left = padding_total - padding_right
+
+        first = state is None
+        tail = state
+        if x.shape[-1]:
+            # The normalization is applied afterwards, as it might not be linear.
+            y = convtr(x)
+            if tail is not None:
+                if convtr.bias is not None:
+                    # The bias was already added to the tail by the previous call.
+                    tail = tail - convtr.bias[:, None]
+                y = torch.cat([y[..., :padding_total] + tail, y[..., padding_total:]], dim=-1)
+            emit = x.shape[-1] * stride
+            tail = y[..., emit:]
+            y = y[..., :emit]
+        else:
+            y = x.new_zeros(x.shape[0], convtr.out_channels, 0)
+        if last and tail is not None:
+            y = torch.cat([y, tail[..., :padding_left]], dim=-1)
+        if first:
+            y = y[..., padding_left:]
+        return self.convtr.norm(y), tail
@@ -6,6 +6,9 @@
 
 """LSTM layers module."""
 
+import typing as tp
+
+import torch
 from torch import nn
 
 
@@ -26,3 +29,16 @@ class SLSTM(nn.Module):
             y = y + x
         y = y.permute(1, 2, 0)
         return y
+
+    def streaming_forward(self, x: torch.Tensor, state: tp.Any = None,
+                          last: bool = False) -> tp.Tuple[torch.Tensor, tp.Any]:
+        """Streaming version of `forward`, carrying the LSTM hidden state between calls.
+        """
+        if not x.shape[-1]:
+            return x, state
+        x = x.permute(2, 0, 1)
+        y, state = self.lstm(x, state)
+        if self.skip:
+            y = y + x
+        y = y.permute(1, 2, 0)
+        return y, state
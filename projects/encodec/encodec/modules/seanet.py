@@ -9,6 +9,7 @@
 import typing as tp
 
 import numpy as np
+import torch
 import torch.nn as nn
 
 from . import (
@@ -18,6 +19,24 @@ from . import (
 )
 
 
+def streaming_sequential(layers: nn.Sequential, x: torch.Tensor, states: tp.Optional[tp.List[tp.Any]] = None,
+                         last: bool = False) -> tp.Tuple[torch.Tensor, tp.List[tp.Any]]:
+    """Run `layers` in streaming mode. Layers with a `streaming_forward` method carry
+    their own state, any other layer (e.g. activations) must act independently on each time step.
+    Returns a tuple `(y, states)`, `states` to be passed to the next call.
+    """
+    if states is None:
+        states = [None] * len(layers)
+    new_states: tp.List[tp.Any] = []
+    for layer, state in zip(layers, states):
+        if hasattr(layer, 'streaming_forward'):
+            x, state = layer.streaming_forward(x, state, last=last)
+        elif x.shape[-1]:
+            x = layer(x)
+        new_states.append(state)
+    return x, new_states
+
+
 class SEANetResnetBlock(nn.Module):
     """Residual block from SEANet model.
     Args:
@@ -62,6 +81,25 @@ class SEANetResnetBlock(nn.Module):
     def forward(self, x):
         return self.shortcut(x) + self.block(x)
 
+    def streaming_forward(self, x: torch.Tensor, state: tp.Any = None,
+                          last: bool = False) -> tp.Tuple[torch.Tensor, tp.Any]:
+        """Streaming version of `forward`. Returns a tuple `(y, state)`.
+        """
+        if state is None:
+            shortcut_state, block_states, pending = None, None, x[..., :0]
+        else:
+            shortcut_state, block_states, pending = state
+        if isinstance(self.shortcut, nn.Identity):
+            skip = x
+        else:
+            skip, shortcut_state = self.shortcut.streaming_forward(x, shortcut_state, last=last)
+        y, block_states = streaming_sequential(self.block, x, block_states, last=last)
+        # The residual branch might lag behind the skip connection on the very first steps.
+        pending = torch.cat([pending, skip], dim=-1)
+        length = y.shape[-1]
+        y = pending[..., :length] + y
+        return y, (shortcut_state, block_states, pending[..., length:])
+
 
 class SEANetEncoder(nn.Module):
     """SEANet encoder.
@@ -143,6 +181,14 @@ class SEANetEncoder(nn.Module):
     def forward(self, x):
         return self.model(x)
 
+    def streaming_forward(self, x: torch.Tensor, state: tp.Any = None,
+                          last: bool = False) -> tp.Tuple[torch.Tensor, tp.Any]:
+        """Encode `x` in streaming mode, only supported for causal models.
+        Feeding the audio chunk by chunk, with `last=True` on the final call, gives the same
+        embeddings as `forward` over the full audio. Returns a tuple `(emb, state)`.
+        """
+        return streaming_sequential(self.model, x, state, last=last)
+
 
 class SEANetDecoder(nn.Module):
     """SEANet decoder.
@@ -237,6 +283,13 @@ class SEANetDecoder(nn.Module):
         y = self.model(z)
         return y
 
+    def streaming_forward(self, z: torch.Tensor, state: tp.Any = None,
+                          last: bool = False) -> tp.Tuple[torch.Tensor, tp.Any]:
+        """Decode `z` in streaming mode, only supported for causal models.
+        See `SEANetEncoder.streaming_forward`. Returns a tuple `(y, state)`.
+        """
+        return streaming_sequential(self.model, z, state, last=last)
+
 
 def test():
     import torch
@@ -248,6 +301,32 @@ def test():
     y = decoder(z)
     assert y.shape == x.shape, (x.shape, y.shape)
 
+    # Streaming must match the offline computation.
+    encoder = SEANetEncoder(causal=True).eval()
+    decoder = SEANetDecoder(causal=True).eval()
+    x = torch.randn(1, 1, 24000 + 123)
+    with torch.no_grad():
+        z = encoder(x)
+        y = decoder(z)
+        z_chunks, y_chunks = [], []
+        enc_state, dec_state = None, None
+        for offset in range(0, x.shape[-1], 997):
+            z_chunk, enc_state = encoder.streaming_forward(x[..., offset: offset + 997], enc_state)
+            z_chunks.append(z_chunk)
+        z_chunk, _ = encoder.streaming_forward(x[..., :0], enc_state, last=True)
+        z_chunks.append(z_chunk)
+        z_stream = torch.cat(z_chunks, dim=-1)
+        assert z_stream.shape == z.shape, (z_stream.shape, z.shape)
+        assert torch.allclose(z_stream, z, atol=1e-5)
+        for offset in range(0, z.shape[-1], 7):
+            y_chunk, dec_state = decoder.streaming_forward(z[..., offset: offset + 7], dec_state)
+            y_chunks.append(y_chunk)
+        y_chunk, _ = decoder.streaming_forward(z[..., :0], dec_state, last=True)
+        y_chunks.append(y_chunk)
+        y_stream = torch.cat(y_chunks, dim=-1)
+        assert y_stream.shape == y.shape, (y_stream.shape, y.shape)
+        assert torch.allclose(y_stream, y, atol=1e-5)
+
 
 if __name__ == '__main__':
     test()
@@ -23,7 +23,9 @@ def build_stable_quantized_cdf(pdf: torch.Tensor, total_range_bits: int,
     to the PDF.
 
     Args:
-        pdf (torch.Tensor): probability distribution, shape should be `[N]`.
+        pdf (torch.Tensor): probability distribution, shape should be `[N]`. Any number of
+            leading dimensions is accepted, e.g. `[K, N]` to build the CDFs of all
+            codebooks at once, each row giving exactly the same result as a `[N]` call.
         total_range_bits (int): see `ArithmeticCoder`, the typical range we expect
             during the coding process is `[0, 2 ** total_range_bits - 1]`.
         roundoff (float): will round the pdf up to that level to remove difference coming
@@ -38,7 +40,7 @@ def build_stable_quantized_cdf(pdf: torch.Tensor, total_range_bits: int,
         pdf = (pdf / roundoff).floor() * roundoff
     # interpolate with uniform distribution to achieve desired minimum probability.
     total_range = 2 ** total_range_bits
-    cardinality = len(pdf)
+    cardinality = pdf.shape[-1]
     alpha = min_range * cardinality / total_range
     assert alpha <= 1, "you must reduce min_range"
     ranges = (((1 - alpha) * total_range) * pdf).floor().long()
@@ -47,8 +49,9 @@ def build_stable_quantized_cdf(pdf: torch.Tensor, total_range_bits: int,
     if min_range < 2:
         raise ValueError("min_range must be at least 2.")
     if check:
-        assert quantized_cdf[-1] <= 2 ** total_range_bits, quantized_cdf[-1]
-        if ((quantized_cdf[1:] - quantized_cdf[:-1]) < min_range).any() or quantized_cdf[0] < min_range:
+        assert (quantized_cdf[..., -1] <= 2 ** total_range_bits).all(), quantized_cdf[..., -1]
+        if ((quantized_cdf[..., 1:] - quantized_cdf[..., :-1]) < min_range).any() or \
+                (quantized_cdf[..., 0] < min_range).any():
             raise ValueError("You must increase your total_range_bits.")
     return quantized_cdf
 
@@ -287,6 +290,12 @@ def test():
             assert decoded_symbol == symbol, idx
         assert decoder.pull(torch.zeros(1)) is None
 
+    # Batched CDFs must match the per row ones exactly.
+    pdfs_batch = torch.softmax(torch.randn(8, 1024), dim=-1)
+    q_cdfs = build_stable_quantized_cdf(pdfs_batch, 24)
+    for pdf, q_cdf in zip(pdfs_batch, q_cdfs):
+        assert torch.equal(build_stable_quantized_cdf(pdf, 24), q_cdf)
+
 
 if __name__ == "__main__":
     test()
@@ -136,6 +136,9 @@ class EuclideanCodebook(nn.Module):
         self.register_buffer("cluster_size", torch.zeros(codebook_size))
         self.register_buffer("embed", embed)
         self.register_buffer("embed_avg", embed.clone())
+        # Squared norms of the codebook entries, cached for inference, see `quantize_cached`.
+        self.register_buffer("embed_sq_norm", torch.zeros(codebook_size), persistent=False)
+        self._cache_valid = False
 
     @torch.jit.ignore
     def init_embed_(self, data):
@@ -147,6 +150,7 @@ class EuclideanCodebook(nn.Module):
         self.embed_avg.data.copy_(embed.clone())
         self.cluster_size.data.copy_(cluster_size)
         self.inited.data.copy_(torch.Tensor([True]))
+        self.invalidate_cache()
         # Make sure all buffers across workers are in sync after initialization
         distrib.broadcast_tensors(self.buffers())
 
@@ -155,6 +159,7 @@ class EuclideanCodebook(nn.Module):
             mask[..., None], sample_vectors(samples, self.codebook_size), self.embed
         )
         self.embed.data.copy_(modified_codebook)
+        self.invalidate_cache()
 
     def expire_codes_(self, batch_samples):
         if self.threshold_ema_dead_code == 0:
@@ -168,6 +173,17 @@ class EuclideanCodebook(nn.Module):
         self.replace_(batch_samples, mask=expired_codes)
         distrib.broadcast_tensors(self.buffers())
 
+    def invalidate_cache(self):
+        """Must be called whenever `embed` is modified, so that `quantize_cached`
+        recomputes the codebook norms. This is done automatically by the updates
+        of the codebook and when loading a state dict.
+        """
+        self._cache_valid = False
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        super()._load_from_state_dict(*args, **kwargs)
+        self.invalidate_cache()
+
     def preprocess(self, x):
         x = rearrange(x, "... d -> (...) d")
         return x
@@ -182,6 +198,17 @@ class EuclideanCodebook(nn.Module):
         embed_ind = dist.max(dim=-1).indices
         return embed_ind
 
+    def quantize_cached(self, x, out: tp.Optional[torch.Tensor] = None):
+        """Inference version of `quantize`, reusing the cached squared norms of the codebook.
+        As the norm of `x` doesn't change the nearest entry, it is not computed at all.
+        `out` can be given to reuse the memory of the `[N, codebook_size]` distance matrix.
+        """
+        if not self._cache_valid:
+            self.embed_sq_norm.copy_(self.embed.pow(2).sum(1))
+            self._cache_valid = True
+        dist = torch.addmm(self.embed_sq_norm, x, self.embed.t(), alpha=-2, out=out)
+        return dist.argmin(dim=-1)
+
     def postprocess_emb(self, embed_ind, shape):
         return embed_ind.view(*shape[:-1])
 
@@ -227,6 +254,7 @@ class EuclideanCodebook(nn.Module):
             )
             embed_normalized = self.embed_avg / cluster_size.unsqueeze(1)
             self.embed.data.copy_(embed_normalized)
+            self.invalidate_cache()
 
         return quantize, embed_ind
 
@@ -346,7 +374,40 @@ class ResidualVectorQuantization(nn.Module):
         out_losses, out_indices = map(torch.stack, (all_losses, all_indices))
         return quantized_out, out_indices, out_losses
 
-    def encode(self, x: torch.Tensor, n_q: tp.Optional[int] = None) -> torch.Tensor:
+    def encode(self, x: torch.Tensor, n_q: tp.Optional[int] = None,
+               chunk_size: tp.Optional[int] = None) -> torch.Tensor:
+        """Encode `x` of shape `[B, D, N]`, returns the codes with shape `[n_q, B, N]`.
+        At inference, the residual is computed in place on a single copy of `x`, using the
+        cached codebook norms (see `EuclideanCodebook.quantize_cached`). If `chunk_size` is given,
+        the `B * N` vectors are processed by chunks of that size, bounding the memory used by the
+        `[chunk_size, codebook_size]` distance matrix.
+        """
+        n_q = n_q or len(self.layers)
+        layers = self.layers[:n_q]
+        if self.training or not all(isinstance(layer.project_in, nn.Identity) for layer in layers):
+            return self._encode_layers(x, n_q)
+
+        B, D, N = x.shape
+        residual = x.new_empty(B, N, D)
+        residual.copy_(x.transpose(1, 2))
+        residual = residual.view(B * N, D)
+        codes = torch.empty(n_q, B * N, dtype=torch.long, device=x.device)
+        chunk_size = min(chunk_size or B * N, B * N)
+        dist = x.new_empty(chunk_size, layers[0].codebook_size)
+        quantized = x.new_empty(chunk_size, D)
+        for offset in range(0, B * N, chunk_size):
+            chunk = residual[offset: offset + chunk_size]
+            length = len(chunk)
+            for q, layer in enumerate(layers):
+                codebook = layer._codebook
+                indices = codebook.quantize_cached(chunk, out=dist[:length])
+                codes[q, offset: offset + length] = indices
+                torch.index_select(codebook.embed, 0, indices, out=quantized[:length])
+                chunk.sub_(quantized[:length])
+        return codes.view(n_q, B, N)
+
+    def _encode_layers(self, x: torch.Tensor, n_q: tp.Optional[int] = None) -> torch.Tensor:
+        # Reference implementation, going through each `VectorQuantization` layer.
         residual = x
         all_indices = []
         n_q = n_q or len(self.layers)
@@ -100,13 +100,15 @@ class ResidualVectorQuantizer(nn.Module):
         """
         return math.log2(self.bins) * frame_rate
 
-    def encode(self, x: torch.Tensor, frame_rate: int, bandwidth: tp.Optional[float] = None) -> torch.Tensor:
+    def encode(self, x: torch.Tensor, frame_rate: int, bandwidth: tp.Optional[float] = None,
+               chunk_size: tp.Optional[int] = None) -> torch.Tensor:
         """Encode a given input tensor with the specified frame rate at the given bandwidth.
         The RVQ encode method sets the appropriate number of quantizers to use
-        and returns indices for each quantizer.
+        and returns indices for each quantizer. See `ResidualVectorQuantization.encode`
+        for `chunk_size`.
         """
         n_q = self.get_num_quantizers_for_bandwidth(frame_rate, bandwidth)
-        codes = self.vq.encode(x, n_q=n_q)
+        codes = self.vq.encode(x, n_q=n_q, chunk_size=chunk_size)
         return codes
 
     def decode(self, codes: torch.Tensor) -> torch.Tensor:
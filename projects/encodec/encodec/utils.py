@@ -9,6 +9,7 @@
 from hashlib import sha256
 from pathlib import Path
 import typing as tp
+import wave
 
 import torch
 import torchaudio
@@ -56,6 +57,51 @@ def _linear_overlap_add(frames: tp.List[torch.Tensor], stride: int):
     return out / sum_weight
 
 
+class _StreamingLinearOverlapAdd:
+    """Streaming counterpart of `_linear_overlap_add`, frames are pushed one at a time
+    and the positions that no later frame can cover are returned right away.
+    Only the overlapping tail is kept in memory.
+    """
+    def __init__(self, stride: int):
+        self.stride = stride
+        self._weight: tp.Optional[torch.Tensor] = None
+        self._out: tp.Optional[torch.Tensor] = None
+        self._sum_weight: tp.Optional[torch.Tensor] = None
+
+    def push(self, frame: torch.Tensor) -> torch.Tensor:
+        """Add a new frame, returns the finalized output up to the start of this frame."""
+        frame_length = frame.shape[-1]
+        if self._weight is None:
+            # As for `_linear_overlap_add`, the first frame gives the weight function.
+            t = torch.linspace(0, 1, frame_length + 2, device=frame.device, dtype=frame.dtype)[1: -1]
+            self._weight = 0.5 - (t - 0.5).abs()
+            self._out = frame.new_zeros(*frame.shape[:-1], 0)
+            self._sum_weight = frame.new_zeros(0)
+        assert self._out is not None and self._sum_weight is not None
+        missing = frame_length - self._out.shape[-1]
+        if missing > 0:
+            self._out = torch.cat([self._out, self._out.new_zeros(*self._out.shape[:-1], missing)], dim=-1)
+            self._sum_weight = torch.cat([self._sum_weight, self._sum_weight.new_zeros(missing)])
+        weight = self._weight[:frame_length]
+        self._out[..., :frame_length] += weight * frame
+        self._sum_weight[:frame_length] += weight
+        return self._pop(min(self.stride, self._out.shape[-1]))
+
+    def flush(self) -> torch.Tensor:
+        """Returns the remaining output, call once all the frames were pushed."""
+        assert self._out is not None, "No frame was pushed."
+        return self._pop(self._out.shape[-1])
+
+    def _pop(self, length: int) -> torch.Tensor:
+        assert self._out is not None and self._sum_weight is not None
+        sum_weight = self._sum_weight[:length]
+        assert length == 0 or sum_weight.min() > 0
+        out = self._out[..., :length] / sum_weight
+        self._out = self._out[..., length:]
+        self._sum_weight = self._sum_weight[length:]
+        return out
+
+
 def _get_checkpoint_url(root_url: str, checkpoint: str):
     if not root_url.endswith('/'):
         root_url += '/'
@@ -101,3 +147,28 @@ def save_audio(wav: torch.Tensor, path: tp.Union[Path, str],
     else:
         wav = wav.clamp(-limit, limit)
     torchaudio.save(str(path), wav, sample_rate=sample_rate, encoding='PCM_S', bits_per_sample=16)
+
+
+def save_audio_stream(chunks: tp.Iterable[torch.Tensor], path: tp.Union[Path, str],
+                      sample_rate: int) -> float:
+    """Streaming version of `save_audio`, writing the chunks of shape `[C, T_i]`
+    one after the other as 16 bits PCM. As the global maximum is not known in advance,
+    rescaling is not supported and the audio is clamped instead.
+    Returns the maximum absolute value of the audio, before clamping.
+    """
+    limit = 0.99
+    mx = 0.
+    with wave.open(str(path), 'wb') as out:
+        out.setsampwidth(2)
+        out.setframerate(sample_rate)
+        channels_set = False
+        for chunk in chunks:
+            if not channels_set:
+                out.setnchannels(chunk.shape[0])
+                channels_set = True
+            mx = max(mx, chunk.abs().max().item())
+            pcm = (chunk.clamp(-limit, limit) * 2 ** 15).to(torch.int16)
+            out.writeframes(pcm.t().contiguous().cpu().numpy().astype('<i2').tobytes())
+        if not channels_set:
+            out.setnchannels(1)
+    return mx
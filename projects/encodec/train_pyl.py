@@ -20,6 +20,7 @@ import torch.distributed as dist
 import hydra  
 import random
 from my_imp import EncodecModel
+from audio_cache import CachedAudioDataset
 import librosa
 import pandas as pd
 
@@ -143,13 +144,19 @@ class CustomAudioDataset(torch.utils.data.Dataset):
         if self.transform:
             waveform = self.transform(waveform)
 
-        if self.tensor_cut > 0:
-            if waveform.size()[1] > self.tensor_cut:
-                start = random.randint(0, waveform.size()[1]-self.tensor_cut-1) # random start point
-                waveform = waveform[:, start:start+self.tensor_cut] # cut tensor
-                return waveform, sample_rate
-            else:
-                return waveform, sample_rate
+        if self.tensor_cut > 0 and waveform.size()[1] > self.tensor_cut:
+            start = random.randint(0, waveform.size()[1]-self.tensor_cut-1) # random start point
+            waveform = waveform[:, start:start+self.tensor_cut] # cut tensor
+        return waveform, sample_rate
+
+
+def build_dataset(config, mode='train'):
+    # use the resampled shards of `audio_cache.py` when available, see `CachedAudioDataset`
+    cache_dir = config.datasets.get(f'{mode}_cache_dir')
+    if cache_dir:
+        return CachedAudioDataset(cache_dir, config.datasets.tensor_cut, config.datasets.fixed_length,
+                                  sample_rate=config.model.sample_rate, channels=config.model.channels)
+    return CustomAudioDataset(config=config, mode=mode)
 
 
 def pad_sequence(batch):
@@ -178,8 +185,8 @@ def main(config):
 
 
      # set train dataset
-    trainset = CustomAudioDataset(config=config)
-    testset = CustomAudioDataset(config=config,mode='test')
+    trainset = build_dataset(config)
+    testset = build_dataset(config, mode='test')
     
     train_sampler, test_sampler = None, None
 
@@ -0,0 +1,138 @@
+import time
+import argparse
+
+import torch
+
+from meshgpt_pytorch import (
+    MeshAutoencoder,
+    MeshTransformer
+)
+
+from meshgpt_pytorch.data import (
+    derive_face_edges_from_faces,
+    derive_face_edges_from_faces_dense
+)
+
+# helper functions
+
+def timed(fn, *args, repeats = 3, **kwargs):
+    best = float('inf')
+
+    for _ in range(repeats):
+        start = time.perf_counter()
+        out = fn(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+
+    return out, best
+
+def grid_mesh_faces(num_faces, shuffle = True):
+    # triangulated square grid with at least `num_faces` faces, like a dense scanned surface
+
+    side = int((num_faces / 2) ** 0.5) + 1
+    ids = torch.arange((side + 1) ** 2).view(side + 1, side + 1)
+
+    top_left, top_right = ids[:-1, :-1].flatten(), ids[:-1, 1:].flatten()
+    bottom_left, bottom_right = ids[1:, :-1].flatten(), ids[1:, 1:].flatten()
+
+    faces = torch.cat((
+        torch.stack((top_left, top_right, bottom_left), dim = -1),
+        torch.stack((top_right, bottom_right, bottom_left), dim = -1)
+    ))[:num_faces]
+
+    if shuffle:
+        faces = faces[torch.randperm(len(faces))]
+
+    return faces
+
+def fan_mesh_faces(num_faces, shuffle = True):
+    # cone, every face shares the apex (vertex 0), like the fan triangulation of a large polygon or cap
+
+    rim = torch.arange(1, num_faces + 1)
+    faces = torch.stack((torch.zeros_like(rim), rim, rim % num_faces + 1), dim = -1)
+
+    if shuffle:
+        faces = faces[torch.randperm(len(faces))]
+
+    return faces
+
+# benchmarks
+
+def check_degenerate_faces(num_meshes = 200, max_faces = 12, num_vertices = 6, device = 'cpu'):
+    # small random meshes, many faces repeat a vertex (as after quantization), checked in every mode
+
+    for _ in range(num_meshes):
+        faces = torch.randint(0, num_vertices, (2, int(torch.randint(1, max_faces, ())), 3), device = device)
+        faces[-1, faces.shape[1] // 2:] = -1
+
+        for neighbor_if_share_one_vertex in (False, True):
+            for include_self in (True, False):
+                kwargs = dict(neighbor_if_share_one_vertex = neighbor_if_share_one_vertex, include_self = include_self)
+                assert torch.equal(derive_face_edges_from_faces(faces, **kwargs), derive_face_edges_from_faces_dense(faces, **kwargs))
+
+def bench_face_edges(face_counts, batch_size = 2, max_dense_faces = 5000, device = 'cpu'):
+    check_degenerate_faces(device = device)
+    print('face edges derivation, sparse (edge join) vs dense (all pairs)')
+
+    for mesh_name, mesh_faces in (('grid', grid_mesh_faces), ('fan', fan_mesh_faces)):
+        for num_faces in face_counts:
+            faces = torch.stack([mesh_faces(num_faces) for _ in range(batch_size)]).to(device)
+            faces[-1, num_faces // 2:] = -1 # padded mesh in the batch
+
+            edges, sparse_time = timed(derive_face_edges_from_faces, faces)
+            line = f'{mesh_name:>4} {num_faces:>7d} faces | sparse {sparse_time * 1000:9.1f} ms'
+
+            if num_faces <= max_dense_faces:
+                dense_edges, dense_time = timed(derive_face_edges_from_faces_dense, faces, repeats = 1)
+                assert torch.equal(edges, dense_edges)
+                line += f' | dense {dense_time * 1000:9.1f} ms | speedup {dense_time / sparse_time:6.1f}x'
+
+            print(line)
+
+def bench_generation(batch_size = 4, max_seq_len = 288, condition_on_text = False, cond_scale = 3., device = 'cpu'):
+    # tiny transformer, the text conditioned version still instantiates the t5 conditioner, though random text embeddings are used
+
+    print(f'mesh transformer generation, batch size {batch_size}, {max_seq_len} codes, text condition {condition_on_text}')
+
+    autoencoder = MeshAutoencoder(dim = 64, codebook_size = 256, num_discrete_coors = 128)
+
+    transformer = MeshTransformer(
+        autoencoder,
+        dim = 64,
+        max_seq_len = max_seq_len,
+        attn_depth = 2,
+        attn_heads = 4,
+        attn_dim_head = 16,
+        fine_attn_depth = 1,
+        flash_attn = False,
+        condition_on_text = condition_on_text
+    ).to(device)
+
+    generate_kwargs = dict(batch_size = batch_size, temperature = 0., return_codes = True)
+
+    if condition_on_text:
+        text_embeds = torch.randn(batch_size, 8, transformer.conditioner.dim_latent, device = device)
+        generate_kwargs = dict(text_embeds = text_embeds, cond_scale = cond_scale, temperature = 0., return_codes = True)
+
+    # the eos logit is pushed down so every row decodes the full length
+
+    with torch.no_grad():
+        transformer.to_logits.bias[-1] = -1e4
+
+    for cache_kv in (False, True):
+        codes, elapsed = timed(transformer.generate, cache_kv = cache_kv, repeats = 1, **generate_kwargs)
+        steps = codes[0].numel()
+        print(f'cache kv {str(cache_kv):>5} | {steps / elapsed:8.1f} steps/sec')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--face_counts', type = int, nargs = '+', default = [500, 1000, 2000, 5000, 20000, 100000])
+    parser.add_argument('--batch_size', type = int, default = 2)
+    parser.add_argument('--max_dense_faces', type = int, default = 5000)
+    parser.add_argument('--device', type = str, default = 'cpu')
+    parser.add_argument('--generate_seq_len', type = int, default = 288)
+    parser.add_argument('--condition_on_text', action = 'store_true')
+    parser.add_argument('--cond_scale', type = float, default = 3.)
+    args = parser.parse_args()
+
+    bench_face_edges(args.face_counts, args.batch_size, args.max_dense_faces, args.device)
+    bench_generation(args.batch_size, args.generate_seq_len, args.condition_on_text, args.cond_scale, args.device)
@@ -3,29 +3,12 @@ from torch.utils.data import Dataset, DataLoader
 from tqdm import tqdm
 import os
 
+from meshgpt_pytorch.mesh_cache import parse_obj
+
 def process_obj(obj_file):
-    # vertices
-    vertices = []
-    for v in obj_file.split('\n'):
-        if v.startswith('v '):
-            x,y,z = v.replace('v ','').strip().split(" ")
-            vertices.append([float(x),float(y),float(z)])
-
-    # meshes
-    meshes = []
-    shapes = obj_file.split('# Mesh ')[1:]
-    for shape in shapes:
-        mesh = []
-        for face in shape.split('\n'):
-            if not face.startswith('f '):
-                continue
-            face_str = face.replace('f ','').strip()
-            v1,v2,v3 = face_str.split(" ")
-            mesh.append([int(v1.split('/')[0])-1,int(v2.split('/')[0])-1,int(v3.split('/')[0])-1])
-        if len(mesh) > 0:
-            meshes.extend(mesh)
-
-    return vertices, meshes
+    # vertices and triangle faces, parsed with numpy instead of line by line
+    vertices, meshes = parse_obj(obj_file)
+    return vertices.tolist(), meshes.tolist()
 
 # obj_data = {"texts": "chair", "vertices": vertices, "faces": faces} 
 obj_data = []
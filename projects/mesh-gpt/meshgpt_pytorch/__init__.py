@@ -10,4 +10,10 @@ from meshgpt_pytorch.trainer import (
 
 from meshgpt_pytorch.data import (
     DatasetFromTransforms
-)
\ No newline at end of file
+)
+from meshgpt_pytorch.mesh_cache import (
+    MeshCacheDataset,
+    MeshCodesDataset,
+    build_mesh_cache,
+    cache_mesh_codes
+)
@@ -5,7 +5,7 @@ from torch import is_tensor
 from torch.utils.data import Dataset
 from torch.nn.utils.rnn import pad_sequence
 
-from einops import rearrange, reduce
+from einops import rearrange, repeat, reduce
 
 from beartype import beartype
 from beartype.typing import Tuple, Union, Optional, Callable, Dict
@@ -50,12 +50,116 @@ class DatasetFromTransforms(Dataset):
 
 # tensor helper functions
 
+def expand_ranges(starts, counts):
+    # (owner, position) for every position of the ranges [starts[k], starts[k] + counts[k])
+    owner = torch.arange(len(counts), device = counts.device).repeat_interleave(counts)
+    offsets = counts.cumsum(dim = 0) - counts
+    positions = starts[owner] + torch.arange(owner.shape[0], device = counts.device) - offsets[owner]
+    return owner, positions
+
+def join_on_keys(query_keys, target_keys):
+    # all (query index, target index) with equal keys, target_keys sorted
+    starts = torch.searchsorted(target_keys, query_keys)
+    ends = torch.searchsorted(target_keys, query_keys, right = True)
+    return expand_ranges(starts, ends - starts)
+
 def derive_face_edges_from_faces(
     faces: TensorType['b', 'nf', 3, int],
     pad_id = -1,
     neighbor_if_share_one_vertex = False,
     include_self = True
 ) -> TensorType['b', 'e', 2, int]:
+    """
+    sparse version of the dense all pairs comparison (kept as `derive_face_edges_from_faces_dense`), with the same output
+    candidate face pairs come from a join of the faces on their edges (sorted distinct vertex pairs), so the work is
+    O(#edges) and does not grow with the valence of fan vertices, for the whole padded batch at once
+    like the dense version, face i counts the vertex slots of face i found in face j, so a vertex repeated in a degenerate
+    face (e.g. from quantization) counts as often as it appears in face i, and the pairs need not be symmetric. such a face
+    reaches the threshold of 2 with a single shared vertex, its repeated vertices are joined with the faces around them
+    with `neighbor_if_share_one_vertex`, every shared vertex makes a neighbor, so all the faces are joined on their vertices
+    """
+
+    is_one_face, device = faces.ndim == 2, faces.device
+
+    if is_one_face:
+        faces = rearrange(faces, 'nf c -> 1 nf c')
+
+    batch, max_num_faces = faces.shape[:2]
+    num_vertices = max(int(faces.amax().item()) + 1, 1) if faces.numel() > 0 else 1
+    face_edges_vertices_threshold = 1 if neighbor_if_share_one_vertex else 2
+
+    face_masks = reduce(faces != pad_id, 'b nf c -> b nf', 'all')
+
+    # distinct vertices of each face and the number of slots they fill, made unique across the batch
+
+    sorted_faces = faces.sort(dim = -1).values
+    multiplicity = (rearrange(sorted_faces, '... c -> ... c 1') == rearrange(sorted_faces, '... c -> ... 1 c')).sum(dim = -1)
+    is_first = torch.ones_like(sorted_faces, dtype = torch.bool)
+    is_first[..., 1:] = sorted_faces[..., 1:] != sorted_faces[..., :-1]
+    is_first &= rearrange(face_masks, 'b nf -> b nf 1')
+
+    batch_offsets = rearrange(torch.arange(batch, device = device), 'b -> b 1 1') * num_vertices
+    face_ids = repeat(torch.arange(batch * max_num_faces, device = device), '(b nf) -> b nf c', b = batch, c = 3)
+
+    # 1. faces sharing an edge, each face emits its distinct edges (u < w)
+
+    slot_pairs = torch.tensor([[0, 1], [0, 2], [1, 2]], device = device)
+    edge_mask = is_first[..., slot_pairs[:, 0]] & is_first[..., slot_pairs[:, 1]]
+    edge_keys = ((sorted_faces[..., slot_pairs[:, 0]] + batch_offsets) * num_vertices + sorted_faces[..., slot_pairs[:, 1]])[edge_mask]
+    edge_faces = face_ids[edge_mask]
+
+    edge_keys, sort_indices = edge_keys.sort()
+    edge_faces = edge_faces[sort_indices]
+    left, right = join_on_keys(edge_keys, edge_keys)
+    candidates = [(edge_faces[left], edge_faces[right])]
+
+    # 2. faces sharing a single vertex, only needed for the vertices filling several slots of a degenerate face,
+    # or for all the vertices with `neighbor_if_share_one_vertex`
+
+    vertex_keys = (sorted_faces + batch_offsets)[is_first]
+    vertex_faces = face_ids[is_first]
+    is_query = multiplicity[is_first] >= face_edges_vertices_threshold
+
+    vertex_keys, sort_indices = vertex_keys.sort()
+    vertex_faces, is_query = vertex_faces[sort_indices], is_query[sort_indices]
+    left, right = join_on_keys(vertex_keys[is_query], vertex_keys)
+    candidates.append((vertex_faces[is_query][left], vertex_faces[right]))
+
+    # number of slots of face i found in face j for the candidate pairs, pairs sorted as (batch, i, j) like the dense version
+
+    face_i, face_j = map(torch.cat, zip(*candidates))
+    pair_ids = torch.unique(face_i * max_num_faces + face_j % max(max_num_faces, 1))
+
+    flat_faces = rearrange(faces, 'b nf c -> (b nf) c')
+    face_i = pair_ids.div(max_num_faces, rounding_mode = 'floor')
+    face_j = face_i - face_i % max_num_faces + pair_ids % max_num_faces
+    shared_vertices = rearrange(flat_faces[face_i], 'p c -> p c 1') == rearrange(flat_faces[face_j], 'p c -> p 1 c')
+    num_shared_vertices = shared_vertices.any(dim = -1).sum(dim = -1)
+
+    is_neighbor_face = num_shared_vertices >= face_edges_vertices_threshold
+
+    if not include_self:
+        is_neighbor_face &= num_shared_vertices != 3
+
+    pair_ids = pair_ids[is_neighbor_face]
+
+    pair_batch, pair_ids = pair_ids.div(max_num_faces ** 2, rounding_mode = 'floor'), pair_ids % (max_num_faces ** 2)
+    face_edges = torch.stack((pair_ids.div(max_num_faces, rounding_mode = 'floor'), pair_ids % max_num_faces), dim = -1)
+
+    num_edges_per_batch = torch.bincount(pair_batch, minlength = batch).tolist()
+    face_edges = pad_sequence(face_edges.split(num_edges_per_batch), padding_value = pad_id, batch_first = True)
+
+    if is_one_face:
+        face_edges = rearrange(face_edges, '1 e ij -> e ij')
+
+    return face_edges
+
+def derive_face_edges_from_faces_dense(
+    faces: TensorType['b', 'nf', 3, int],
+    pad_id = -1,
+    neighbor_if_share_one_vertex = False,
+    include_self = True
+) -> TensorType['b', 'e', 2, int]:
 
     is_one_face, device = faces.ndim == 2, faces.device
 
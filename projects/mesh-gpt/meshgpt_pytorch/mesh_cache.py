@@ -0,0 +1,311 @@
+import re
+import json
+import hashlib
+from pathlib import Path
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import torch
+from torch.utils.data import Dataset, DataLoader
+
+from beartype import beartype
+from beartype.typing import Optional, List
+
+from tqdm import tqdm
+
+from meshgpt_pytorch.data import (
+    derive_face_edges_from_faces,
+    custom_collate
+)
+
+# offline preprocessing of a folder of meshes, in two stages
+# 1. obj files -> flat vertex / face / face edge arrays, so the autoencoder no longer parses text or derives edges every step
+# 2. mesh arrays -> residual vq codes of a given autoencoder, so the transformer trains directly on the code sequences
+
+MANIFEST_NAME = 'manifest.json'
+INDEX_NAME = 'index.npy'
+
+MESH_ARRAYS = dict(
+    vertices = (np.float32, 3),
+    faces = (np.int64, 3),
+    face_edges = (np.int64, 2)
+)
+
+CODES_NAME = 'codes.bin'
+CODES_DTYPE = np.int32
+
+FACE_VERTEX_INDEX = re.compile(rb'/\S*')
+
+# helper functions
+
+def exists(v):
+    return v is not None
+
+def bin_path(folder, name):
+    return Path(folder) / f'{name}.bin'
+
+# vectorized obj parsing
+
+def parse_obj(text):
+    # only the vertex and face lines are kept, the numbers themselves are parsed by numpy in one go
+    # only the vertex index of each `v/vt/vn` triplet is kept, quads and other polygons are fan triangulated
+
+    if isinstance(text, str):
+        text = text.encode()
+
+    lines = text.splitlines()
+
+    vertex_lines = [line[2:] for line in lines if line.startswith(b'v ')]
+    face_lines = [FACE_VERTEX_INDEX.sub(b'', line[2:]).split() for line in lines if line.startswith(b'f ')]
+
+    vertices = np.loadtxt(vertex_lines, dtype = np.float32, usecols = (0, 1, 2), ndmin = 2).reshape(-1, 3)
+
+    # flat vertex indices of all the polygons, with the number of corners of each
+
+    corners = np.array([len(line) for line in face_lines], dtype = np.int64)
+    assert (corners >= 3).all(), 'faces need at least 3 vertices'
+
+    indices = np.array([index for line in face_lines for index in line], dtype = np.int64)
+
+    # polygon (v0, v1, ..., vn-1) -> triangles (v0, vi, vi+1) for i in 1 .. n-2
+
+    starts = np.cumsum(corners) - corners
+    num_tris = corners - 2
+
+    tri_starts = np.repeat(starts, num_tris)
+    tri_offsets = np.arange(num_tris.sum()) - np.repeat(np.cumsum(num_tris) - num_tris, num_tris) + 1
+
+    faces = np.stack((indices[tri_starts], indices[tri_starts + tri_offsets], indices[tri_starts + tri_offsets + 1]), axis = -1)
+
+    # obj indices are 1-based, negative indices are relative to the vertices read so far (here, the end)
+
+    faces = np.where(faces < 0, faces + len(vertices), faces - 1)
+
+    return vertices, faces
+
+def load_obj(path):
+    return parse_obj(Path(path).read_bytes())
+
+def process_mesh(path):
+    vertices, faces = load_obj(path)
+
+    face_edges = derive_face_edges_from_faces(torch.from_numpy(faces))
+
+    return dict(
+        vertices = vertices,
+        faces = faces,
+        face_edges = face_edges.numpy()
+    )
+
+# stage 1 - meshes
+
+@beartype
+def build_mesh_cache(
+    folder: str,
+    cache_dir: str,
+    ext: str = 'obj',
+    num_workers: int = 8,
+    max_faces: Optional[int] = None
+):
+    folder, cache_dir = Path(folder), Path(cache_dir)
+    cache_dir.mkdir(exist_ok = True, parents = True)
+
+    paths = sorted(folder.glob(f'**/*.{ext}'))
+    assert len(paths) > 0, f'no .{ext} files found at {folder}'
+
+    files = {name: open(bin_path(cache_dir, name), 'wb') for name in MESH_ARRAYS.keys()}
+    offsets = {name: 0 for name in MESH_ARRAYS.keys()}
+
+    index = []
+    sources = []
+
+    with ProcessPoolExecutor(num_workers) as pool:
+        for path, mesh in tqdm(zip(paths, pool.map(process_mesh, paths, chunksize = 8)), total = len(paths)):
+
+            num_faces = len(mesh['faces'])
+
+            if num_faces == 0 or (exists(max_faces) and num_faces > max_faces):
+                continue
+
+            row = []
+
+            for name, (dtype, _) in MESH_ARRAYS.items():
+                arr = mesh[name]
+                files[name].write(arr.astype(dtype).tobytes())
+
+                row.extend((offsets[name], len(arr)))
+                offsets[name] += len(arr)
+
+            index.append(row)
+            sources.append(str(path.relative_to(folder)))
+
+    for f in files.values():
+        f.close()
+
+    np.save(cache_dir / INDEX_NAME, np.array(index, dtype = np.int64).reshape(-1, 2 * len(MESH_ARRAYS)))
+
+    manifest = dict(
+        folder = str(folder),
+        sources = sources
+    )
+
+    (cache_dir / MANIFEST_NAME).write_text(json.dumps(manifest))
+
+    print(f'{len(index)} / {len(paths)} meshes cached at {cache_dir}')
+
+class MeshCacheDataset(Dataset):
+    # memmapped meshes from `build_mesh_cache`, returns the same dictionary as the autoencoder forward expects
+
+    def __init__(
+        self,
+        cache_dir: str,
+        data_kwargs: List[str] = ['vertices', 'faces', 'face_edges']
+    ):
+        self.cache_dir = Path(cache_dir)
+        self.index = np.load(self.cache_dir / INDEX_NAME)
+        self.manifest = json.loads((self.cache_dir / MANIFEST_NAME).read_text())
+        self.data_kwargs = data_kwargs
+
+        # memmaps are opened lazily, so that each dataloader worker opens its own
+
+        self.arrays = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def open(self):
+        self.arrays = dict()
+
+        for name, (dtype, dim) in MESH_ARRAYS.items():
+            path = bin_path(self.cache_dir, name)
+            self.arrays[name] = np.memmap(path, dtype = dtype, mode = 'r').reshape(-1, dim) if path.stat().st_size > 0 else np.zeros((0, dim), dtype = dtype)
+
+    def __getitem__(self, idx):
+        if not exists(self.arrays):
+            self.open()
+
+        row = self.index[idx]
+        data = dict()
+
+        for i, name in enumerate(MESH_ARRAYS.keys()):
+            if name not in self.data_kwargs:
+                continue
+
+            offset, length = row[2 * i], row[2 * i + 1]
+            data[name] = torch.from_numpy(np.array(self.arrays[name][offset:offset + length]))
+
+        return data
+
+# stage 2 - autoencoder codes
+
+@torch.no_grad()
+def autoencoder_checkpoint_hash(autoencoder):
+    # hash of all the parameters and buffers, so codes are recomputed whenever the autoencoder changes
+
+    hasher = hashlib.sha256()
+
+    for name, tensor in sorted(autoencoder.state_dict().items()):
+        hasher.update(name.encode())
+        hasher.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+
+    return hasher.hexdigest()[:16]
+
+@beartype
+def cache_mesh_codes(
+    autoencoder,
+    mesh_cache_dir: str,
+    batch_size: int = 16,
+    device: Optional[str] = None,
+    overwrite: bool = False
+) -> Path:
+    checkpoint_hash = autoencoder_checkpoint_hash(autoencoder)
+    codes_dir = Path(mesh_cache_dir) / f'codes-{checkpoint_hash}'
+
+    if (codes_dir / MANIFEST_NAME).exists() and not overwrite:
+        return codes_dir
+
+    codes_dir.mkdir(exist_ok = True, parents = True)
+
+    if exists(device):
+        autoencoder = autoencoder.to(device)
+
+    device = next(autoencoder.parameters()).device
+    pad_id = autoencoder.pad_id
+
+    dataset = MeshCacheDataset(mesh_cache_dir)
+
+    dl = DataLoader(
+        dataset,
+        batch_size = batch_size,
+        shuffle = False,
+        collate_fn = partial(custom_collate, pad_id = pad_id)
+    )
+
+    index = []
+    offset = 0
+
+    with open(codes_dir / CODES_NAME, 'wb') as f:
+        for batch in tqdm(dl):
+            batch = {k: v.to(device) for k, v in batch.items()}
+
+            codes = autoencoder.tokenize(**batch)
+
+            # padded faces come out at the end of each sequence as pad ids, strip them before saving
+
+            num_codes = (batch['faces'] != pad_id).all(dim = -1).sum(dim = -1) * 3 * codes.shape[-1]
+            codes = codes.flatten(1).cpu().numpy().astype(CODES_DTYPE)
+
+            for seq, length in zip(codes, num_codes.tolist()):
+                f.write(seq[:length].tobytes())
+                index.append((offset, length))
+                offset += length
+
+    np.save(codes_dir / INDEX_NAME, np.array(index, dtype = np.int64).reshape(-1, 2))
+
+    manifest = dict(
+        checkpoint_hash = checkpoint_hash,
+        num_quantizers = autoencoder.num_quantizers,
+        codebook_size = autoencoder.codebook_size,
+        sources = dataset.manifest['sources']
+    )
+
+    (codes_dir / MANIFEST_NAME).write_text(json.dumps(manifest))
+
+    return codes_dir
+
+class MeshCodesDataset(Dataset):
+    # memmapped code sequences from `cache_mesh_codes`, for training the transformer without the autoencoder in the loop
+
+    def __init__(self, codes_dir: str):
+        self.codes_dir = Path(codes_dir)
+        self.index = np.load(self.codes_dir / INDEX_NAME)
+        self.manifest = json.loads((self.codes_dir / MANIFEST_NAME).read_text())
+
+        self.codes = None
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        if not exists(self.codes):
+            self.codes = np.memmap(self.codes_dir / CODES_NAME, dtype = CODES_DTYPE, mode = 'r')
+
+        offset, length = self.index[idx]
+        codes = np.array(self.codes[offset:offset + length], dtype = np.int64)
+
+        return dict(codes = torch.from_numpy(codes))
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description = 'cache a folder of meshes as flat vertex, face and face edge arrays')
+    parser.add_argument('folder', type = str)
+    parser.add_argument('cache_dir', type = str)
+    parser.add_argument('--ext', type = str, default = 'obj')
+    parser.add_argument('--num_workers', type = int, default = 8)
+    parser.add_argument('--max_faces', type = int, default = None)
+    args = parser.parse_args()
+
+    build_mesh_cache(args.folder, args.cache_dir, args.ext, args.num_workers, args.max_faces)
@@ -1,5 +1,6 @@
 from pathlib import Path
 from functools import partial
+from dataclasses import is_dataclass, fields, replace
 from math import ceil, pi
 
 import torch
@@ -108,6 +109,26 @@ def pad_to_length(t, length, dim = -1, value = 0, right = True):
     padding = (0, remainder) if right else (remainder, 0)
     return pad_at_dim(t, padding, dim = dim, value = value)
 
+def select_cache_rows(cache, rows, batch):
+    # keep only the given batch rows of a nested decoding cache (tensors, lists, tuples, x-transformers dataclasses)
+    # the leading dimension of the tensors is either the batch, or the batch folded with another dimension, like (b d) for the gateloop states
+
+    if isinstance(cache, Tensor):
+        if cache.ndim == 0 or not divisible_by(cache.shape[0], batch):
+            return cache
+
+        rest_shape = cache.shape[1:]
+        cache = cache.reshape(batch, -1, *rest_shape)[rows]
+        return cache.reshape(-1, *rest_shape)
+
+    if isinstance(cache, (list, tuple)):
+        return type(cache)(select_cache_rows(c, rows, batch) for c in cache)
+
+    if is_dataclass(cache):
+        return replace(cache, **{f.name: select_cache_rows(getattr(cache, f.name), rows, batch) for f in fields(cache)})
+
+    return cache
+
 # continuous embed
 
 def ContinuousEmbed(dim_cont):
@@ -126,15 +147,35 @@ def derive_angle(x, y, eps = 1e-5):
     z = einsum('... d, ... d -> ...', l2norm(x), l2norm(y))
     return z.clip(-1 + eps, 1 - eps).arccos()
 
+def get_face_coords(
+    vertices: TensorType['b', 'nv', 3, float],
+    faces: TensorType['b', 'nf', 3, int]
+):
+    # look up the 3 vertices of each face in the flattened (b nv) vertex table
+    # rather than gathering from the vertices repeated for every face, which takes O(nf * nv) memory
+
+    batch, num_vertices, _ = vertices.shape
+
+    batch_offsets = torch.arange(batch, device = faces.device) * num_vertices
+    flat_faces = faces + rearrange(batch_offsets, 'b -> b 1 1')
+
+    flat_vertices = rearrange(vertices, 'b nv c -> (b nv) c')
+    face_coords = flat_vertices.index_select(0, flat_faces.flatten())
+
+    return rearrange(face_coords, '(b nf nv) c -> b nf nv c', b = batch, nv = 3)
+
 @torch.no_grad()
 def get_derived_face_features(
     face_coords: TensorType['b', 'nf', 3, 3, float]  # 3 vertices with 3 coordinates
 ):
-    shifted_face_coords = torch.cat((face_coords[:, :, -1:], face_coords[:, :, :-1]), dim = 2)
+    shifted_face_coords = torch.roll(face_coords, 1, dims = 2)
 
     angles  = derive_angle(face_coords, shifted_face_coords)
 
-    edge1, edge2, _ = (face_coords - shifted_face_coords).unbind(dim = 2)
+    # reuse the shifted buffer for the edges, face_coords - shifted_face_coords
+
+    edges = shifted_face_coords.neg_().add_(face_coords)
+    edge1, edge2, _ = edges.unbind(dim = 2)
 
     normals = l2norm(torch.cross(edge1, edge2, dim = -1))
     area = normals.norm(dim = -1, keepdim = True) * 0.5
@@ -157,11 +198,14 @@ def discretize(
     lo, hi = continuous_range
     assert hi > lo
 
-    t = (t - lo) / (hi - lo)
+    # single copy of the input, the rest of the arithmetic is done in place
+
+    t = t - lo
+    t /= hi - lo
     t *= num_discrete
     t -= 0.5
 
-    return t.round().long().clamp(min = 0, max = num_discrete - 1)
+    return t.round_().long().clamp_(min = 0, max = num_discrete - 1)
 
 @beartype
 def undiscretize(
@@ -532,17 +576,11 @@ class MeshAutoencoder(Module):
         d - embed dim
         """
 
-        batch, num_vertices, num_coors, device = *vertices.shape, vertices.device
-        _, num_faces, _ = faces.shape
-
         face_without_pad = faces.masked_fill(~rearrange(face_mask, 'b nf -> b nf 1'), 0)
 
-        faces_vertices = repeat(face_without_pad, 'b nf nv -> b nf nv c', c = num_coors)
-        vertices = repeat(vertices, 'b nv c -> b nf nv c', nf = num_faces)
-
         # continuous face coords
 
-        face_coords = vertices.gather(-2, faces_vertices)
+        face_coords = get_face_coords(vertices, face_without_pad)
 
         # compute derived features and embed
 
@@ -1076,38 +1114,66 @@ class MeshTransformer(Module):
 
         batch_size = default(batch_size, 1)
 
-        codes = default(prompt, torch.empty((batch_size, 0), dtype = torch.long, device = self.device))
+        # sampled codes are written into a preallocated buffer, padded from the start
+
+        codes = torch.full((batch_size, self.max_seq_len), self.pad_id, dtype = torch.long, device = self.device)
+
+        curr_length = 0
+
+        if exists(prompt):
+            curr_length = prompt.shape[-1]
+            codes[:, :curr_length] = prompt
+
+        # with classifier free guidance, the conditional and null rows are decoded together as one batch of 2 * batch_size
+        # the null rows have their text masked out, like the conditioner does with a dropped condition, and each half keeps its own kv cache rows
 
-        curr_length = codes.shape[-1]
+        guided = self.condition_on_text and cond_scale != 1.
 
-        # for now, kv cache disabled when conditioning on text
+        context_mask = None
 
-        can_cache = cache_kv and (not self.condition_on_text or cond_scale == 1.)
+        if guided:
+            text_mask = (text_embeds != 0).any(dim = -1)
+            text_embeds = torch.cat((text_embeds, text_embeds))
+            context_mask = torch.cat((text_mask, torch.zeros_like(text_mask)))
+
+        # rows still decoding, finished rows are retired from the batch and the cache
+
+        active_rows = torch.arange(batch_size, device = self.device)
 
         cache = None
+        code_len = curr_length
 
         for i in tqdm(range(curr_length, self.max_seq_len)):
             # v1([q1] [q2] [q1] [q2] [q1] [q2]) v2([eos| q1] [q2] [q1] [q2] [q1] [q2]) -> 0 1 2 3 4 5 6 7 8 9 10 11 12 -> v1(F F F F F F) v2(T F F F F F) v3(T F F F F F)
 
             can_eos = i != 0 and divisible_by(i, self.num_quantizers * 3)  # only allow for eos to be decoded at the end of each face, defined as 3 vertices with D residual VQ codes
 
+            active_codes = codes[:, :i] if len(active_rows) == batch_size else codes[active_rows, :i]
+
+            if guided:
+                active_codes = torch.cat((active_codes, active_codes))
+
             output = self.forward_on_codes(
-                codes,
+                active_codes,
                 cache = cache,
                 text_embeds = text_embeds,
+                context_mask = context_mask,
                 return_loss = False,
-                return_cache = can_cache,
-                append_eos = False,
-                cond_scale = cond_scale
+                return_cache = cache_kv,
+                append_eos = False
             )
 
-            if can_cache:
+            if cache_kv:
                 logits, cache = output
             else:
                 logits = output
 
             logits = logits[:, -1]
 
+            if guided:
+                cond_logits, null_logits = logits.chunk(2)
+                logits = null_logits + (cond_logits - null_logits) * cond_scale
+
             if not can_eos:
                 logits[:, -1] = -torch.finfo(logits.dtype).max
 
@@ -1119,22 +1185,40 @@ class MeshTransformer(Module):
                 probs = F.softmax(filtered_logits / temperature, dim = -1)
                 sample = torch.multinomial(probs, 1)
 
-            codes, _ = pack([codes, sample], 'b *')
+            sample = rearrange(sample, '... -> (...)')
+
+            # rows that decoded [eos] are finished, the [eos] and everything after it is left as padding
 
-            # check for all rows to have [eos] to terminate
+            is_eos = sample == self.eos_token_id
 
-            is_eos_codes = (codes == self.eos_token_id)
+            codes[active_rows, i] = sample.masked_fill(is_eos, self.pad_id)
+            code_len = i + 1
 
-            if not is_eos_codes.any(dim = -1).all():
+            if not is_eos.any():
                 continue
 
-            mask = is_eos_codes.float().cumsum(dim = -1) >= 1
-            codes = codes.masked_fill(mask, self.pad_id)
-            break
+            keep = ~is_eos
+
+            if not keep.any():
+                break
+
+            active_rows = active_rows[keep]
+
+            if guided:
+                keep = torch.cat((keep, keep))
+
+            if exists(text_embeds):
+                text_embeds = text_embeds[keep]
+
+            if exists(context_mask):
+                context_mask = context_mask[keep]
+
+            cache = select_cache_rows(cache, keep, len(keep))
 
         # remove a potential extra token from eos, if breaked early
 
-        code_len = codes.shape[-1]
+        codes = codes[:, :code_len]
+
         round_down_code_len = code_len // self.num_quantizers * self.num_quantizers
         codes = codes[:, :round_down_code_len]
 
@@ -1156,17 +1240,23 @@ class MeshTransformer(Module):
     def forward(
         self,
         *,
-        vertices:       TensorType['b', 'nv', 3, int],
-        faces:          TensorType['b', 'nf', 3, int],
+        vertices:       Optional[TensorType['b', 'nv', 3, int]] = None,
+        faces:          Optional[TensorType['b', 'nf', 3, int]] = None,
         face_edges:     Optional[TensorType['b', 'e', 2, int]] = None,
+        codes:          Optional[TensorType['b', 'n', int]] = None,
         cache:          Optional[LayerIntermediates] = None,
         **kwargs
     ):
-        codes = self.autoencoder.tokenize(
-            vertices = vertices,
-            faces = faces,
-            face_edges = face_edges
-        )
+        # codes can be passed in directly, for training from the precomputed codes of `mesh_cache.cache_mesh_codes`
+
+        if not exists(codes):
+            assert exists(vertices) and exists(faces), 'either `codes` or the `vertices` and `faces` must be passed in'
+
+            codes = self.autoencoder.tokenize(
+                vertices = vertices,
+                faces = faces,
+                face_edges = face_edges
+            )
 
         return self.forward_on_codes(codes, cache = cache, **kwargs)
 
@@ -1180,6 +1270,7 @@ class MeshTransformer(Module):
         cache = None,
         texts: Optional[List[str]] = None,
         text_embeds: Optional[Tensor] = None,
+        context_mask: Optional[Tensor] = None,
         cond_drop_prob = 0.
     ):
         # handle text conditions
@@ -1200,9 +1291,11 @@ class MeshTransformer(Module):
                 cond_drop_prob = cond_drop_prob
             )
 
+            # an explicit context mask overrides the dropout mask, for batching conditional and null rows together
+
             attn_context_kwargs = dict(
                 context = maybe_dropped_text_embeds.embed,
-                context_mask = maybe_dropped_text_embeds.mask
+                context_mask = default(context_mask, maybe_dropped_text_embeds.mask)
             )
 
         # take care of codes that may be flattened
@@ -1,9 +1,194 @@
 import os
+import sys
+import json
+import hashlib
 import numpy as np
 import torch.nn.functional as F
 import matplotlib.pyplot as plt
 from modelzipper.tutils import *
 from argparse import ArgumentParser
+sys.path.append(os.getcwd())
+from custom_mamba.activation_trace import read_index, iter_trace
+
+
+##############################
+#### 0. streaming helpers ####
+##############################
+"""
+The traces of custom_mamba/activation_trace.py are read one record at a time from the memmapped
+shards, and every statistic is a small summary that can be merged across shards:
+RunningStats (per channel count / mean / M2 / min / max), IncrementalSVD (top singular values and
+right singular vectors) and blockwise cosine similarities. TraceAnalyzer caches the summary of every
+(layer, tensor, shard) on disk, re-running a plot only reads the shards that are new or changed.
+"""
+class RunningStats:
+    """per channel statistics of rows x channels blocks, merged with the parallel variance formula"""
+    def __init__(self, count=0, mean=None, m2=None, min=None, max=None):
+        self.count, self.mean, self.m2, self.min, self.max = count, mean, m2, min, max
+
+    def update(self, x):
+        x = torch.as_tensor(x).reshape(-1, x.shape[-1]).double()
+        if x.size(0) == 0:
+            return self
+        mean = x.mean(dim=0)
+        block = RunningStats(x.size(0), mean.numpy(), ((x - mean) ** 2).sum(dim=0).numpy(), x.min(dim=0).values.numpy(), x.max(dim=0).values.numpy())
+        return self.merge(block)
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2, self.min, self.max = other.count, other.mean, other.m2, other.min, other.max
+            return self
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * other.count / count
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / count
+        self.min, self.max = np.minimum(self.min, other.min), np.maximum(self.max, other.max)
+        self.count = count
+        return self
+
+    @property
+    def var(self):
+        return self.m2 / max(self.count - 1, 1)
+
+    def state_dict(self):
+        return dict(count=np.array(self.count), mean=self.mean, m2=self.m2, min=self.min, max=self.max)
+
+    @classmethod
+    def from_state_dict(cls, state):
+        return cls(int(state["count"]), state["mean"], state["m2"], state["min"], state["max"])
+
+
+class IncrementalSVD:
+    """
+    singular values / right singular vectors of all the rows seen so far, without keeping the rows:
+    the rows of a new block are stacked under diag(s) @ vt and re-decomposed, which is exact as long as
+    the rank stays <= k (k=None keeps the full spectrum, at most `channels` values)
+    """
+    def __init__(self, k=None, block_rows=4096, s=None, vt=None):
+        self.k, self.block_rows = k, block_rows
+        self.s, self.vt = s, vt
+
+    def update(self, x):
+        x = torch.as_tensor(x).reshape(-1, x.shape[-1]).double()
+        for start in range(0, x.size(0), self.block_rows):
+            block = x[start: start + self.block_rows]
+            if self.s is not None:
+                block = torch.cat([torch.from_numpy(self.s)[:, None] * torch.from_numpy(self.vt), block], dim=0)
+            _, s, vt = torch.linalg.svd(block, full_matrices=False)
+            if self.k is not None:
+                s, vt = s[:self.k], vt[:self.k]
+            self.s, self.vt = s.numpy(), vt.numpy()
+        return self
+
+    def merge(self, other):
+        if other.s is not None:
+            self.update(torch.from_numpy(other.s)[:, None] * torch.from_numpy(other.vt))
+        return self
+
+    def rank(self, tol=1e-10):
+        return 0 if self.s is None else int(np.sum(self.s > tol))
+
+    def state_dict(self):
+        return dict(s=self.s, vt=self.vt)
+
+    @classmethod
+    def from_state_dict(cls, state, k=None):
+        return cls(k=k, s=state["s"], vt=state["vt"])
+
+
+def blockwise_cosine(queries, keys, block_size=1024, out=None):
+    """
+    cosine similarity matrix queries x keys (n x d, m x d), `block_size` query rows at a time
+    out: optional array (e.g. np.memmap) of shape n x m written in place, allocated otherwise
+    """
+    keys = F.normalize(torch.as_tensor(keys).float(), dim=-1)
+    out = np.zeros((len(queries), keys.size(0)), dtype=np.float32) if out is None else out
+    for start in range(0, len(queries), block_size):
+        q = F.normalize(torch.as_tensor(queries[start: start + block_size]).float(), dim=-1)
+        out[start: start + q.size(0)] = (q @ keys.T).numpy()
+    return out
+
+
+def blockwise_cosine_topk(queries, keys, k, block_size=1024):
+    """top-k (values, indices) of every query row of the cosine matrix, without holding the full matrix"""
+    keys = F.normalize(torch.as_tensor(keys).float(), dim=-1)
+    values, indices = [], []
+    for start in range(0, len(queries), block_size):
+        q = F.normalize(torch.as_tensor(queries[start: start + block_size]).float(), dim=-1)
+        top = torch.topk(q @ keys.T, k=min(k, keys.size(0)), dim=-1)
+        values.append(top.values)
+        indices.append(top.indices)
+    return torch.cat(values).numpy(), torch.cat(indices).numpy()
+
+
+class TraceAnalyzer:
+    """
+    shard-wise analysis of an activation trace, results are cached in `cache_dir` per
+    (statistic, layer, tensor, shard, filters) and merged across the shards
+    """
+    def __init__(self, trace_dir, cache_dir=None):
+        self.trace_dir = trace_dir
+        self.cache_dir = cache_dir if cache_dir is not None else os.path.join(trace_dir, "analysis_cache")
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def shards(self, layer, name, **filters):
+        """shard id -> metadata of the matching records of this shard"""
+        groups = {}
+        for meta in read_index(self.trace_dir, layer=layer, name=name, **filters):
+            groups.setdefault(meta["shard"], []).append(meta)
+        return groups
+
+    def _cache_path(self, stat, layer, name, shard, metas, filters, params):
+        # the records of the shard are part of the key, a shard that got more records is recomputed
+        key = json.dumps([filters, params, len(metas), metas[-1]["offset"]], sort_keys=True, default=str)
+        digest = hashlib.sha1(key.encode()).hexdigest()[:12]
+        return os.path.join(self.cache_dir, f"{stat}-{name}-layer_{layer}-shard_{shard:05d}-{digest}.npz")
+
+    def per_shard(self, stat, compute, layer, name, params=None, **filters):
+        """yields compute(records of one shard) -> dict of arrays, loaded from the cache when possible"""
+        for shard, metas in sorted(self.shards(layer, name, **filters).items()):
+            path = self._cache_path(stat, layer, name, shard, metas, filters, params)
+            if os.path.exists(path):
+                with np.load(path) as f:
+                    yield dict(f)
+                continue
+            result = compute(iter_trace(self.trace_dir, metas=metas))
+            np.savez(path + ".tmp.npz", **result)
+            os.replace(path + ".tmp.npz", path)
+            yield result
+
+    def running_stats(self, layer, name, **filters):
+        def compute(records):
+            stats = RunningStats()
+            for _, x in records:
+                stats.update(x)
+            return stats.state_dict()
+        total = RunningStats()
+        for state in self.per_shard("stats", compute, layer, name, **filters):
+            total.merge(RunningStats.from_state_dict(state))
+        return total
+
+    def svd(self, layer, name, k=None, **filters):
+        def compute(records):
+            svd = IncrementalSVD(k=k)
+            for _, x in records:
+                svd.update(x)
+            return svd.state_dict()
+        total = IncrementalSVD(k=k)
+        for state in self.per_shard("svd", compute, layer, name, params=dict(k=k), **filters):
+            total.merge(IncrementalSVD.from_state_dict(state, k=k))
+        return total
+
+    def cosine_to_anchor(self, layer, name, anchor, **filters):
+        """cosine similarity of every traced token (in writing order) with `anchor` (d,)"""
+        anchor = torch.as_tensor(anchor).reshape(1, -1)
+        anchor_key = hashlib.sha1(anchor.float().numpy().tobytes()).hexdigest()[:12]
+        def compute(records):
+            sims = [blockwise_cosine(x.reshape(-1, x.shape[-1]), anchor)[:, 0] for _, x in records]
+            return dict(sims=np.concatenate(sims) if sims else np.zeros(0, dtype=np.float32))
+        return np.concatenate([r["sims"] for r in self.per_shard("cosine", compute, layer, name, params=dict(anchor=anchor_key), **filters)])
 
 ##############################
 ##### 1. analysis_rank  ######
@@ -19,15 +204,11 @@ class AnalysisRank:
         if hidden_states.dim() == 3:  # prevent batch size
             hidden_states = hidden_states.squeeze(0)
 
-        if isinstance(hidden_states, torch.Tensor):
-            hidden_states = hidden_states.float().cpu().numpy()
-        # SVD
-        import pdb; pdb.set_trace()
-        u, s, vh = np.linalg.svd(hidden_states)
+        # SVD, block by block
+        svd = IncrementalSVD().update(torch.as_tensor(hidden_states).float().cpu())
 
         # cal rank
-        rank = np.sum(s > 1e-10)
-        return rank
+        return svd.rank(tol=1e-10)
 
 
     def analysis_multi_hidden_states(self, dir):
@@ -42,6 +223,13 @@ class AnalysisRank:
             all_rks.append(rk)
         return all_rks
 
+    def analysis_trace(self, trace_dir, layer, name="conv_input", cache_dir=None, **filters):
+        """rank of each traced record (e.g. every generation step) and of all of them, streamed from the shards"""
+        analyzer = TraceAnalyzer(trace_dir, cache_dir)
+        all_rks = [IncrementalSVD().update(x.float()).rank() for _, x in iter_trace(trace_dir, layer=layer, name=name, **filters)]
+        total_rank = analyzer.svd(layer, name, **filters).rank()
+        return all_rks, total_rank
+
 
 ##############################
 #### 2. analysis_similar  ####
@@ -87,15 +275,10 @@ class AnalysisSimilar:
                     hidden_state = hidden_state.squeeze(0)
                 hidden_state = hidden_state.permute(1, 0)
                 
-                similarity_matrix = torch.zeros(hidden_state.size(0), embedding.size(0)).to(hidden_state.device)
-                
-                for i, h in enumerate(hidden_state):
-                    cos_sim = F.cosine_similarity(h.unsqueeze(0), embedding)
-                    similarity_matrix[i] = cos_sim
+                similarity_matrix_np = blockwise_cosine(hidden_state.cpu(), embedding.cpu())
                 
                 top_k = 20  # 取每个conv1d state的前20个最大值
 
-                similarity_matrix_np = similarity_matrix.cpu().numpy()
                 top_indices = np.argpartition(similarity_matrix_np, -10, axis=1)[:, -top_k:]  
 
                 # 统计每个区间出发的关键点
@@ -109,7 +292,7 @@ class AnalysisSimilar:
 
                 ### 划分每个区间 划分 5个区间
                 num_partitions = 5
-                partition_length = similarity_matrix.size(-1) // num_partitions  # 每个分区的长度
+                partition_length = similarity_matrix_np.shape[-1] // num_partitions  # 每个分区的长度
                 partition_scores = np.zeros((top_indices.shape[0], num_partitions))  # 存储每个分区的得分
 
                 # 对 top_indices 进行排序
@@ -221,12 +404,7 @@ class AnalysisSimilar:
                         if hidden_state.size(-1) != text_embedding.size(-1):
                             h_avg_pooled = F.avg_pool1d(hidden_state, kernel_size=2, stride=2)
 
-                        similarity_matrix = torch.zeros(4, 550).to(h_avg_pooled.device)
-                        for i, h in enumerate(h_avg_pooled):
-                            cos_sim = F.cosine_similarity(h.unsqueeze(0), text_embedding)
-                            similarity_matrix[i] = cos_sim
-                        
-                        similarity_matrix_np = similarity_matrix.cpu().numpy()
+                        similarity_matrix_np = blockwise_cosine(h_avg_pooled.cpu(), text_embedding.cpu())
                         top_indices = np.argpartition(similarity_matrix_np, -50, axis=1)[:, -50:]
                         
                         # 统计每个区间出发的关键点
@@ -239,7 +417,7 @@ class AnalysisSimilar:
 
                         ### 划分每个区间
                         num_partitions = 5
-                        partition_length = similarity_matrix.size(-1) // num_partitions  # 每个分区的长度
+                        partition_length = similarity_matrix_np.shape[-1] // num_partitions  # 每个分区的长度
                         partition_scores = np.zeros((top_indices.shape[0], num_partitions))  # 存储每个分区的得分
 
                         # 对 top_indices 进行排序
@@ -363,6 +541,35 @@ class ForgetAnalysis:
         ax.set_title(save_mark)
         ax.set_xlabel('Generation Step')
         ax.set_ylabel('Cosine Similarity')
+
+
+def forget_analysis_from_trace(trace_dir, save_root_dir, layers, name="conv_input", cache_dir=None, **filters):
+    """
+    same plot as ForgetAnalysis from an activation trace: cosine similarity of every generated token with
+    the last prompt token (the first record of the layer), streamed shard by shard
+    """
+    auto_mkdir(save_root_dir)
+    analyzer = TraceAnalyzer(trace_dir, cache_dir)
+    nrows = int(np.ceil(np.sqrt(len(layers))))
+    fig, axs = plt.subplots(nrows, nrows, figsize=(15, 15), squeeze=False)
+    fig.subplots_adjust(hspace=0.4, wspace=0.4)
+    for idx, layer in enumerate(layers):
+        ax = axs[idx // nrows, idx % nrows]
+        first = next(iter_trace(trace_dir, layer=layer, name=name, **filters), None)
+        if first is None:
+            ax.axis('off')
+            continue
+        anchor = first[1].reshape(-1, first[1].shape[-1])[-1]
+        cos_sim = np.abs(analyzer.cosine_to_anchor(layer, name, anchor, **filters))
+        ax.plot(cos_sim)
+        ax.set_title(f"{name}-layer_{layer}")
+        ax.set_xlabel('Generation Step')
+        ax.set_ylabel('Cosine Similarity')
+    for idx in range(len(layers), nrows * nrows):
+        axs[idx // nrows, idx % nrows].axis('off')
+    tag = "-".join(f"{k}_{v}" for k, v in sorted(filters.items()))
+    plt.savefig(os.path.join(save_root_dir, f"{name}-{tag}_all_layers.png"))
+    plt.close(fig)
         
 
 ##############################
@@ -401,12 +608,38 @@ if __name__ == "__main__":
     parser.add_argument("--tokenizer_name_or_path", "-tkp", type=str, default="/nvme/hf_models/EleutherAI/gpt-neox-20b")
     parser.add_argument("--analysis_task", "-at", type=str, default="low_rank")
     parser.add_argument("--save_dir", "-sd", type=str, default="low_rank")
+    parser.add_argument("--trace_dir", type=str, default=None, help="activation trace of custom_mamba/activation_trace.py, streamed instead of the pkl dumps")
+    parser.add_argument("--cache_dir", type=str, default=None, help="per (layer, shard) results, default trace_dir/analysis_cache")
+    parser.add_argument("--layers", type=int, nargs="+", default=[0, 11, 23, 35, 47])
+    parser.add_argument("--tensor", type=str, default="conv_input")
+    parser.add_argument("--ctx_length", type=int, default=None)
+    parser.add_argument("--depth", type=float, default=None)
     args = parser.parse_args() 
-    tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name_or_path)
 
     save_root_dir = os.path.join(args.save_dir, args.analysis_task)
+    trace_filters = {k: v for k, v in dict(ctx_length=args.ctx_length, depth=args.depth).items() if v is not None}
+
+    if args.trace_dir is not None and "forget" in args.analysis_task.lower():
+
+        log_c(f"begin to analysis forget from {args.trace_dir} ...\nsave results to {save_root_dir}", "yellow")
+        forget_analysis_from_trace(args.trace_dir, save_root_dir, args.layers, args.tensor, args.cache_dir, **trace_filters)
+
+    elif args.trace_dir is not None and "rank" in args.analysis_task.lower():
+
+        for layer in args.layers:
+            all_rks, total_rank = AnalysisRank().analysis_trace(args.trace_dir, layer, args.tensor, args.cache_dir, **trace_filters)
+            print_c(f"layer {layer}: rank of all steps {total_rank}, per step {all_rks}", "yellow")
+
+    elif args.trace_dir is not None and "stats" in args.analysis_task.lower():
+
+        analyzer = TraceAnalyzer(args.trace_dir, args.cache_dir)
+        for layer in args.layers:
+            stats = analyzer.running_stats(layer, args.tensor, **trace_filters)
+            if stats.count > 0:
+                print_c(f"layer {layer}: {stats.count} tokens | mean {stats.mean.mean():.4f} | std {np.sqrt(stats.var).mean():.4f} | min {stats.min.min():.4f} | max {stats.max.max():.4f}", "yellow")
 
-    if "passkey" in args.analysis_task.lower():
+    elif "passkey" in args.analysis_task.lower():
+        tokenizer = AutoTokenizer.from_pretrained(args.tokenizer_name_or_path)
 
         passkey = "The best thing to do in San Francisco is eat a sandwich and sit in Dolores Park on a sunny day."
         passkey_length = len(tokenizer(passkey)['input_ids'])
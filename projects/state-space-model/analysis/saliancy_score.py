@@ -12,6 +12,7 @@ from mamba_ssm.ops.selective_scan_interface import selective_scan_fn, mamba_inne
 from causal_conv1d import causal_conv1d_fn, causal_conv1d_update
 from mamba_ssm.ops.triton.selective_state_update import selective_state_update
 from custom_mamba.custom_mamba_v2 import CustomMambaForCausalLM
+from custom_mamba.activation_trace import TraceWriter
 from modelzipper.tutils import *
 
 
@@ -300,6 +301,102 @@ class Conv1dManager(Conv1dManagerBase):
         return conv1d_adapters
 
 
+class SaliencyAdapter(Conv1dAdapterBase):
+    """
+    keeps the tensor it is applied to, its saliency is tensor * grad, the same as the grad of
+    the ones multiplier of Conv1dAdapter without the extra tensors
+    """
+    def __init__(self) -> None:
+        super().__init__()
+        self.activation = None
+
+    def _forward(self, weights):
+        if not weights.requires_grad:  # frozen model, the tensor becomes a leaf of the graph
+            weights.requires_grad_(True)
+        self.activation = weights
+        return weights
+
+
+class SaliencyEngine:
+    """
+    token saliency of the conv1d adapters of all the layers for several target tokens, from one forward pass
+        score[layer][batch, target, token] = sum over channels of (activation * d loss_target / d activation)
+    the vector-Jacobian products of all the targets run as one batched backward (`is_grads_batched`, vmap),
+    with one backward per target if an op of the graph has no batching rule. vmap pays off on the GPU, on
+    the CPU the batched backward is compute bound and slower than the loop, so use_vmap=None uses it on cuda only.
+    The gradients are reduced to per-token scores right away, `layer_chunk` layers at a time (None for all
+    the layers in one backward): at most num_targets x layer_chunk activation gradients are alive, each chunk
+    goes through the backward again down to its lowest layer.
+    """
+    def __init__(self, model: PreTrainedModel, layer_chunk=None, use_abs=False, use_vmap=None):
+        self.model = model
+        self.layer_chunk = layer_chunk
+        self.use_abs = use_abs
+        self.use_vmap = use_vmap
+        self.adapters = []
+        for layer in self.model.backbone.layers:
+            adapter = SaliencyAdapter()
+            layer.mixer.cuda_kernels_forward = partial(cuda_kernels_forward, layer.mixer, adapter=adapter)
+            layer.mixer.slow_forward = partial(slow_forward, layer.mixer, adapter=adapter)
+            self.adapters.append(adapter)
+
+    def target_losses(self, input_ids, targets):
+        """cross entropy of each target token (position in input_ids) summed over the batch, the lm head only runs on the targets"""
+        hidden_states = self.model.backbone(input_ids=input_ids, use_cache=False)[0]
+        positions = torch.as_tensor(targets, device=input_ids.device)
+        logits = self.model.lm_head(hidden_states[:, positions - 1].to(self.model.lm_head.weight.dtype)).float()
+        losses = F.cross_entropy(logits.flatten(0, 1), input_ids[:, positions].flatten(), reduction="none")
+        return losses.view(input_ids.size(0), -1).sum(0)  # [num_targets], the rows do not interact
+
+    def vjp(self, losses, inputs):
+        """d losses[t] / d inputs for all the targets t, the gradients get a leading target dim"""
+        if self.use_vmap is None:
+            self.use_vmap = losses.is_cuda
+        if self.use_vmap:
+            try:
+                grad_outputs = torch.eye(losses.numel(), device=losses.device, dtype=losses.dtype)
+                return torch.autograd.grad((losses,), inputs, (grad_outputs,), retain_graph=True, is_grads_batched=True)
+            except (RuntimeError, NotImplementedError) as e:
+                log_c(f"batched backward not supported ({type(e).__name__}), one backward per target", "yellow")
+                self.use_vmap = False
+        grads = [torch.autograd.grad(losses[t], inputs, retain_graph=True) for t in range(losses.numel())]
+        return [torch.stack(grad) for grad in zip(*grads)]
+
+    def reduce(self, activation, grad):
+        # [num_targets, batch, channels, seq_len] -> [batch, num_targets, seq_len]
+        saliency = activation.unsqueeze(0) * grad
+        if self.use_abs:
+            saliency = saliency.abs()
+        return saliency.float().sum(2).transpose(0, 1)
+
+    def __call__(self, input_ids, targets):
+        """per-token scores of each layer, [batch, num_targets, seq_len]"""
+        losses = self.target_losses(input_ids, targets)
+        activations = [adapter.activation for adapter in self.adapters]
+        layer_chunk = len(activations) if self.layer_chunk is None else self.layer_chunk
+        scores = []
+        for start in range(0, len(activations), layer_chunk):
+            chunk = activations[start: start + layer_chunk]
+            grads = self.vjp(losses, chunk)
+            scores.extend(self.reduce(activation, grad) for activation, grad in zip(chunk, grads))
+            del grads
+        for adapter in self.adapters:  # frees the graph
+            adapter.activation = None
+        return scores
+
+
+def write_saliency(writer: TraceWriter, scores, targets, **tag):
+    """per-layer scores as records of the trace store (name "saliency"), see custom_mamba/activation_trace.py"""
+    targets = [int(t) for t in targets]
+    for layer, score in enumerate(scores):
+        score = score.detach().cpu().contiguous()
+        meta = dict(
+            tag, layer=layer, name="saliency", start=0, targets=targets,
+            shape=list(score.shape), dtype=str(score.dtype).replace("torch.", ""),
+        )
+        writer.put(meta, score)
+
+
 @hydra.main(config_path='../configs/platform', config_name='h800', version_base='1.1')
 def main(config):
     print_c(OmegaConf.to_yaml(config), "yellow")
@@ -316,8 +413,12 @@ def main(config):
     
     raw_data = auto_read_data(os.path.join(data_root_dir, "needle/processed_data/128k_500_insert_ids.pkl"))
     
-    conv1d_manger = Conv1dManager(model)
-    
+    # several target tokens per example, all the layers from one forward pass
+    engine = SaliencyEngine(model, layer_chunk=config.get("layer_chunk", None))
+    num_targets = config.get("num_targets", 1)
+    max_ctx_length = config.get("max_ctx_length", 16000)
+    writer = TraceWriter("/nvme/zecheng/evaluation/analysis/conv1d_saliency_trace")
+
     all_score = []
     model.eval()
 
@@ -326,7 +427,7 @@ def main(config):
         bos_pos, eos_pos = data['bos_pos'], data['eos_pos']
         ctx_length = data['before_insert_context_length']
         depth = data['depth']
-        if ctx_length > 4000:
+        if ctx_length > max_ctx_length:
             break
 
         log_c(f"processing context length: {ctx_length}, depth {depth}", "yellow")
@@ -335,25 +436,20 @@ def main(config):
 
         # token_ids = tokenizer(data['passkey_context'], return_tensors="pt").input_ids[0]
         input_ids = token_ids.to(model.device).unsqueeze(0)
-        conv1d_manger.zero_grad()
-        
-        output = model(input_ids=input_ids, extra_kwargs=None)
-        
-        label = input_ids[:, -1].long()
-        loss = F.cross_entropy(output[0][:, -2, :], label)
-       
-        loss.backward(retain_graph=True)
-
-        for i in range(len(conv1d_manger.conv1d_adapters)):
-            saliency = conv1d_manger.grad(use_abs=False)[i].squeeze()  # 4096, 532
-            import pdb; pdb.set_trace()
-            important_place_score = saliency[:, bos_pos: eos_pos].sum()
-            other_place_score = saliency[eos_pos:].sum()
+        targets = list(range(input_ids.size(1) - num_targets, input_ids.size(1)))  # the last tokens
+        scores = engine(input_ids, targets)
+        write_saliency(writer, scores, targets, ctx_length=ctx_length, depth=depth, sample_id=idx)
+
+        for i, saliency in enumerate(scores):
+            saliency = saliency[0]  # [num_targets, seq_len]
+            important_place_score = saliency[:, bos_pos: eos_pos].sum(-1)
+            other_place_score = saliency[:, eos_pos:].sum(-1)
             proportion = important_place_score / other_place_score  # the larger the better
-            per_ctx_length_score.append({"proportion": proportion, "depth": depth})
+            per_ctx_length_score.append({"proportion": proportion.tolist(), "depth": depth, "layer": i})
 
         all_score.append(per_ctx_length_score)
 
+    writer.close()
     auto_save_data(all_score, "/nvme/zecheng/evaluation/analysis/conv1d_adapter_score.pkl")
 
 
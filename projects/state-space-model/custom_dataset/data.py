@@ -9,8 +9,111 @@ import glob
 from datasets import load_dataset
 
 
+import os
+import hashlib
+import collections
+import numpy as np
+from torch.utils.data import Sampler
+
+
+def tokenize_with_cache(texts, tokenizer, max_length, cache_dir=None, chunk_size=10000):
+    """
+    tokenize all texts in a few batched calls (no padding), returns a list of id tensors
+    with `cache_dir`, the ids are saved keyed by the texts / tokenizer / max_length and loaded on the next run
+    """
+    cache_file = None
+    if cache_dir is not None:
+        hasher = hashlib.sha1()
+        for text in texts:
+            hasher.update(text.encode())
+            hasher.update(b"\0")
+        hasher.update(f"{tokenizer.name_or_path}|{len(tokenizer)}|{max_length}".encode())
+        cache_file = os.path.join(cache_dir, f"tokenized_{hasher.hexdigest()[:16]}.pt")
+        if os.path.exists(cache_file):
+            return torch.load(cache_file)
+
+    input_ids = []
+    for start in range(0, len(texts), chunk_size):
+        tokenized = tokenizer(texts[start: start + chunk_size], truncation=True, max_length=max_length)
+        input_ids.extend(torch.tensor(ids, dtype=torch.long) for ids in tokenized["input_ids"])
+
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        torch.save(input_ids, cache_file + ".tmp")
+        os.replace(cache_file + ".tmp", cache_file)
+    return input_ids
+
+
+class LengthGroupedSampler(Sampler):
+    """
+    shuffle, then sort each mega batch (batch_size * mega_batch_mult samples) by length,
+    so the samples of a batch have similar lengths and the dynamic padding stays small
+    """
+    def __init__(self, lengths, batch_size, mega_batch_mult=50, shuffle=True, seed=42):
+        self.lengths = np.asarray(lengths)
+        self.mega_batch_size = batch_size * mega_batch_mult
+        self.shuffle = shuffle
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def __iter__(self):
+        if self.shuffle:
+            indices = np.random.default_rng(self.seed + self.epoch).permutation(len(self.lengths))
+        else:
+            indices = np.arange(len(self.lengths))
+        self.epoch += 1
+        for start in range(0, len(indices), self.mega_batch_size):
+            mega_batch = indices[start: start + self.mega_batch_size]
+            yield from mega_batch[np.argsort(-self.lengths[mega_batch], kind="stable")].tolist()
+
+
+class PadCollator:
+    """
+    pad input_ids / attention_mask / labels to the longest sample of the batch, rounded up to `pad_to_multiple_of`
+    the ratio of real tokens to padded tokens of the last `report_every` batches is kept in `utilization`, and printed every `report_every` batches
+    """
+    def __init__(self, pad_token_id, pad_to_multiple_of=8, label_pad_token_id=-100, report_every=None):
+        self.pad_token_id = pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.label_pad_token_id = label_pad_token_id
+        self.report_every = report_every
+        self.utilization = collections.deque(maxlen=report_every or 100)
+        self.num_batches = 0
+
+    def pad(self, seqs, value, length):
+        out = torch.full((len(seqs), length), value, dtype=seqs[0].dtype)
+        for i, seq in enumerate(seqs):
+            out[i, :seq.size(0)] = seq
+        return out
+
+    def __call__(self, batch):
+        lengths = [item["input_ids"].size(0) for item in batch]
+        max_length = max(lengths)
+        if self.pad_to_multiple_of is not None:
+            max_length = (max_length + self.pad_to_multiple_of - 1) // self.pad_to_multiple_of * self.pad_to_multiple_of
+
+        input_ids = self.pad([item["input_ids"] for item in batch], self.pad_token_id, max_length)
+        res = {
+            "input_ids": input_ids,
+            "attention_mask": self.pad([item["attention_mask"] for item in batch], 0, max_length),
+            "labels": self.pad([item["labels"] for item in batch], self.label_pad_token_id, max_length),
+        }
+
+        self.utilization.append(sum(lengths) / input_ids.numel())
+        self.num_batches += 1
+        if self.report_every is not None and self.num_batches % self.report_every == 0:
+            print_c(f"token utilization of the last {self.report_every} batches: {sum(self.utilization) / len(self.utilization):.3f}", "yellow")
+        return res
+
+
 class AlpacaDataset(Dataset):
-    def __init__(self, content=None, tokenizer=None, split="train", full_modeling=True, max_seq_length=512, *args, **kwargs):
+    def __init__(self, content=None, tokenizer=None, split="train", full_modeling=True, max_seq_length=512, cache_dir=None, *args, **kwargs):
         super().__init__()
         self.split = split
         self.content = content
@@ -18,27 +121,20 @@ class AlpacaDataset(Dataset):
         self.tokenizer = tokenizer
         self.full_modeling = full_modeling
         self.template = "{instruction} {input} {output}"
-    
+
+        # tokenized once (unpadded), PadCollator pads each batch
+        prompts = [self.template.format(instruction=sample["instruction"], input=sample["input"], output=sample["output"]) for sample in self.content]
+        self.input_ids = tokenize_with_cache(prompts, tokenizer, self.max_text_length, cache_dir)
+
     def __len__(self):
         return len(self.content)
+
+    def lengths(self):
+        return [ids.size(0) for ids in self.input_ids]
     
     def __getitem__(self, index) -> Any:
-        sample = self.content[index]
-        instruction = sample["instruction"]
-        input_text = sample["input"]
-        output_text = sample["output"]
-        
-        prompt = self.template.format(instruction=instruction, input=input_text, output=output_text)
-        
-        tokenized_prompt = self.tokenizer(
-            prompt,  
-            truncation=True, 
-            padding="max_length",
-            max_length=self.max_text_length,
-            return_tensors="pt",
-        )
-        input_ids = tokenized_prompt.input_ids[0]
-        attention_mask = tokenized_prompt.attention_mask[0]
+        input_ids = self.input_ids[index]
+        attention_mask = torch.ones_like(input_ids)
         labels = torch.where(
             input_ids != self.tokenizer.pad_token_id, input_ids, -100
         )
@@ -92,15 +188,15 @@ class TextFillingDataset(Dataset):
             
             remain_length = self.max_text_length - prompt_ids.size(0)
             
+            # unpadded, PadCollator pads each batch
             tokenized_mid = self.tokenizer(
                 s4,  
                 truncation=True, 
-                padding="max_length",
                 max_length=remain_length,
                 return_tensors="pt",
             )
             label_ids = tokenized_mid.input_ids[0]
-            label_attention_mask = tokenized_prompt.attention_mask[0]
+            label_attention_mask = tokenized_mid.attention_mask[0]
             label_sentinel = label_ids
             
             input_ids = torch.concatenate([prompt_ids, label_ids], dim=0)
@@ -117,7 +213,6 @@ class TextFillingDataset(Dataset):
             tokenized_prompt = self.tokenizer(
                 prompt,  
                 truncation=True, 
-                padding="max_length",
                 max_length=self.max_text_length,
                 return_tensors="pt",
             )
@@ -136,6 +231,74 @@ class TextFillingDataset(Dataset):
 
     def __len__(self):
         return len(self.content)
+
+
+class custom_datamodule(pl.LightningDataModule):
+    """ROCStories text filling, the unpadded train / valid samples are padded per batch by PadCollator"""
+    def __init__(self, cfg, tokenizer):
+        super().__init__()
+        self.cfg = cfg
+        self.tokenizer = tokenizer
+        self.prepare_data_per_node = True
+        self.dataset_kwargs = {
+            "max_text_length": self.cfg.max_seq_length,
+        }
+
+    def setup(self, stage: str = 'fit') -> None:
+        self.test_dataset = None
+        if self.cfg.inference_mode:
+            self.test_data = auto_read_data(self.cfg.test_data_path)
+            self.test_dataset = TextFillingDataset(
+                content=self.test_data, 
+                tokenizer=self.tokenizer, 
+                full_modeling=False,
+                split="test",
+                **self.dataset_kwargs,
+            )
+        else:
+            content = auto_read_data(self.cfg.file_path)
+            min_valid_num = int(min(1000, len(content) * 0.1))
+            self.valid_data = content[:min_valid_num]
+            self.train_data = content[min_valid_num:]
+            
+            self.train_dataset = TextFillingDataset(
+                content=self.train_data, 
+                tokenizer=self.tokenizer, 
+                split="train",
+                **self.dataset_kwargs,
+            )
+            
+            self.valid_dataset = TextFillingDataset(
+                content=self.valid_data, 
+                tokenizer=self.tokenizer, 
+                split="valid",
+                **self.dataset_kwargs,
+            )
+            print_c(f"num of train samples: {len(self.train_dataset)}", color='magenta')
+            print_c(f"num of valid samples: {len(self.valid_dataset)}", color='magenta')
+
+    def train_dataloader(self) -> TRAIN_DATALOADERS:
+        return DataLoader(
+            self.train_dataset, batch_size=self.cfg.train_batch_size, 
+            num_workers=self.cfg.nworkers, pin_memory=self.cfg.pin_memory, drop_last=True, shuffle=True, 
+            collate_fn=PadCollator(self.tokenizer.pad_token_id, report_every=100),
+        )
+    
+    def val_dataloader(self) -> EVAL_DATALOADERS:
+        return DataLoader(
+            self.valid_dataset, batch_size=self.cfg.val_batch_size, 
+            num_workers=self.cfg.nworkers, pin_memory=self.cfg.pin_memory, drop_last=False, shuffle=False,
+            collate_fn=PadCollator(self.tokenizer.pad_token_id),
+        )
+    
+    def predict_dataloader(self) -> EVAL_DATALOADERS:
+        # one prompt per batch, the test samples have no attention mask to pad
+        if self.test_dataset is not None:
+            return DataLoader(
+                self.test_dataset, batch_size=1, 
+                num_workers=self.cfg.nworkers, pin_memory=self.cfg.pin_memory, drop_last=False, shuffle=False,
+            )
+        return None
     
 
 class AlpacaData(pl.LightningDataModule):
@@ -159,6 +322,7 @@ class AlpacaData(pl.LightningDataModule):
                 split="train",
                 full_modeling=True,
                 max_seq_length=self.max_seq_length,
+                cache_dir=self.cfg.get("cache_dir", None),
             )
             print_c(f"num of train samples: {len(self.train_dataset)}", color='magenta')
       
@@ -168,7 +332,9 @@ class AlpacaData(pl.LightningDataModule):
             batch_size=self.cfg.train_batch_size, 
             num_workers=self.cfg.nworkers, 
             pin_memory=self.cfg.pin_memory, 
-            drop_last=True, shuffle=True, 
+            drop_last=True, 
+            sampler=LengthGroupedSampler(self.train_dataset.lengths(), self.cfg.train_batch_size),
+            collate_fn=PadCollator(self.tokenizer.pad_token_id, report_every=100),
         )
 
  
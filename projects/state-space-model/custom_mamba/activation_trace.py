@@ -0,0 +1,234 @@
+"""
+Forward-hook activation tracer for the (custom) Mamba mixers, replaces the pkl dumps inside the forward pass
+
+    save_dir/
+        shard_00000.bin     raw bytes of the traced tensors, appended one after another
+        index.jsonl         one line per traced tensor: tag, layer, name, start token, shape, dtype, shard, offset
+
+Hooks only copy the selected slice (optionally downcast) to pinned memory without blocking the GPU,
+a background thread waits for the copy and appends it to the shards. Nothing is registered
+unless the tracer is attached, so a model without tracer runs exactly as before.
+
+    with ActivationTracer(save_dir, layers=[0, 11, 23, 35, 47], tensors=["conv_input"], dtype=torch.float16).attach(model) as tracer:
+        for batch in dataloader:
+            tracer.set_tag(ctx_length=..., depth=...)
+            model.generate(...)
+
+    records = load_trace(save_dir, layer=0, name="conv_input", depth=0.05)  # [(meta, tensor), ...]
+
+tensors (all batch x tokens x channels):
+    mixer_input     input of the mixer (residual stream after the norm)
+    conv_input      x branch of in_proj, before the causal conv1d
+    conv_output     after the conv1d and activation, the input of x_proj
+    mixer_output    output of out_proj
+"""
+import os
+import json
+import queue
+import threading
+from functools import partial
+
+import numpy as np
+import torch
+
+TRACE_TENSORS = ("mixer_input", "conv_input", "conv_output", "mixer_output")
+INDEX_NAME = "index.jsonl"
+
+
+def shard_name(shard_id):
+    return f"shard_{shard_id:05d}.bin"
+
+
+class TraceWriter:
+    """background thread appending tensors to the shards of `save_dir`, an existing trace is continued, never rewritten"""
+    def __init__(self, save_dir, shard_bytes=1 << 30, max_pending=256):
+        os.makedirs(save_dir, exist_ok=True)
+        self.save_dir = save_dir
+        self.shard_bytes = shard_bytes
+        self.queue = queue.Queue(maxsize=max_pending)  # bounded, a slow disk throttles the model instead of filling the RAM
+        self.shard_id = len([f for f in os.listdir(save_dir) if f.startswith("shard_") and f.endswith(".bin")])
+        self.shard = None
+        self.index = open(os.path.join(save_dir, INDEX_NAME), "a")
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def put(self, meta, tensor, event=None):
+        if self.error is not None:
+            raise RuntimeError("activation trace writer failed") from self.error
+        self.queue.put((meta, tensor, event))
+
+    def _write(self, meta, tensor, event):
+        if event is not None:  # the device -> pinned memory copy was queued without blocking
+            event.synchronize()
+        data = tensor.contiguous().view(-1).view(torch.uint8).numpy()
+        if self.shard is None or (self.shard.tell() > 0 and self.shard.tell() + data.nbytes > self.shard_bytes):
+            if self.shard is not None:
+                self.shard.close()
+                self.shard_id += 1
+            self.shard = open(os.path.join(self.save_dir, shard_name(self.shard_id)), "ab")
+        offset = self.shard.tell()
+        self.shard.write(data.tobytes())
+        self.shard.flush()
+        # the index line is written after the data, it never points to missing bytes
+        self.index.write(json.dumps(dict(meta, shard=self.shard_id, offset=offset, nbytes=int(data.nbytes))) + "\n")
+        self.index.flush()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is None:
+                try:
+                    self._write(*item)
+                except Exception as e:
+                    self.error = e
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.shard is not None:
+            self.shard.close()
+        self.index.close()
+        if self.error is not None:
+            raise RuntimeError("activation trace writer failed") from self.error
+
+
+class ActivationTracer:
+    """
+    Args:
+        save_dir: output directory, see the module docstring
+        layers: layer_idx of the mixers to trace, None for all
+        tensors: names in TRACE_TENSORS
+        token_range: (start, end) absolute token positions to keep (end None = open), None for all,
+            decoding steps are placed with `cache_params.seqlen_offset`
+        dtype: optional downcast (e.g. torch.float16) before the copy to host
+    """
+    def __init__(self, save_dir, layers=None, tensors=("conv_input",), token_range=None, dtype=None, shard_bytes=1 << 30, max_pending=256):
+        for name in tensors:
+            assert name in TRACE_TENSORS, f"unknown tensor {name}, choose from {TRACE_TENSORS}"
+        self.save_dir = save_dir
+        self.layers = None if layers is None else set(layers)
+        self.tensors = tuple(tensors)
+        self.token_range = token_range
+        self.dtype = dtype
+        self.shard_bytes = shard_bytes
+        self.max_pending = max_pending
+        self.writer = None
+        self.handles = []
+        self.offsets = {}  # layer_idx -> position of the first token of the current forward
+        self.tag = {}
+
+    def set_tag(self, **tag):
+        """metadata (e.g. ctx_length, depth) stored with every following record"""
+        self.tag = tag
+
+    def attach(self, model):
+        if self.writer is None:
+            self.writer = TraceWriter(self.save_dir, self.shard_bytes, self.max_pending)
+        for module in model.modules():
+            if not (hasattr(module, "layer_idx") and hasattr(module, "in_proj") and hasattr(module, "x_proj")):
+                continue
+            layer = module.layer_idx
+            if self.layers is not None and layer not in self.layers:
+                continue
+            self.handles.append(module.register_forward_pre_hook(partial(self._mixer_pre_hook, layer), with_kwargs=True))
+            if "mixer_output" in self.tensors:
+                self.handles.append(module.register_forward_hook(partial(self._output_hook, layer, "mixer_output")))
+            if "conv_input" in self.tensors:
+                self.handles.append(module.in_proj.register_forward_hook(partial(self._in_proj_hook, layer)))
+            if "conv_output" in self.tensors:
+                self.handles.append(module.x_proj.register_forward_pre_hook(partial(self._input_hook, layer, "conv_output")))
+        return self
+
+    def detach(self):
+        for handle in self.handles:
+            handle.remove()
+        self.handles = []
+
+    def close(self):
+        """remove the hooks and wait until everything is on disk"""
+        self.detach()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _mixer_pre_hook(self, layer, module, args, kwargs):
+        cache_params = kwargs.get("cache_params", args[1] if len(args) > 1 else None)
+        self.offsets[layer] = getattr(cache_params, "seqlen_offset", 0) if cache_params is not None else 0
+        if "mixer_input" in self.tensors:
+            self.record(layer, "mixer_input", args[0] if len(args) > 0 else kwargs["hidden_states"])
+
+    def _output_hook(self, layer, name, module, args, output):
+        self.record(layer, name, output)
+
+    def _input_hook(self, layer, name, module, args):
+        self.record(layer, name, args[0])
+
+    def _in_proj_hook(self, layer, module, args, output):
+        self.record(layer, "conv_input", output[..., : output.size(-1) // 2])
+
+    @torch.no_grad()
+    def record(self, layer, name, tensor):
+        if tensor.dim() == 2:  # single decoding step without the token dim
+            tensor = tensor.unsqueeze(1)
+        start = self.offsets.get(layer, 0)
+        lo, hi = start, start + tensor.size(1)
+        if self.token_range is not None:
+            lo = max(lo, self.token_range[0])
+            hi = hi if self.token_range[1] is None else min(hi, self.token_range[1])
+            if lo >= hi:
+                return
+        x = tensor.detach()[:, lo - start: hi - start]
+        if self.dtype is not None:
+            x = x.to(self.dtype)
+
+        event = None
+        if x.is_cuda:
+            host = torch.empty(x.shape, dtype=x.dtype, pin_memory=True)
+            host.copy_(x, non_blocking=True)
+            event = torch.cuda.Event()
+            event.record()
+        else:
+            host = x.clone()
+        meta = dict(self.tag, layer=layer, name=name, start=lo, shape=list(host.shape), dtype=str(host.dtype).replace("torch.", ""))
+        self.writer.put(meta, host, event)
+
+
+def read_index(save_dir, **filters):
+    """metadata of the records whose fields match `filters` (e.g. layer=0, name="conv_input"), in writing order"""
+    metas = []
+    with open(os.path.join(save_dir, INDEX_NAME)) as f:
+        for line in f:
+            meta = json.loads(line)
+            if all(meta.get(k) == v for k, v in filters.items()):
+                metas.append(meta)
+    return metas
+
+
+def read_record(save_dir, meta, shards=None):
+    """tensor of one record, `shards` is an optional dict caching the opened memmaps"""
+    shards = {} if shards is None else shards
+    if meta["shard"] not in shards:
+        shards[meta["shard"]] = np.memmap(os.path.join(save_dir, shard_name(meta["shard"])), dtype=np.uint8, mode="r")
+    data = shards[meta["shard"]][meta["offset"]: meta["offset"] + meta["nbytes"]]
+    return torch.frombuffer(bytearray(data), dtype=getattr(torch, meta["dtype"])).view(meta["shape"])
+
+
+def iter_trace(save_dir, metas=None, **filters):
+    """(meta, tensor) pairs, read one at a time from the memmapped shards"""
+    shards = {}
+    for meta in (read_index(save_dir, **filters) if metas is None else metas):
+        yield meta, read_record(save_dir, meta, shards)
+
+
+def load_trace(save_dir, **filters):
+    """all the records of a trace whose metadata match `filters`, as (meta, tensor) pairs"""
+    return list(iter_trace(save_dir, **filters))
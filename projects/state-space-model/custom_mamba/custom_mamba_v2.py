@@ -141,17 +141,7 @@ class MambaMixer(nn.Module):
 
     def cuda_kernels_forward(self, hidden_states: torch.Tensor, cache_params=None, extra_kwargs=None):
         
-        analysis_mode = False
-            
-        if extra_kwargs is not None: ## for analysis
-            analysis_layers = [0, 11, 23, 35, 47]
-            depth = extra_kwargs.get("depth", None)
-            save_dir = extra_kwargs.get("save_dir", None)
-            ctx_length = extra_kwargs.get("ctx_length", None)
-            if ctx_length in [500, 1000, 2000, 4000, 8000, 16000, 32000] and depth in [0.05, 0.55, 1.0]:
-                analysis_mode = True
-                depth = str(depth).replace(".", "_")    
-
+        # activations for analysis are traced with forward hooks, see custom_mamba/activation_trace.py
         # 1. Gated MLP's linear projection
         projected_states = self.in_proj(hidden_states).transpose(1, 2)
 
@@ -187,20 +177,9 @@ class MambaMixer(nn.Module):
                     self.activation,
                 )
                 hidden_states = hidden_states.unsqueeze(-1)
-
-                if analysis_mode:  # save first hidden state
-                    if self.layer_idx in analysis_layers:  # analysis step: save the 1-st hidden_state
-                        save_path = os.path.join(f"{save_dir}/ctx_length_{ctx_length}-depth_{depth}/layer_{self.layer_idx}", f"hidden_states_{cache_params.seqlen_offset}.pkl")
-                        auto_save_data(hidden_states[:, :, 0].cpu(), save_path)
             
             else:
                 if cache_params is not None:
-                    
-                    if analysis_mode:  # save first hidden state
-                        if self.layer_idx in analysis_layers:  # analysis step: save the 1-st hidden_state
-                            save_path = os.path.join(f"{save_dir}/ctx_length_{ctx_length}-depth_{depth}/layer_{self.layer_idx}", "first_hidden_state.pkl")
-                            auto_save_data(hidden_states.cpu(), save_path)
-
                     conv_states = nn.functional.pad(
                         hidden_states, (self.conv_kernel_size - hidden_states.shape[-1], 0)
                     )
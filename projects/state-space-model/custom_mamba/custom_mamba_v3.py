@@ -57,21 +57,74 @@ class MambaCausalLMOutput(ModelOutput):
 
 
 class MambaCache:
-    def __init__(self, config, batch_size, dtype=torch.float16, device=None):
+    """
+    conv / ssm states of all the layers, allocated once and only updated in place
+        conv_buffer: [num_layers, batch, intermediate_size, conv_kernel_size], one ring per layer, the oldest input
+                     of layer i is in column `conv_starts[i]` (0 after the prefill, the cuda kernels keep it at 0)
+        ssm_buffer:  [num_layers, batch, intermediate_size, ssm_state_size], float32 like the states of the scans
+    conv_states[i] / ssm_states[i] are views of layer i, write them with `.copy_` (or the methods below)
+    """
+    def __init__(self, config, batch_size, dtype=torch.float16, device=None, conv_kernel_size=None, ssm_dtype=torch.float32):
         self.seqlen_offset = 0
         self.dtype = dtype
-        intermediate_size = config.intermediate_size
-        ssm_state_size = config.state_size
-        conv_kernel_size = config.conv_kernel
+        self.num_layers = config.num_hidden_layers
+        conv_kernel_size = config.conv_kernel if conv_kernel_size is None else conv_kernel_size
+        self.conv_buffer = torch.zeros(
+            self.num_layers, batch_size, config.intermediate_size, conv_kernel_size, device=device, dtype=dtype
+        )
+        self.ssm_buffer = torch.zeros(
+            self.num_layers, batch_size, config.intermediate_size, config.state_size, device=device, dtype=ssm_dtype
+        )
+        self._make_views()
+
+    def _make_views(self):
+        self.conv_states = [self.conv_buffer[i] for i in range(self.num_layers)]
+        self.ssm_states = [self.ssm_buffer[i] for i in range(self.num_layers)]
+        self.conv_starts = [0] * self.num_layers
+
+    def set_conv_state(self, layer_idx, x):
+        """prefill, keeps the last conv_kernel_size inputs of x [batch, intermediate_size, seq_len] (zeros on the left)"""
+        conv_state = self.conv_states[layer_idx]
+        width = min(conv_state.size(-1), x.size(-1))
+        conv_state[..., : conv_state.size(-1) - width].zero_()
+        conv_state[..., conv_state.size(-1) - width:].copy_(x[..., x.size(-1) - width:])
+        self.conv_starts[layer_idx] = 0
+
+    def update_conv_state(self, layer_idx, x):
+        """
+        decoding, writes the input of the new token x [batch, intermediate_size] over the oldest one,
+        returns the conv state and the column of its oldest input (see `ring_conv_weight`)
+        """
+        start = self.conv_starts[layer_idx]
+        self.conv_states[layer_idx][..., start].copy_(x)
+        self.conv_starts[layer_idx] = (start + 1) % self.conv_buffer.size(-1)
+        return self.conv_states[layer_idx], self.conv_starts[layer_idx]
+
+    def ordered_conv_state(self, layer_idx):
+        """copy of the conv state of a layer, oldest input first"""
+        return torch.roll(self.conv_states[layer_idx], shifts=-self.conv_starts[layer_idx], dims=-1)
+
+    def reorder(self, beam_idx):
+        """
+        keep / repeat the batch entries `beam_idx` (batch reordering, beam selection), the views stay valid
+        as long as the batch size does not change
+        """
+        beam_idx = beam_idx.to(self.conv_buffer.device)
+        if beam_idx.numel() == self.conv_buffer.size(1):
+            self.conv_buffer.copy_(self.conv_buffer.index_select(1, beam_idx))
+            self.ssm_buffer.copy_(self.ssm_buffer.index_select(1, beam_idx))
+        else:
+            conv_starts = self.conv_starts
+            self.conv_buffer = self.conv_buffer.index_select(1, beam_idx)
+            self.ssm_buffer = self.ssm_buffer.index_select(1, beam_idx)
+            self._make_views()
+            self.conv_starts = conv_starts
+        return self
+
 
-        self.conv_states = {
-            i: torch.zeros(batch_size, intermediate_size, conv_kernel_size, device=device, dtype=dtype)
-            for i in range(config.num_hidden_layers)
-        }
-        self.ssm_states = {
-            i: torch.zeros(batch_size, intermediate_size, ssm_state_size, device=device, dtype=dtype)
-            for i in range(config.num_hidden_layers)
-        }
+def ring_conv_weight(weight, start):
+    """conv weight [..., kernel_size] aligned with a ring conv state whose oldest input is in column `start`"""
+    return torch.roll(weight, shifts=start, dims=-1) if start else weight
 
 
 class MambaRMSNorm(nn.Module):
@@ -118,8 +171,24 @@ class GatedMultiScaleConv1dNoTrain(nn.Module):
         
 
 class GatedMultiScaleConv1d(nn.Module):
+    """
+    one gated causal conv per kernel size, conv k gives channels [k * D // n, (k + 1) * D // n) of the output
+    The convs are run as a single grouped conv of the max kernel size: the kernels are zero padded on the
+    left and interleaved so that fused output channel j * n + k is channel j of conv k (they read the same
+    input group), the gates of all the convs are then applied at once.
+    """
     def __init__(self, in_channels, out_channels, kernel_sizes):
         super(GatedMultiScaleConv1d, self).__init__()
+        self.kernel_sizes = list(kernel_sizes)
+        self.max_kernel_size = max(self.kernel_sizes)
+        self.groups = out_channels // len(kernel_sizes) * 2
+        if out_channels % len(self.kernel_sizes) or in_channels % self.groups:
+            raise ValueError(
+                f"GatedMultiScaleConv1d with {len(self.kernel_sizes)} kernel sizes needs out_channels ({out_channels}) divisible by "
+                f"the number of kernel sizes and in_channels ({in_channels}) divisible by 2 * out_channels / len(kernel_sizes) "
+                f"({self.groups}), i.e. an even number of kernel sizes when in_channels == out_channels"
+            )
+        self._fused_cache = None
         self.convs = nn.ModuleList([
             nn.Sequential(
                 nn.ConstantPad1d((kernel_size - 1, 0), 0),
@@ -132,7 +201,45 @@ class GatedMultiScaleConv1d(nn.Module):
             ) for kernel_size in kernel_sizes
         ])
         
+    def fused_weight(self):
+        """weight [2 * D, in_channels // groups, max_kernel_size] and bias of the fused grouped conv"""
+        convs = [conv[1] for conv in self.convs]
+        key = tuple((p.data_ptr(), p._version) for p in self.parameters())
+        if not torch.is_grad_enabled() and self._fused_cache is not None and self._fused_cache[0] == key:
+            return self._fused_cache[1]  # decoding: the weights did not change since the last step
+        weight = torch.stack([
+            nn.functional.pad(conv.weight, (self.max_kernel_size - kernel_size, 0)) 
+            for conv, kernel_size in zip(convs, self.kernel_sizes)
+        ], dim=1).flatten(0, 1)
+        bias = torch.stack([conv.bias for conv in convs], dim=1).flatten() if convs[0].bias is not None else None
+        if not torch.is_grad_enabled():
+            self._fused_cache = (key, (weight, bias))
+        return weight, bias
+
+    def gate(self, conv_output):
+        # [B, 2 * D, L] fused channels (gate / output, channel, conv) -> [B, D, L] ordered (conv, channel)
+        batch_size, _, seq_len = conv_output.shape
+        conv_output = conv_output.view(batch_size, 2, -1, len(self.kernel_sizes), seq_len)
+        outputs = conv_output[:, 1] * torch.sigmoid(conv_output[:, 0])
+        return outputs.transpose(1, 2).reshape(batch_size, -1, seq_len)
+
     def forward(self, x):
+        weight, bias = self.fused_weight()
+        x = nn.functional.pad(x, (self.max_kernel_size - 1, 0))  # causal, same as the ConstantPad1d of each conv
+        return self.gate(nn.functional.conv1d(x, weight, bias, groups=self.groups))
+
+    def step(self, conv_state, start=0):
+        """
+        one decoding step, conv_state: [B, in_channels, max_kernel_size] window of the last inputs (zero padded
+        on the left), a ring whose oldest input is in column `start`, returns the output at the newest position [B, D]
+        """
+        weight, bias = self.fused_weight()
+        weight = ring_conv_weight(weight, start)
+        conv_output = nn.functional.conv1d(conv_state, weight, bias, groups=self.groups)
+        return self.gate(conv_output)[..., -1]
+
+    def loop_forward(self, x):
+        """one conv per kernel size, the reference for `forward`"""
         outputs = []
         for conv in self.convs:
             conv_output = conv(x)
@@ -190,6 +297,7 @@ class MambaMixer(nn.Module):
                     config.intermediate_size, 
                     kernel_sizes
                 )
+                self.conv_kernel_size = self.conv1d.max_kernel_size  # rolling conv state for decoding
                 self.multi_conv1d = True  # use multi_conv1d_forward
             else:
                 raise ValueError("Invalid kernel_sizes (<=4) for GatedMultiScaleConv1d or utilize custom module")
@@ -240,28 +348,19 @@ class MambaMixer(nn.Module):
         if cache_params is not None:
             ssm_state = cache_params.ssm_states[self.layer_idx]
             if cache_params.seqlen_offset > 0:
-                conv_state = cache_params.conv_states[self.layer_idx] # [batch, intermediate_size, conv_kernel_size]
-                conv_state = torch.roll(conv_state, shifts=-1, dims=-1)
-                conv_state[:, :, -1] = hidden_states[:, :, 0]
-                cache_params.conv_states[self.layer_idx] = conv_state.clone()
-                # hidden_states = self.convs(conv_state)      #TODO WARNING
-                hidden_states = self.conv1d(conv_state) 
+                # ring conv state [batch, intermediate_size, conv_kernel_size], updated in place
+                conv_state, start = cache_params.update_conv_state(self.layer_idx, hidden_states[:, :, 0])
+                hidden_states = self.conv1d.step(conv_state, start)
                 hidden_states = self.act(hidden_states).to(dtype).unsqueeze(-1)         # [batch, intermediate_size, 1] : decoding
             else:
-                conv_state = nn.functional.pad(  # only save last conv_kernel_size states
-                    hidden_states,
-                    (self.conv_kernel_size - hidden_states.shape[-1], 0)
-                )
-                cache_params.conv_states[self.layer_idx] = conv_state.clone()
-                # hidden_states = self.act(self.convs(hidden_states)[..., :seq_len])     # [batch, intermediate_size, seq_len] #TODO WARNING
-                hidden_states = self.act(self.conv1d(hidden_states)[..., :seq_len])
+                cache_params.set_conv_state(self.layer_idx, hidden_states)  # only save last conv_kernel_size states
+                hidden_states = self.act(self.conv1d(hidden_states)[..., :seq_len])     # [batch, intermediate_size, seq_len]
         else:
             ssm_state = torch.zeros(
                 (batch_size, self.intermediate_size, self.ssm_state_size),
                 device=hidden_states.device, dtype=dtype
             )
-            # hidden_states = self.act(self.convs(hidden_states)[..., :seq_len])
-            hidden_states = self.act(self.conv1d(hidden_states)[..., :seq_len])  #TODO WARNING
+            hidden_states = self.act(self.conv1d(hidden_states)[..., :seq_len])
 
         # 3.a. Selection:  [batch, seq_len, self.time_step_rank + self.ssm_state_size * 2]
         ssm_parameters = self.x_proj(hidden_states.transpose(1, 2))
@@ -303,10 +402,8 @@ class MambaMixer(nn.Module):
                 delta_softplus=True,
                 return_last_state=True,
             )
-
-
-        if cache_params is not None:
-            cache_params.ssm_states[self.layer_idx] = ssm_state.clone()
+            if cache_params is not None:
+                cache_params.ssm_states[self.layer_idx].copy_(ssm_state)
 
         # 4. Final linear projection
         contextualized_states = self.out_proj(scan_outputs.transpose(1, 2))
@@ -318,14 +415,11 @@ class MambaMixer(nn.Module):
         
         analysis_mode = False
         
-        if extra_kwargs is not None: ## for analysis
-            analysis_layers = [0, 11, 23, 35, 47]
+        if extra_kwargs is not None: ## for analysis, activations are traced with custom_mamba/activation_trace.py
             depth = extra_kwargs.get("depth", None)
-            save_dir = extra_kwargs.get("save_dir", None)
             ctx_length = extra_kwargs.get("ctx_length", None)
             if ctx_length in [500, 1000, 2000, 4000, 8000, 16000, 32000] and depth in [0.05, 0.55, 1.0]:
                 analysis_mode = True
-                depth = str(depth).replace(".", "_")    
 
         if analysis_mode:
             hidden_states.requires_grad_(True)
@@ -365,24 +459,10 @@ class MambaMixer(nn.Module):
                     self.activation,
                 )
                 hidden_states = hidden_states.unsqueeze(-1)
-
-                if analysis_mode:  # save first hidden state
-                    if self.layer_idx in analysis_layers:  # analysis step: save the 1-st hidden_state
-                        save_path = os.path.join(f"{save_dir}/ctx_length_{ctx_length}-depth_{depth}/layer_{self.layer_idx}", f"hidden_states_{cache_params.seqlen_offset}.pkl")
-                        auto_save_data(hidden_states[:, :, 0].cpu(), save_path)
             
             else:
                 if cache_params is not None:
-                    
-                    if analysis_mode:  # save first hidden state
-                        if self.layer_idx in analysis_layers:  # analysis step: save the 1-st hidden_state
-                            save_path = os.path.join(f"{save_dir}/ctx_length_{ctx_length}-depth_{depth}/layer_{self.layer_idx}", "first_hidden_state.pkl")
-                            auto_save_data(hidden_states.cpu(), save_path)
-
-                    conv_states = nn.functional.pad(
-                        hidden_states, (self.conv_kernel_size - hidden_states.shape[-1], 0)
-                    )
-                    cache_params.conv_states[self.layer_idx].copy_(conv_states)
+                    cache_params.set_conv_state(self.layer_idx, hidden_states)
                 
                 hidden_states = causal_conv1d_fn(
                     hidden_states, conv_weights, self.conv1d.bias, activation=self.activation
@@ -446,35 +526,16 @@ class MambaMixer(nn.Module):
         if cache_params is not None:
             ssm_state = cache_params.ssm_states[self.layer_idx]
             if cache_params.seqlen_offset > 0:
-                conv_state = cache_params.conv_states[self.layer_idx] # [batch, intermediate_size, conv_kernel_size]
-                conv_state = torch.roll(conv_state, shifts=-1, dims=-1)
-                conv_state[:, :, -1] = hidden_states[:, :, 0]
-                cache_params.conv_states[self.layer_idx] = conv_state.clone()
-                hidden_states = torch.sum(conv_state * self.conv1d.weight[:, 0, :], dim=-1)
+                # ring conv state [batch, intermediate_size, conv_kernel_size], updated in place
+                conv_state, start = cache_params.update_conv_state(self.layer_idx, hidden_states[:, :, 0])
+                hidden_states = torch.sum(conv_state * ring_conv_weight(self.conv1d.weight[:, 0, :], start), dim=-1)
 
                 if self.use_conv_bias:
                     hidden_states += self.conv1d.bias
                 hidden_states = self.act(hidden_states).to(dtype).unsqueeze(-1) # [batch, intermediate_size, 1] : decoding
             else:
-                conv_state = nn.functional.pad(  # only save last conv_kernel_size states
-                    hidden_states,
-                    (self.conv_kernel_size - hidden_states.shape[-1], 0)
-                )
-                cache_params.conv_states[self.layer_idx] = conv_state.clone()
-
-                if extra_kwargs is not None and extra_kwargs['depth'] == 0.0 and self.layer_idx % 8 == 0:
-                    auto_save_data(
-                        hidden_states, 
-                        f"/nvme/zecheng/modelzipper/projects/state-space-model/analysis/analysis_version2/ctx-{extra_kwargs['ctx_length']}/layer_{self.layer_idx}-contextstate.pkl"
-                    )
-
+                cache_params.set_conv_state(self.layer_idx, hidden_states)  # only save last conv_kernel_size states
                 hidden_states = self.act(self.conv1d(hidden_states)[..., :seq_len]) # [batch, intermediate_size, seq_len]
-
-                if extra_kwargs is not None and extra_kwargs['depth'] == 0.0 and self.layer_idx % 8 == 0:
-                    auto_save_data(
-                        hidden_states, 
-                        f"/nvme/zecheng/modelzipper/projects/state-space-model/analysis/analysis_version2/ctx-{extra_kwargs['ctx_length']}/layer_{self.layer_idx}-conv1dstates.pkl"
-                    )
         else:
             ssm_state = torch.zeros(
                 (batch_size, self.intermediate_size, self.ssm_state_size),  # intermediate_size: 4096, ssm_state_size: 16
@@ -536,18 +597,21 @@ class MambaMixer(nn.Module):
             deltaB_u = discrete_B * hidden_states[:, :, :, None].float()
 
             # 3.c perform the recurrence y ← SSM(A, B, C)(x)
-            scan_outputs = []
-            for i in range(seq_len):
-                ssm_state = discrete_A[:, :, i, :] * ssm_state + deltaB_u[:, :, i, :]  # [batch, intermediade_size, ssm_state]
-                scan_output = torch.matmul(ssm_state.to(dtype), C[:, i, :].unsqueeze(-1))  # [batch, intermediade_size, 1]
-                scan_outputs.append(scan_output[:, :, 0])
-            scan_output = torch.stack(scan_outputs, dim=-1) # [batch, seq_len, intermediade_size]
+            if cache_params is not None and cache_params.seqlen_offset > 0:  # single token, the cached state is updated in place
+                ssm_state.mul_(discrete_A[:, :, 0, :]).add_(deltaB_u[:, :, 0, :])
+                scan_output = torch.matmul(ssm_state.to(dtype), C[:, 0, :].unsqueeze(-1))  # [batch, intermediade_size, 1]
+            else:
+                scan_outputs = []
+                for i in range(seq_len):
+                    ssm_state = discrete_A[:, :, i, :] * ssm_state + deltaB_u[:, :, i, :]  # [batch, intermediade_size, ssm_state]
+                    scan_output = torch.matmul(ssm_state.to(dtype), C[:, i, :].unsqueeze(-1))  # [batch, intermediade_size, 1]
+                    scan_outputs.append(scan_output[:, :, 0])
+                scan_output = torch.stack(scan_outputs, dim=-1) # [batch, seq_len, intermediade_size]
+                if cache_params is not None:
+                    cache_params.ssm_states[self.layer_idx].copy_(ssm_state)
             scan_output = scan_output + (hidden_states * self.D[None, :, None])
             scan_output = (scan_output * self.act(gate))
 
-            if cache_params is not None:
-                cache_params.ssm_states[self.layer_idx] = ssm_state.clone()
-
         # 4. Final linear projection
         contextualized_states = self.out_proj(scan_output.transpose(1, 2)) # [batch, seq_len, hidden_size]
             
@@ -684,7 +748,8 @@ class CustomMambaModel(MambaPreTrainedModel):
 
         if cache_params is None and use_cache:
             cache_params = MambaCache(
-                self.config, inputs_embeds.size(0), device=inputs_embeds.device, dtype=inputs_embeds.dtype
+                self.config, inputs_embeds.size(0), device=inputs_embeds.device, dtype=inputs_embeds.dtype,
+                conv_kernel_size=self.layers[0].mixer.conv_kernel_size,  # kernel size of the custom convs
             )
 
         position_embeds = None
@@ -792,6 +857,10 @@ class CustomMambaForCausalLM(MambaPreTrainedModel):
         model_kwargs["cache_params"] = outputs["cache_params"]
         return model_kwargs
 
+    @staticmethod
+    def _reorder_cache(cache_params, beam_idx):
+        return cache_params.reorder(beam_idx)
+
     def prepare_inputs_for_generation(
         self, input_ids, cache_params=None, inputs_embeds=None, attention_mask=None, extra_kwargs=None, **kwargs,
     ):  
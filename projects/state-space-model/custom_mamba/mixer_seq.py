@@ -666,6 +666,15 @@ class MambaBlock(nn.Module):
         return hidden_states
 
 
+def compact_inference_cache(inference_params, keep):
+    """keep only the batch rows `keep` (LongTensor) of every cached state, e.g. to drop finished sequences"""
+    for layer_idx, states in inference_params.key_value_memory_dict.items():
+        inference_params.key_value_memory_dict[layer_idx] = tuple(state.index_select(0, keep) for state in states)
+    if getattr(inference_params, "lengths_per_sample", None) is not None:
+        inference_params.lengths_per_sample = inference_params.lengths_per_sample.index_select(0, keep)
+    inference_params.max_batch_size = keep.numel()
+
+
 @torch.inference_mode()
 def decode(
     input_ids,
@@ -676,11 +685,14 @@ def decode(
     top_p=0.0,
     temperature=1.0,
     eos_token_id=None,
+    pad_token_id=None,
     teacher_outputs=None,
     vocab_size=None,
     tensor_parallel=1,
     cg=False,
     enable_timing=False,
+    output_scores=False,
+    compact_ratio=0.5,
 ):
     """Decoding, either greedy or with top-k or top-p sampling.
     If top-k = 0, don't limit the number of candidates (pure sampling).
@@ -691,14 +703,22 @@ def decode(
     Arguments:
         input_ids: (batch, seq_len)
         max_length: int
+        min_length: int, eos_token_id can not be sampled before this position
+        eos_token_id (optional): a sequence is finished once it samples it, and only gets pad_token_id
+            (default eos_token_id) afterwards
         teacher_outputs (optional): (batch, seq_len). If provided, instead of sampling from the
             logits, the next token is taken from the teacher_outputs. Useful for testing.
+        output_scores: keep the logits of every step, -inf for the finished sequences
+        compact_ratio (optional): the finished sequences are dropped from the batch and the inference cache
+            once they are at least this fraction of the decoded batch, None to always decode the full batch
+            (not used with cg, the graphs are captured for a fixed batch size)
     Returns: GreedySearchDecoderOnlyOutput or SampleDecoderOnlyOutput, with the following fields:
         sequences: (batch, max_length)
-        scores: tuples of (batch, vocab_size)
+        scores: tuples of (batch, vocab_size), None unless output_scores
     """
     batch_size, seqlen_og = input_ids.shape
     teacher_output_len = teacher_outputs.shape[1] if teacher_outputs is not None else 0
+    pad_token_id = eos_token_id if pad_token_id is None else pad_token_id
     if cg:
         if not hasattr(model, "_decoding_cache"):
             model._decoding_cache = None
@@ -712,6 +732,7 @@ def decode(
         )
         inference_params = model._decoding_cache.inference_params
         inference_params.reset(max_length, batch_size)
+        compact_ratio = None
     else:
         inference_params = InferenceParams(max_seqlen=max_length, max_batch_size=batch_size)
 
@@ -719,7 +740,7 @@ def decode(
         decoding = inference_params.seqlen_offset > 0
         if decoding:
             position_ids = torch.full(
-                (batch_size, 1),
+                (input_ids.shape[0], 1),
                 inference_params.seqlen_offset,
                 dtype=torch.long,
                 device=input_ids.device,
@@ -739,18 +760,18 @@ def decode(
             ).squeeze(dim=1)
         return logits[..., :vocab_size] if vocab_size is not None else logits
 
-    def sample_tokens(logits, inference_params):
+    def sample_tokens(logits, inference_params, rows):
         if teacher_outputs is None or teacher_output_len <= inference_params.seqlen_offset:
             token = sample(logits, top_k=top_k, top_p=top_p, temperature=temperature)
         else:
-            token = teacher_outputs[:, inference_params.seqlen_offset]
+            token = teacher_outputs[rows, inference_params.seqlen_offset]
         # return rearrange(token, "b -> b 1")
         return token.unsqueeze(1)
 
-    def should_stop(current_token, inference_params):
+    def should_stop(num_finished, num_rows, inference_params):
         if inference_params.seqlen_offset == 0 or inference_params.seqlen_offset < min_length:
             return False
-        if eos_token_id is not None and (current_token == eos_token_id).all():
+        if eos_token_id is not None and num_finished == num_rows:
             return True
         if inference_params.seqlen_offset >= max_length - 1:
             return True
@@ -765,10 +786,37 @@ def decode(
         start.record()
     scores, sequences = [], [input_ids]
 
-    while not should_stop(sequences[-1], inference_params):
-        scores.append(get_logits(sequences[-1], inference_params))
-        inference_params.seqlen_offset += sequences[-1].shape[1]
-        sequences.append(sample_tokens(scores[-1], inference_params))
+    # the decoded batch: original row of each sequence, and which of them sampled eos
+    rows = torch.arange(batch_size, device=input_ids.device)
+    finished = torch.zeros(batch_size, dtype=torch.bool, device=input_ids.device)
+    num_finished, current_token = 0, input_ids
+
+    while not should_stop(num_finished, rows.numel(), inference_params):
+        if compact_ratio is not None and num_finished > 0 and num_finished >= compact_ratio * rows.numel():
+            keep = torch.nonzero(~finished).squeeze(1)
+            compact_inference_cache(inference_params, keep)
+            rows, finished, current_token = rows[keep], finished[keep], current_token[keep]
+            num_finished = 0
+
+        logits = get_logits(current_token, inference_params)
+        inference_params.seqlen_offset += current_token.shape[1]
+        if eos_token_id is not None and inference_params.seqlen_offset < min_length:
+            logits[..., eos_token_id] = -float("inf")
+        if output_scores:
+            full_logits = logits.new_full((batch_size, logits.shape[-1]), -float("inf"))
+            full_logits[rows] = logits.masked_fill(finished.unsqueeze(1), -float("inf"))
+            scores.append(full_logits)
+
+        current_token = sample_tokens(logits, inference_params, rows)
+        if eos_token_id is not None:
+            current_token = current_token.masked_fill(finished.unsqueeze(1), pad_token_id)
+            finished |= current_token.squeeze(1) == eos_token_id
+            num_finished = int(finished.sum())  # the only sync of the step, as the `.all()` it replaces
+
+        if rows.numel() == batch_size:
+            sequences.append(current_token)
+        else:  # dropped rows are finished
+            sequences.append(current_token.new_full((batch_size, 1), pad_token_id).index_copy_(0, rows, current_token))
     
     if enable_timing:
         end.record()
@@ -777,7 +825,7 @@ def decode(
         torch.cuda.synchronize()
         print(f"Prompt processing + decoding time: {(start.elapsed_time(end)):.0f}ms")
     output_cls = GreedySearchDecoderOnlyOutput if top_k == 1 else SampleDecoderOnlyOutput
-    return output_cls(sequences=torch.cat(sequences, dim=1), scores=tuple(scores))
+    return output_cls(sequences=torch.cat(sequences, dim=1), scores=tuple(scores) if output_scores else None)
 
 
 class GenerationMixin:
@@ -794,13 +842,14 @@ class GenerationMixin:
         temperature=1.0,
         return_dict_in_generate=False,
         output_scores=False,
+        eos_token_id=None,
+        pad_token_id=None,
         **kwargs,
     ):
         output = decode(
             input_ids, self, max_length, min_length, top_k=top_k, top_p=top_p, temperature=temperature, 
+            eos_token_id=eos_token_id, pad_token_id=pad_token_id, output_scores=output_scores,
         )
-        if not output_scores:
-            output.scores = None
         return output if return_dict_in_generate else output.sequences
 
 
@@ -0,0 +1,58 @@
+"""
+Checks of the fused GatedMultiScaleConv1d in custom_mamba_v3.py, run from projects/state-space-model:
+
+    python custom_mamba/test_multi_scale_conv.py      (or pytest custom_mamba/test_multi_scale_conv.py)
+
+The fused grouped conv sums the taps in another order than the per-scale convs, so in fp32 it matches
+`loop_forward` to ~1e-7 (up to ~1e-6 with long kernels), not bit for bit, the checks use a tolerance.
+"""
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import torch
+import torch.nn as nn
+from custom_mamba.custom_mamba_v3 import GatedMultiScaleConv1d
+
+KERNEL_SIZES = [[2, 4, 8, 16], [4, 16, 64, 256], [3, 5], [2, 3, 5, 7, 9, 11]]
+
+
+def test_fused_forward_matches_loop():
+    torch.manual_seed(0)
+    for kernel_sizes in KERNEL_SIZES:
+        conv = GatedMultiScaleConv1d(48, 48, kernel_sizes)
+        x = torch.randn(2, 48, 300)
+        out, ref = conv(x), conv.loop_forward(x)
+        assert torch.allclose(out, ref, rtol=1e-5, atol=1e-6), (kernel_sizes, (out - ref).abs().max())
+
+        grads = torch.autograd.grad(out.square().sum(), list(conv.parameters()))
+        ref_grads = torch.autograd.grad(ref.square().sum(), list(conv.parameters()))
+        for grad, ref_grad in zip(grads, ref_grads):
+            assert torch.allclose(grad, ref_grad, rtol=1e-4, atol=1e-4), (kernel_sizes, (grad - ref_grad).abs().max())
+
+
+def test_step_matches_forward():
+    torch.manual_seed(0)
+    conv = GatedMultiScaleConv1d(32, 32, [2, 4, 8, 16])
+    x = torch.randn(2, 32, 40)
+    with torch.no_grad():
+        ref = conv(x)
+        state = torch.zeros(2, 32, conv.max_kernel_size)
+        for t in range(x.size(-1)):
+            state = torch.roll(state, -1, -1)
+            state[..., -1] = x[..., t]
+            assert torch.allclose(conv.step(state), ref[..., t], rtol=1e-5, atol=1e-6), t
+
+
+def test_odd_number_of_kernel_sizes():
+    try:
+        GatedMultiScaleConv1d(48, 48, [2, 4, 8])
+    except ValueError:
+        return
+    raise AssertionError("an odd number of kernel sizes with in_channels == out_channels must be rejected")
+
+
+if __name__ == "__main__":
+    test_fused_forward_matches_loop()
+    test_step_matches_forward()
+    test_odd_number_of_kernel_sizes()
+    print("ok")
@@ -9,6 +9,7 @@ from sklearn.decomposition import PCA
 from modelzipper.tutils import *
 from utils import *
 from captum.attr import IntegratedGradients
+from custom_mamba.activation_trace import ActivationTracer
 
 def analysis_cov1d_kernel(module):
     weights = module.weight.data.cpu().numpy()
@@ -21,12 +22,13 @@ def analysis_cov1d_kernel(module):
 
 
 class Experiment(pl.LightningModule):
-    def __init__(self, model, config, tokenizer=None, state="eval") -> None:
+    def __init__(self, model, config, tokenizer=None, state="eval", tracer=None) -> None:
         super(Experiment, self).__init__()
         self.model = model
         self.model.eval()
         self.cfg = config
         self.tokenizer = tokenizer
+        self.tracer = tracer
         try:
             self.hold_graph = self.params['retain_first_backpass']
         except:
@@ -44,10 +46,11 @@ class Experiment(pl.LightningModule):
         extra_kwargs = {
             "ctx_length": ctx_length,
             "depth": depth,
-            "save_dir": "/nvme/zecheng/modelzipper/projects/state-space-model/analysis/inner_state2",
             "bos_pos": bos_pos, 
             "eos_pos": eos_pos,
         }
+        if self.tracer is not None:
+            self.tracer.set_tag(ctx_length=ctx_length, depth=depth, batch_idx=batch_idx)
 
         output = self.model.generate(
             input_ids, min_length=input_ids.size(-1)+10, max_length=input_ids.size(-1)+32, extra_kwargs=extra_kwargs)
@@ -84,8 +87,17 @@ def main(config):
     data_module = CustomDatamodule(config.task, data_root_dir, tokenizer)
     data_module.setup(stage='predict')
 
+    # trace the mixer activations in the background, see custom_mamba/activation_trace.py
+    tracer = None
+    trace_cfg = config.get("trace", None)
+    if trace_cfg is not None and trace_cfg.save_dir is not None:
+        tracer = ActivationTracer(
+            trace_cfg.save_dir, layers=trace_cfg.layers, tensors=trace_cfg.tensors, 
+            token_range=trace_cfg.token_range, dtype=getattr(torch, trace_cfg.dtype) if trace_cfg.dtype else None,
+        ).attach(model)
+
     # load experiment (and model checkpoint)
-    experiment = Experiment(model=model, config=config, tokenizer=tokenizer)
+    experiment = Experiment(model=model, config=config, tokenizer=tokenizer, tracer=tracer)
     tester = pl.Trainer(devices=config.experiment.device_num, precision="bf16")
     
     #########################
@@ -108,6 +120,9 @@ def main(config):
         ckpt_path=config.model.ckpt_path if config.model.load_model_state_dict else None
     )
 
+    if tracer is not None:
+        tracer.close()  # flush the pending activations
+
     print_c(f"======= prediction end, begin to post process and save =======", "magenta")
     save_path = "/nvme/zecheng/evaluation/analysis/gen_res.pkl"
     # save_path = os.path.join(config.platform.result_path, f"{config.experiment.results_save_dir}/predictions.pkl")
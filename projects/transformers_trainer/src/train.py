@@ -3,6 +3,9 @@ import os
 sys.path.append(os.getcwd())
 import copy
 import random
+import bisect
+import hashlib
+import numpy as np
 from dataclasses import dataclass, field
 from typing import Optional, Dict, Sequence
 import torch
@@ -27,6 +30,8 @@ class ModelArguments:
 @dataclass
 class DataArguments:
     data_path: str = field(default=None, metadata={"help": "Path to the training data."})
+    packing_length: Optional[int] = field(default=None, metadata={"help": "Pack short examples into sequences of this many tokens."})
+    preprocess_cache_dir: Optional[str] = field(default=None, metadata={"help": "Where to cache the tokenized (and packed) data."})
 
 @dataclass
 class TrainingArguments(transformers.TrainingArguments):
@@ -70,45 +75,198 @@ def smart_tokenizer_and_embedding_resize(
         output_embeddings[-num_new_tokens:] = output_embeddings_avg
 
 
-def _tokenize_fn(strings: Sequence[str], tokenizer: transformers.PreTrainedTokenizer) -> Dict:
-    """Tokenize a list of strings."""
-    tokenized_list = [
-        tokenizer(
-            text,
-            return_tensors="pt",
-            padding="longest",
+def _tokenize_fn(strings: Sequence[str], tokenizer: transformers.PreTrainedTokenizer, chunk_size: int = 10000) -> Dict:
+    """Tokenize a list of strings, a few batched calls instead of one call per string."""
+    input_ids = []
+    for start in range(0, len(strings), chunk_size):
+        tokenized = tokenizer(
+            list(strings[start:start + chunk_size]),
             max_length=tokenizer.model_max_length,
             truncation=True,
         )
-        for text in strings
-    ]
-    input_ids = labels = [tokenized.input_ids[0] for tokenized in tokenized_list]
-    input_ids_lens = labels_lens = [
-        tokenized.input_ids.ne(tokenizer.pad_token_id).sum().item() for tokenized in tokenized_list
-    ]
+        input_ids.extend(torch.tensor(ids, dtype=torch.long) for ids in tokenized["input_ids"])
+    input_ids_lens = [len(ids) for ids in input_ids]
     return dict(
         input_ids=input_ids,
-        labels=labels,
+        labels=input_ids,
         input_ids_lens=input_ids_lens,
-        labels_lens=labels_lens,
+        labels_lens=input_ids_lens,
     )
 
 
+def _prompt_lens_from_offsets(sources: Sequence[str], offset_mapping, special_tokens_mask) -> list:
+    """Number of prompt tokens of each example: the tokens before the first non-special token starting in the target.
+
+    A token spanning the source / target boundary starts in the source and is masked. This can differ from
+    `len(tokenize(source))`, the old rule, which also masks the first target token when the source alone
+    tokenizes into more pieces than its part of the example (e.g. "... ans" + "wer" gives "ans" "wer" vs "answer").
+    """
+    prompt_lens = []
+    for source, offsets, special in zip(sources, offset_mapping, special_tokens_mask):
+        starts = np.array([start for start, _ in offsets], dtype=np.int64)
+        in_target = (starts >= len(source)) & ~np.array(special, dtype=bool)
+        prompt_lens.append(int(in_target.argmax()) if in_target.any() else len(starts))
+    return prompt_lens
+
+
 def preprocess(
     sources: Sequence[str],
     targets: Sequence[str],
     tokenizer: transformers.PreTrainedTokenizer,
+    chunk_size: int = 10000,
 ) -> Dict:
-    """Preprocess the data by tokenizing."""
+    """Preprocess the data by tokenizing.
+
+    With a fast tokenizer every example is tokenized once, and the prompt length is read from
+    the character offsets of the tokens, instead of tokenizing the sources a second time.
+    """
     examples = [s + t for s, t in zip(sources, targets)]
-    examples_tokenized, sources_tokenized = [_tokenize_fn(strings, tokenizer) for strings in (examples, sources)]
-    input_ids = examples_tokenized["input_ids"]
-    labels = copy.deepcopy(input_ids)
-    for label, source_len in zip(labels, sources_tokenized["input_ids_lens"]):
+    if not tokenizer.is_fast:
+        examples_tokenized, sources_tokenized = [_tokenize_fn(strings, tokenizer, chunk_size) for strings in (examples, sources)]
+        input_ids, prompt_lens = examples_tokenized["input_ids"], sources_tokenized["input_ids_lens"]
+    else:
+        input_ids, prompt_lens = [], []
+        for start in range(0, len(examples), chunk_size):
+            tokenized = tokenizer(
+                examples[start:start + chunk_size],
+                max_length=tokenizer.model_max_length,
+                truncation=True,
+                return_offsets_mapping=True,
+                return_special_tokens_mask=True,
+            )
+            input_ids.extend(torch.tensor(ids, dtype=torch.long) for ids in tokenized["input_ids"])
+            prompt_lens.extend(_prompt_lens_from_offsets(sources[start:start + chunk_size], tokenized["offset_mapping"], tokenized["special_tokens_mask"]))
+
+    labels = []
+    for ids, source_len in zip(input_ids, prompt_lens):
+        label = ids.clone()
         label[:source_len] = IGNORE_INDEX
+        labels.append(label)
     return dict(input_ids=input_ids, labels=labels)
 
 
+def pack_examples(input_ids: Sequence[torch.Tensor], labels: Sequence[torch.Tensor], max_length: int) -> Dict:
+    """Pack examples into sequences of at most `max_length` tokens (best-fit, longest first).
+
+    Each packed sequence keeps the boundaries of its examples: `position_ids` restart at 0 for every
+    example and `seq_lens` lists the example lengths, DataCollatorForPackedDataset turns them into a
+    block-diagonal attention mask. The first label of every example is ignored, so no token is
+    predicted across a boundary.
+    """
+    lengths = np.minimum([len(ids) for ids in input_ids], max_length)
+    bins = []  # example indices of each pack
+    free = []  # sorted (free tokens, pack index)
+    for idx in np.argsort(-lengths, kind="stable"):
+        length = int(lengths[idx])
+        pos = bisect.bisect_left(free, (length, -1))
+        if pos < len(free):
+            space, b = free.pop(pos)
+        else:
+            space, b = max_length, len(bins)
+            bins.append([])
+        bins[b].append(idx)
+        bisect.insort(free, (space - length, b))
+
+    packed = dict(input_ids=[], labels=[], position_ids=[], seq_lens=[])
+    for members in bins:
+        members = sorted(members)
+        ids = [input_ids[i][:max_length] for i in members]
+        label = [labels[i][:max_length].clone() for i in members]
+        for l in label:
+            l[0] = IGNORE_INDEX
+        packed["input_ids"].append(torch.cat(ids))
+        packed["labels"].append(torch.cat(label))
+        packed["position_ids"].append(torch.cat([torch.arange(len(x)) for x in ids]))
+        packed["seq_lens"].append(torch.tensor([len(x) for x in ids], dtype=torch.long))
+    return packed
+
+
+def cached_preprocess(
+    sources: Sequence[str],
+    targets: Sequence[str],
+    tokenizer: transformers.PreTrainedTokenizer,
+    cache_dir: Optional[str] = None,
+    packing_length: Optional[int] = None,
+) -> Dict:
+    """`preprocess` (and `pack_examples` when `packing_length` is set), saved in `cache_dir` keyed by the data and tokenizer."""
+    cache_file = None
+    if cache_dir is not None:
+        hasher = hashlib.sha1()
+        for text in (*sources, *targets):
+            hasher.update(text.encode())
+            hasher.update(b"\0")
+        hasher.update(f"{tokenizer.name_or_path}|{len(tokenizer)}|{tokenizer.model_max_length}|{packing_length}".encode())
+        cache_file = os.path.join(cache_dir, f"sft_{hasher.hexdigest()[:16]}.pt")
+        if os.path.exists(cache_file):
+            return torch.load(cache_file)
+
+    data_dict = preprocess(sources, targets, tokenizer)
+    if packing_length is not None:
+        data_dict = pack_examples(data_dict["input_ids"], data_dict["labels"], packing_length)
+
+    if cache_file is not None:
+        os.makedirs(cache_dir, exist_ok=True)
+        torch.save(data_dict, cache_file + ".tmp")
+        os.replace(cache_file + ".tmp", cache_file)
+    return data_dict
+
+
+class SupervisedDataset(torch.utils.data.Dataset):
+    """Dataset for supervised fine-tuning, optionally packed, from a jsonl file of source / target pairs."""
+
+    def __init__(self, data_path: str, tokenizer: transformers.PreTrainedTokenizer, source_key: str = "source", target_key: str = "target", packing_length: Optional[int] = None, cache_dir: Optional[str] = None):
+        super().__init__()
+        list_data_dict = auto_read_data(data_path)
+        sources = [example[source_key] for example in list_data_dict]
+        targets = [f"{example[target_key]}{tokenizer.eos_token}" for example in list_data_dict]
+        self.data_dict = cached_preprocess(sources, targets, tokenizer, cache_dir=cache_dir, packing_length=packing_length)
+
+    def __len__(self):
+        return len(self.data_dict["input_ids"])
+
+    def __getitem__(self, i) -> Dict[str, torch.Tensor]:
+        return {key: value[i] for key, value in self.data_dict.items()}
+
+
+def packed_attention_mask(seq_lens: Sequence[torch.Tensor], dtype: torch.dtype = torch.float32) -> torch.Tensor:
+    """Additive causal block-diagonal mask (batch, 1, len, len) of packed sequences, 0 = attend, dtype min = masked.
+
+    Every token only sees the earlier tokens of its own example. Padding tokens see the padding before them,
+    so no row is fully masked.
+    """
+    segment_ids = torch.nn.utils.rnn.pad_sequence(
+        [torch.repeat_interleave(torch.arange(1, len(lens) + 1), lens) for lens in seq_lens], batch_first=True, padding_value=0
+    )
+    length = segment_ids.size(1)
+    causal = torch.ones(length, length, dtype=torch.bool).tril()
+    allowed = (segment_ids[:, :, None] == segment_ids[:, None, :]) & causal
+    mask = torch.zeros(allowed.shape, dtype=dtype).masked_fill_(~allowed, torch.finfo(dtype).min)
+    return mask.unsqueeze(1)
+
+
+@dataclass
+class DataCollatorForPackedDataset(object):
+    """Collate packed (or plain) examples, padded to the longest sequence of the batch.
+
+    Packs get a 4D block-diagonal attention mask (see `packed_attention_mask`) in `mask_dtype`, which
+    should be the dtype of the model, HF attention models take it instead of the 2D padding mask.
+    """
+
+    tokenizer: transformers.PreTrainedTokenizer
+    mask_dtype: torch.dtype = torch.float32
+
+    def __call__(self, instances: Sequence[Dict]) -> Dict[str, torch.Tensor]:
+        input_ids = torch.nn.utils.rnn.pad_sequence([x["input_ids"] for x in instances], batch_first=True, padding_value=self.tokenizer.pad_token_id)
+        labels = torch.nn.utils.rnn.pad_sequence([x["labels"] for x in instances], batch_first=True, padding_value=IGNORE_INDEX)
+        batch = dict(input_ids=input_ids, labels=labels)
+        if "position_ids" in instances[0]:
+            batch["position_ids"] = torch.nn.utils.rnn.pad_sequence([x["position_ids"] for x in instances], batch_first=True, padding_value=0)
+            batch["attention_mask"] = packed_attention_mask([x["seq_lens"] for x in instances], self.mask_dtype)
+        else:
+            batch["attention_mask"] = input_ids.ne(self.tokenizer.pad_token_id)
+        return batch
+
+
 @dataclass
 class DataCollatorForSupervisedDataset(object):
     """Collate examples for supervised fine-tuning."""
@@ -147,6 +305,21 @@ class DataCollatorForSupervisedDataset(object):
         }
         
 
+def make_supervised_data_module(tokenizer: transformers.PreTrainedTokenizer, data_args, train_file: str, val_file: Optional[str] = None, mask_dtype: torch.dtype = torch.float32) -> Dict:
+    """Make dataset and collator for supervised fine-tuning."""
+    train_dataset, val_dataset = [
+        SupervisedDataset(
+            data_file, 
+            tokenizer=tokenizer, 
+            packing_length=data_args.packing_length, 
+            cache_dir=data_args.preprocess_cache_dir,
+        ) if data_file is not None else None
+        for data_file in (train_file, val_file)
+    ]
+    data_collator = DataCollatorForPackedDataset(tokenizer=tokenizer, mask_dtype=mask_dtype)
+    return dict(train_dataset=train_dataset, eval_dataset=val_dataset, data_collator=data_collator)
+
+
 class CustomTrainier(Trainer):
     def __init__(self, model, args, train_dataset, eval_dataset, tokenizer, **kwargs):
         super().__init__(
@@ -226,23 +399,30 @@ def train():
     train_file = os.path.join(data_args.data_path, "instruct_combine_train_consistency_decimal1_aug.jsonl")
     val_file = os.path.join(data_args.data_path, "instruct_combine_val_consistency_decimal1_aug.jsonl")
     
-    train_dataset = RawFileDataset(training_args, train_file, tokenizer)
-    val_dataset = RawFileDataset(training_args, val_file, tokenizer)
-
+    if data_args.packing_length is not None or data_args.preprocess_cache_dir is not None:
+        # source / target examples tokenized once (and packed), cached on disk, plain causal lm loss
+        if data_args.packing_length is not None and "gla" in model_args.model_name_or_path:
+            raise ValueError("packing needs a model taking an attention mask, GLAForCausalLM does not")
+        data_module = make_supervised_data_module(tokenizer, data_args, train_file, val_file, mask_dtype=model.dtype)
+        trainer_cls = Trainer
+    else:
+        train_dataset = RawFileDataset(training_args, train_file, tokenizer)
+        val_dataset = RawFileDataset(training_args, val_file, tokenizer)
+        data_collator = DataCollatorForSupervisedDataset(tokenizer=tokenizer)
+        data_module = dict(train_dataset=train_dataset, eval_dataset=val_dataset, data_collator=data_collator)
+        trainer_cls = CustomTrainier
 
+    train_dataset = data_module["train_dataset"]
     if training_args.local_rank == 0:
         print(len(train_dataset))
         for index in random.sample(range(len(train_dataset)), 3):
             print(f"Sample {index} of the training set: {train_dataset[index]}.")
-    
-    data_collator = DataCollatorForSupervisedDataset(tokenizer=tokenizer)
-    data_module = dict(train_dataset=train_dataset, eval_dataset=val_dataset, data_collator=data_collator)
 
     #Tell Trainer not to attempt DataParallel
     model.is_parallelizable = True
     model.model_parallel = True
 
-    trainer = CustomTrainier(model=model, tokenizer=tokenizer, args=training_args, **data_module)
+    trainer = trainer_cls(model=model, tokenizer=tokenizer, args=training_args, **data_module)
     model.config.use_cache = False
 
     trainer.train()
@@ -0,0 +1,75 @@
+"""
+Checks of the packed SFT preprocessing in src/train.py, run from projects/transformers_trainer:
+
+    python test_packing.py      (or pytest test_packing.py)
+"""
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "src"))
+import torch
+import transformers
+from tokenizers import Tokenizer, models, pre_tokenizers
+from train import IGNORE_INDEX, DataCollatorForPackedDataset, pack_examples, preprocess
+
+
+def tiny_tokenizer():
+    # "answer" is one token, "ans" alone is split into "an" "##s"
+    vocab = {"[PAD]": 0, "</s>": 1, "what": 2, "is": 3, "the": 4, "answer": 5, "an": 6, "##s": 7, "?": 8, ":": 9, "yes": 10, "[UNK]": 11}
+    tokenizer = Tokenizer(models.WordPiece(vocab, unk_token="[UNK]", max_input_chars_per_word=100))
+    tokenizer.pre_tokenizer = pre_tokenizers.Sequence([pre_tokenizers.WhitespaceSplit(), pre_tokenizers.Punctuation()])
+    return transformers.PreTrainedTokenizerFast(tokenizer_object=tokenizer, pad_token="[PAD]", eos_token="</s>", model_max_length=64)
+
+
+def tiny_llama(attn_implementation):
+    config = transformers.LlamaConfig(
+        vocab_size=32, hidden_size=32, intermediate_size=64, num_hidden_layers=2,
+        num_attention_heads=4, num_key_value_heads=4, max_position_embeddings=64,
+    )
+    torch.manual_seed(0)
+    return transformers.LlamaForCausalLM._from_config(config, attn_implementation=attn_implementation).eval()
+
+
+def test_packed_forward_equals_separate_forwards():
+    torch.manual_seed(0)
+    lengths = [5, 3, 7, 2, 6, 4]
+    input_ids = [torch.randint(2, 32, (n,)) for n in lengths]
+    labels = [ids.clone() for ids in input_ids]
+    packed = pack_examples(input_ids, labels, max_length=12)
+    assert sum(len(x) for x in packed["input_ids"]) == sum(lengths)
+
+    tokenizer = tiny_tokenizer()
+    instances = [{k: v[i] for k, v in packed.items()} for i in range(len(packed["input_ids"]))]
+    batch = DataCollatorForPackedDataset(tokenizer=tokenizer)(instances)
+    for attn_implementation in ("eager", "sdpa"):
+        model = tiny_llama(attn_implementation)
+        with torch.no_grad():
+            logits = model(input_ids=batch["input_ids"], attention_mask=batch["attention_mask"], position_ids=batch["position_ids"]).logits
+            for row, seq_lens in enumerate(packed["seq_lens"]):
+                start = 0
+                for n in seq_lens.tolist():
+                    alone = model(input_ids=batch["input_ids"][row: row + 1, start: start + n]).logits[0]
+                    assert torch.allclose(logits[row, start: start + n], alone, atol=1e-5), attn_implementation
+                    start += n
+
+
+def test_prompt_masking_from_offsets():
+    tokenizer = tiny_tokenizer()
+    sources = ["what is the answer ? ", "what is the ans", "what is the answer?"]
+    targets = ["yes</s>", "wer: yes</s>", " : yes</s>"]
+    data = preprocess(sources, targets, tokenizer)
+    for source, ids, label in zip(sources, data["input_ids"], data["labels"]):
+        masked = int((label == IGNORE_INDEX).sum())
+        assert torch.equal(label[masked:], ids[masked:])
+        # the prompt ends with the last token starting in the source: "ans" + "wer" gives "answer", which is masked,
+        # but the source alone has one token more ("an" "##s"), which the old len(tokenize(source)) rule masked
+        prompt = tokenizer(source)["input_ids"]
+        if source.endswith("ans"):
+            assert masked == len(prompt) - 1
+        else:
+            assert masked == len(prompt)
+
+
+if __name__ == "__main__":
+    test_packed_forward_equals_separate_forwards()
+    test_prompt_masking_from_offsets()
+    print("ok")